@@ -0,0 +1,3 @@
+from asahi.batch import QueryBatch, msearch, amsearch
+from asahi.refresh import refresh_after
+from asahi.session import Session
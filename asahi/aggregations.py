@@ -0,0 +1,304 @@
+from datetime import datetime
+from .properties import DateTimeProperty, ListProperty
+from .exceptions import PropertyNotExist
+
+
+class Aggregation(object):
+    """
+    The aggregation of Query.aggregate().
+    http://www.elastic.co/guide/en/elasticsearch/reference/1.7/search-aggregations.html
+    """
+    aggregation_type = None
+
+    def __init__(self, member):
+        """
+        Init the aggregation.
+        :param member: {string} The property name of the document.
+        """
+        self.member = member
+
+    def get_body(self, document_class):
+        """
+        Generate the body of this aggregation.
+        :param document_class: {Document} The document class of the query.
+        :return: {dict} {aggregation_type: {options}}
+        """
+        self._get_property(document_class)
+        return {self.aggregation_type: self._get_options()}
+
+    def parse(self, document_class, response):
+        """
+        Convert the response of this aggregation to the python result.
+        :param document_class: {Document} The document class of the query.
+        :param response: {dict} The aggregation result of ElasticSearch.
+        :return:
+        """
+        return response.get('value')
+
+    def _get_options(self):
+        """
+        Get options of this aggregation.
+        :return: {dict}
+        """
+        return {'field': self.member}
+
+    def _get_property(self, document_class):
+        """
+        Get the property of the member.
+        :param document_class: {Document} The document class of the query.
+        :return: {Property or None} None if the member is the field of the dict property. ('dict.field')
+        """
+        property_name = self.member.split('.', 1)[0]
+        property = document_class.get_properties().get(property_name)
+        if property is None:
+            raise PropertyNotExist('%s not in %s' % (self.member, document_class.__name__))
+        if property_name != self.member:
+            return None
+        return property
+
+
+# ---------------------------------------------------------
+# Bucket aggregations
+# ---------------------------------------------------------
+class Bucket(object):
+    """
+    The bucket of the bucket aggregation.
+    Results of sub aggregations are available by bucket['name'].
+    :attribute key: The key of the bucket converted by the property.
+    :attribute doc_count: {int} The number of documents in the bucket.
+    :attribute aggregations: {dict} {name: result} Results of sub aggregations.
+    """
+    def __init__(self, key, doc_count, aggregations=None):
+        self.key = key
+        self.doc_count = doc_count
+        self.aggregations = aggregations or {}
+
+    def __getitem__(self, item):
+        return self.aggregations[item]
+
+    def __eq__(self, other):
+        if not isinstance(other, Bucket):
+            return False
+        return (self.key, self.doc_count, self.aggregations) == (other.key, other.doc_count, other.aggregations)
+
+    def __repr__(self):
+        return 'Bucket(%r, %r, %r)' % (self.key, self.doc_count, self.aggregations)
+
+
+class BucketAggregation(Aggregation):
+    def __init__(self, member, aggs=None):
+        """
+        Init the bucket aggregation.
+        :param member: {string} The property name of the document.
+        :param aggs: {dict} {name: {Aggregation}} Sub aggregations of each bucket.
+        """
+        super(BucketAggregation, self).__init__(member)
+        self.aggs = aggs or {}
+
+    def get_body(self, document_class):
+        """
+        Generate the body of this aggregation and sub aggregations.
+        :param document_class: {Document} The document class of the query.
+        :return: {dict} {aggregation_type: {options}, 'aggs': {dict}}
+        """
+        body = super(BucketAggregation, self).get_body(document_class)
+        if self.aggs:
+            body['aggs'] = generate_aggregations_body(document_class, self.aggs)
+        return body
+
+    def parse(self, document_class, response):
+        """
+        Convert buckets of the response.
+        :param document_class: {Document} The document class of the query.
+        :param response: {dict} The aggregation result of ElasticSearch.
+        :return: {list} [{Bucket}]
+        """
+        to_python = self._get_key_converter(document_class)
+        return [
+            Bucket(
+                to_python(x),
+                x['doc_count'],
+                parse_aggregations_response(document_class, self.aggs, x),
+            )
+            for x in response['buckets']
+        ]
+
+    def _get_key_converter(self, document_class):
+        """
+        Get the function which converts the key of the bucket by the property.
+        :param document_class: {Document} The document class of the query.
+        :return: {function} ({dict}bucket) -> key
+        """
+        property = self._get_property(document_class)
+        if isinstance(property, DateTimeProperty) or \
+                (isinstance(property, ListProperty) and property.item_type is datetime):
+            # keys of dates are timestamps, key_as_string is formatted by the mapping
+            return lambda bucket: DateTimeProperty._to_python(bucket.get('key_as_string', bucket['key']))
+        if isinstance(property, ListProperty):
+            if issubclass(property.item_type, dict):
+                return lambda bucket: bucket['key']
+            return lambda bucket: property.item_type(bucket['key'])
+        if property is None:
+            return lambda bucket: bucket['key']
+        return lambda bucket: property._to_python(bucket['key'])
+
+
+class Terms(BucketAggregation):
+    aggregation_type = 'terms'
+
+    def __init__(self, member, size=10, descending=True, aggs=None):
+        """
+        Group documents by values of the member.
+        :param member: {string} The property name of the document.
+        :param size: {int} The number of buckets.
+        :param descending: {bool} Are buckets sorted by doc_count descending?
+        :param aggs: {dict} {name: {Aggregation}} Sub aggregations of each bucket.
+        """
+        super(Terms, self).__init__(member, aggs)
+        self.size = size
+        self.descending = descending
+
+    def _get_options(self):
+        return {
+            'field': self.member,
+            'size': self.size,
+            'order': {
+                '_count': 'desc' if self.descending else 'asc'
+            },
+        }
+
+
+class DateHistogram(BucketAggregation):
+    aggregation_type = 'date_histogram'
+
+    def __init__(self, member, interval='day', time_zone=None, min_doc_count=None, aggs=None):
+        """
+        Group documents by the interval of the datetime property.
+        :param member: {string} The property name of the document.
+        :param interval: {string} 'year', 'quarter', 'month', 'week', 'day', 'hour', 'minute', 'second' or '1.5h'
+        :param time_zone: {string} The time zone of buckets. '+08:00'
+        :param min_doc_count: {int} 0: empty buckets are returned too.
+        :param aggs: {dict} {name: {Aggregation}} Sub aggregations of each bucket.
+        """
+        super(DateHistogram, self).__init__(member, aggs)
+        self.interval = interval
+        self.time_zone = time_zone
+        self.min_doc_count = min_doc_count
+
+    def get_body(self, document_class):
+        property = self._get_property(document_class)
+        if property is not None and not isinstance(property, DateTimeProperty) and \
+                not (isinstance(property, ListProperty) and property.item_type is datetime):
+            raise ValueError('date_histogram needs the datetime property, %s is %s'
+                             % (self.member, property.__class__.__name__))
+        return super(DateHistogram, self).get_body(document_class)
+
+    def _get_options(self):
+        options = {
+            'field': self.member,
+            'interval': self.interval,
+        }
+        if self.time_zone is not None:
+            options['time_zone'] = self.time_zone
+        if self.min_doc_count is not None:
+            options['min_doc_count'] = self.min_doc_count
+        return options
+
+    def _get_key_converter(self, document_class):
+        return lambda bucket: DateTimeProperty._to_python(bucket.get('key_as_string', bucket['key']))
+
+
+# ---------------------------------------------------------
+# Metrics aggregations
+# ---------------------------------------------------------
+class Sum(Aggregation):
+    aggregation_type = 'sum'
+
+class Avg(Aggregation):
+    aggregation_type = 'avg'
+
+class Min(Aggregation):
+    aggregation_type = 'min'
+
+class Max(Aggregation):
+    aggregation_type = 'max'
+
+class Stats(Aggregation):
+    aggregation_type = 'stats'
+
+    def parse(self, document_class, response):
+        """
+        :return: {dict} {'count': {int}, 'min': {float}, 'max': {float}, 'avg': {float}, 'sum': {float}}
+        """
+        return {x: response.get(x) for x in ('count', 'min', 'max', 'avg', 'sum')}
+
+class Percentiles(Aggregation):
+    aggregation_type = 'percentiles'
+
+    def __init__(self, member, percents=None):
+        """
+        Approximate percentiles of values of the member.
+        :param member: {string} The property name of the document.
+        :param percents: {list} [{float}] The default is [1, 5, 25, 50, 75, 95, 99].
+        """
+        super(Percentiles, self).__init__(member)
+        self.percents = percents
+
+    def _get_options(self):
+        options = {'field': self.member}
+        if self.percents is not None:
+            options['percents'] = self.percents
+        return options
+
+    def parse(self, document_class, response):
+        """
+        :return: {dict} {{float}percent: {float}value}
+        """
+        return {float(x): y for x, y in response['values'].items()}
+
+class Cardinality(Aggregation):
+    aggregation_type = 'cardinality'
+
+    def __init__(self, member, precision_threshold=None):
+        """
+        The approximate count of distinct values of the member.
+        :param member: {string} The property name of the document.
+        :param precision_threshold: {int} Counts below this are expected to be close to accurate.
+        """
+        super(Cardinality, self).__init__(member)
+        self.precision_threshold = precision_threshold
+
+    def _get_options(self):
+        options = {'field': self.member}
+        if self.precision_threshold is not None:
+            options['precision_threshold'] = self.precision_threshold
+        return options
+
+    def parse(self, document_class, response):
+        """
+        :return: {int}
+        """
+        return int(response['value'])
+
+
+def generate_aggregations_body(document_class, aggregations):
+    """
+    Generate the aggs body of aggregations.
+    :param document_class: {Document} The document class of the query.
+    :param aggregations: {dict} {name: {Aggregation}}
+    :return: {dict} {name: {body}}
+    """
+    for name, aggregation in aggregations.items():
+        if not isinstance(aggregation, Aggregation):
+            raise TypeError('%s should be an Aggregation, not %s' % (name, aggregation.__class__.__name__))
+    return {name: aggregation.get_body(document_class) for name, aggregation in aggregations.items()}
+
+def parse_aggregations_response(document_class, aggregations, response):
+    """
+    Convert results of aggregations.
+    :param document_class: {Document} The document class of the query.
+    :param aggregations: {dict} {name: {Aggregation}}
+    :param response: {dict} The aggregations of the search response or the bucket.
+    :return: {dict} {name: result}
+    """
+    return {name: aggregation.parse(document_class, response[name]) for name, aggregation in aggregations.items()}
@@ -0,0 +1,140 @@
+import json
+from elasticsearch.client.utils import _make_path, _escape
+from elasticsearch.serializer import JSONSerializer
+from elasticsearch.exceptions import HTTP_EXCEPTIONS, TransportError, ConnectionError, NotFoundError
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class AsyncIndicesClient(object):
+    def __init__(self, client):
+        self.client = client
+
+    async def exists(self, index):
+        try:
+            await self.client.perform_request('HEAD', _make_path(index))
+        except NotFoundError:
+            return False
+        return True
+
+    async def create(self, index, body=None):
+        return await self.client.perform_request('PUT', _make_path(index), body=body)
+
+    async def refresh(self, index=None):
+        return await self.client.perform_request('POST', _make_path(index, '_refresh'))
+
+
+class AsyncElasticsearch(object):
+    """
+    The asyncio client of ElasticSearch over aiohttp.
+    It only provides apis which are used by asahi.
+    Requests share keep-alive connections of the aiohttp session, so they don't cost threads.
+    """
+    def __init__(self, url='http://localhost:9200', maxsize=10):
+        """
+        Init the client.
+        :param url: {string} The url of ElasticSearch.
+        :param maxsize: {int} The max number of connections.
+        """
+        if aiohttp is None:
+            raise ImportError('aiohttp is required for the asyncio api of asahi')
+        self.url = url.rstrip('/')
+        self.maxsize = maxsize
+        self.serializer = JSONSerializer()
+        self.indices = AsyncIndicesClient(self)
+        self.__session = None
+
+    async def perform_request(self, method, path, params=None, body=None):
+        """
+        Perform the http request.
+        :param method: {string} The http method.
+        :param path: {string} The url path.
+        :param params: {dict} The query string.
+        :param body: {dict or string} The request body.
+        :return: {dict} The response.
+        """
+        if self.__session is None:
+            self.__session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit_per_host=self.maxsize),
+            )
+        if params:
+            params = {key: self.__escape(value) for key, value in params.items() if value is not None}
+        if body is not None and not isinstance(body, str):
+            body = self.serializer.dumps(body)
+        try:
+            async with self.__session.request(
+                    method, self.url + path, params=params, data=body,
+                    headers={'Content-Type': 'application/json'}) as response:
+                raw_data = await response.text()
+                status = response.status
+        except aiohttp.ClientError as e:
+            raise ConnectionError('N/A', str(e), e)
+        if not 200 <= status < 300:
+            self.__raise_error(status, raw_data)
+        return self.serializer.loads(raw_data) if raw_data else {}
+
+    async def close(self):
+        """
+        Close connections of this client.
+        """
+        if self.__session is not None:
+            await self.__session.close()
+            self.__session = None
+
+    async def aclose(self):
+        """
+        Close the aiohttp session of this client. It is close() by the name of the asyncio api of asahi.
+        """
+        await self.close()
+
+    async def get(self, index, id, doc_type='_all', **params):
+        return await self.perform_request('GET', _make_path(index, doc_type, id), params=params)
+
+    async def mget(self, body, index=None, doc_type=None, **params):
+        return await self.perform_request('POST', _make_path(index, doc_type, '_mget'), params=params, body=body)
+
+    async def index(self, index, doc_type, body, id=None, **params):
+        return await self.perform_request('POST' if id is None else 'PUT',
+                                          _make_path(index, doc_type, id), params=params, body=body)
+
+    async def update(self, index, doc_type, id, body=None, **params):
+        return await self.perform_request('POST', _make_path(index, doc_type, id, '_update'), params=params, body=body)
+
+    async def delete(self, index, doc_type, id, **params):
+        return await self.perform_request('DELETE', _make_path(index, doc_type, id), params=params)
+
+    async def search(self, index=None, doc_type=None, body=None, **params):
+        return await self.perform_request('POST', _make_path(index, doc_type, '_search'), params=params, body=body)
+
+    async def msearch(self, body, index=None, doc_type=None, **params):
+        return await self.perform_request('POST', _make_path(index, doc_type, '_msearch'), params=params,
+                                          body=''.join([self.serializer.dumps(x) + '\n' for x in body]))
+
+    async def count(self, index=None, doc_type=None, body=None, **params):
+        return await self.perform_request('POST', _make_path(index, doc_type, '_count'), params=params, body=body)
+
+    def __escape(self, value):
+        """
+        Convert the value of the query string to the string.
+        """
+        value = _escape(value)
+        if isinstance(value, bytes):
+            return value.decode('utf-8')
+        return value
+
+    def __raise_error(self, status_code, raw_data):
+        """
+        Raise the exception like elasticsearch-py.
+        """
+        error_message = raw_data
+        additional_info = None
+        try:
+            additional_info = json.loads(raw_data)
+            error_message = additional_info.get('error', error_message)
+            if isinstance(error_message, dict) and 'type' in error_message:
+                error_message = error_message['type']
+        except (ValueError, AttributeError):
+            pass
+        raise HTTP_EXCEPTIONS.get(status_code, TransportError)(status_code, error_message, additional_info)
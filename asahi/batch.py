@@ -0,0 +1,158 @@
+from .deep_query import update_batch_reference_properties, aupdate_batch_reference_properties
+from .aggregations import parse_aggregations_response
+from .exceptions import TransportError
+
+
+class QuerySpec(object):
+    """
+    One search of the multi-search request.
+    It is made by Query.fetch_spec(), count_spec(), group_by_spec() and aggregate_spec().
+    :attribute query: {asahi.query.Query}
+    :attribute operation: {string} 'fetch', 'count', 'group_by' or 'aggregate'
+    :attribute body: {dict or None} The search body. None if the result is known without the request.
+    :attribute result: The result in the same shape of Query.fetch(), count(), group_by() or aggregate().
+    """
+    def __init__(self, query, operation, body=None, result=None, fetch_reference=False, deferred=None, include=None,
+                 aggregations=None):
+        """
+        Init the spec.
+        :param query: {asahi.query.Query}
+        :param operation: {string} 'fetch', 'count', 'group_by' or 'aggregate'
+        :param body: {dict} The search body.
+        :param result: The result if it is known without the request. (the query contains the empty list)
+        :param fetch_reference: {bool} Update reference properties of fetched documents.
+        :param deferred: {set} The names of deferred properties of fetched documents.
+        :param include: {list} The reference paths which should be resolved.
+        :param aggregations: {dict} {name: {asahi.aggregations.Aggregation}} The aggregations of aggregate_spec().
+        """
+        self.query = query
+        self.operation = operation
+        self.body = body
+        self.result = result
+        self.fetch_reference = fetch_reference
+        self.deferred = deferred
+        self.include = include
+        self.aggregations = aggregations
+
+
+class QueryBatch(object):
+    """
+    Run many queries in one _msearch round trip.
+    example:
+        batch = QueryBatch()
+        models = batch.add(SampleModel.where('name', equal='asahi').fetch_spec(20))
+        count = batch.add(SampleModel.all().count_spec())
+        (documents, total), count = batch.execute()
+    """
+    def __init__(self, specs=None):
+        """
+        Init the batch.
+        :param specs: {list} [{QuerySpec}]
+        """
+        self.specs = list(specs or [])
+
+    def add(self, spec):
+        """
+        Add the spec into this batch.
+        :param spec: {QuerySpec}
+        :return: {QuerySpec}
+        """
+        self.specs.append(spec)
+        return spec
+
+    def execute(self):
+        """
+        Send all searches with one _msearch request.
+        References of all fetched documents are resolved together.
+        :return: {list} Results in the order of specs.
+        """
+        requests = [x for x in self.specs if x.body is not None]
+        if requests:
+            for document_class in set([x.query.document_class for x in requests]):
+                document_class.ensure_index()
+            es = requests[0].query.document_class._es
+            response = es.msearch(body=self.__generate_body(requests))
+            self.__apply_responses(requests, response['responses'])
+        update_batch_reference_properties(self.__get_reference_groups())
+        return [x.result for x in self.specs]
+
+    async def aexecute(self):
+        """
+        Send all searches with one _msearch request with asyncio.
+        :return: {list} Results in the order of specs.
+        """
+        requests = [x for x in self.specs if x.body is not None]
+        if requests:
+            for document_class in set([x.query.document_class for x in requests]):
+                await document_class.aensure_index()
+            es = requests[0].query.document_class._async_es
+            response = await es.msearch(body=self.__generate_body(requests))
+            self.__apply_responses(requests, response['responses'])
+        await aupdate_batch_reference_properties(self.__get_reference_groups())
+        return [x.result for x in self.specs]
+
+    def __generate_body(self, requests):
+        """
+        Generate the body of the _msearch request.
+        :param requests: {list} [{QuerySpec}]
+        :return: {list} [{header}, {body}, {header}, {body}...]
+        """
+        body = []
+        for spec in requests:
+            body.append({'index': spec.query.document_class.get_index_name()})
+            body.append(spec.body)
+        return body
+
+    def __apply_responses(self, requests, responses):
+        """
+        Convert responses of the _msearch request to results of specs.
+        :param requests: {list} [{QuerySpec}]
+        :param responses: {list} The responses of the _msearch request.
+        """
+        for spec, response in zip(requests, responses):
+            if 'error' in response:
+                raise TransportError(response.get('status', 500), response['error'])
+            if spec.operation == 'fetch':
+                document_class = spec.query.document_class
+                documents = [document_class._from_hit(x, spec.deferred) for x in response['hits']['hits']]
+                spec.result = (documents, response['hits']['total'])
+            elif spec.operation == 'count':
+                spec.result = response['hits']['total']
+            elif spec.operation == 'group_by':
+                spec.result = response['aggregations']['group']['buckets']
+            elif spec.operation == 'aggregate':
+                spec.result = parse_aggregations_response(
+                    spec.query.document_class, spec.aggregations, response.get('aggregations', {}))
+
+    def __get_reference_groups(self):
+        """
+        Get fetched documents which references should be resolved.
+        :return: {list} [({list}[{Document}], {list or None}include)]
+        """
+        groups = []
+        for spec in self.specs:
+            if spec.operation == 'fetch' and (spec.fetch_reference or spec.include is not None):
+                groups.append((spec.result[0], spec.include))
+        return groups
+
+
+def msearch(specs):
+    """
+    Run many queries in one _msearch round trip.
+    :param specs: {list} [{QuerySpec}]
+        query.fetch_spec(), query.count_spec(), query.group_by_spec() or query.aggregate_spec()
+    :return: {list} Results in the order of specs.
+        fetch_spec: ({list}[{Document}], {int}total)
+        count_spec: {int}
+        group_by_spec: {list}[{dict}]
+        aggregate_spec: {dict} {name: result}
+    """
+    return QueryBatch(specs).execute()
+
+async def amsearch(specs):
+    """
+    Run many queries in one _msearch round trip with asyncio.
+    :param specs: {list} [{QuerySpec}]
+    :return: {list} Results in the order of specs.
+    """
+    return await QueryBatch(specs).aexecute()
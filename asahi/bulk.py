@@ -0,0 +1,153 @@
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from elasticsearch.serializer import JSONSerializer
+from .exceptions import TransportError
+
+
+DEFAULT_CHUNK_SIZE = 500
+DEFAULT_MAX_CHUNK_BYTES = 10 * 1024 * 1024
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_INITIAL_BACKOFF = 2
+
+serializer = JSONSerializer()
+
+
+class BulkAction(object):
+    """
+    One operation of the bulk request.
+    """
+    def __init__(self, operation, index, doc_type, id=None, version=None, body=None, item=None):
+        """
+        Init the bulk action.
+        :param operation: {string} 'index', 'update' or 'delete'
+        :param index: {string} The index name.
+        :param doc_type: {string} The document type.
+        :param id: {string} The document id.
+        :param version: {int} The version for the optimistic concurrency control.
+        :param body: {dict} The document source for 'index', {'doc': {dict}} for 'update'.
+        :param item: The object which will be passed back with the result. (Document)
+        """
+        self.operation = operation
+        self.index = index
+        self.doc_type = doc_type
+        self.id = id
+        self.version = version
+        self.body = body
+        self.item = item
+        self.result = None
+        self.error = None
+
+        header = {
+            '_index': index,
+            '_type': doc_type,
+        }
+        if id is not None:
+            header['_id'] = id
+        if version is not None:
+            header['_version'] = version
+        lines = [serializer.dumps({operation: header})]
+        if body is not None:
+            lines.append(serializer.dumps(body))
+        self.data = '\n'.join(lines) + '\n'
+        self.size = len(self.data.encode('utf-8'))
+
+
+def chunk_actions(actions, chunk_size=DEFAULT_CHUNK_SIZE, max_chunk_bytes=DEFAULT_MAX_CHUNK_BYTES):
+    """
+    Split actions into chunks by count and byte size.
+    :param actions: {list} [{BulkAction}]
+    :param chunk_size: {int} The max number of actions in one chunk.
+    :param max_chunk_bytes: {int} The max bytes of one chunk.
+    :return: {generator} [{BulkAction}]
+    """
+    chunk = []
+    chunk_bytes = 0
+    for action in actions:
+        if chunk and (len(chunk) >= chunk_size or chunk_bytes + action.size > max_chunk_bytes):
+            yield chunk
+            chunk = []
+            chunk_bytes = 0
+        chunk.append(action)
+        chunk_bytes += action.size
+    if chunk:
+        yield chunk
+
+
+def execute(es, actions, chunk_size=DEFAULT_CHUNK_SIZE, max_chunk_bytes=DEFAULT_MAX_CHUNK_BYTES,
+            max_retries=DEFAULT_MAX_RETRIES, initial_backoff=DEFAULT_INITIAL_BACKOFF, **kwargs):
+    """
+    Execute actions with the _bulk api.
+    Items rejected with 429 (the bulk queue of the cluster is full) are retried with exponential backoff.
+    :param es: {Elasticsearch}
+    :param actions: {list} [{BulkAction}]
+    :param chunk_size: {int} The max number of actions in one request.
+    :param max_chunk_bytes: {int} The max bytes of one request.
+    :param max_retries: {int} The max times to retry the rejected items.
+    :param initial_backoff: {int} The seconds to wait before the first retry. It is doubled for each retry.
+    :param kwargs: The other arguments of es.bulk(). (refresh)
+    :return: {list} [{BulkAction}] The failed actions. action.error is the error of the item.
+    """
+    failures = []
+    for chunk in chunk_actions(actions, chunk_size, max_chunk_bytes):
+        for attempt in range(max_retries + 1):
+            rejected = []
+            try:
+                response = es.bulk(body=''.join([x.data for x in chunk]), **kwargs)
+            except TransportError as e:
+                if e.status_code != 429:
+                    raise e
+                for action in chunk:
+                    action.error = e.error
+                rejected = chunk
+            else:
+                for action, response_item in zip(chunk, response['items']):
+                    action.result = list(response_item.values())[0]
+                    if action.result.get('status') == 429:
+                        action.error = action.result.get('error')
+                        rejected.append(action)
+                    elif action.result.get('error'):
+                        action.error = action.result.get('error')
+                        failures.append(action)
+                    else:
+                        action.error = None
+            if not rejected:
+                break
+            if attempt < max_retries:
+                time.sleep(initial_backoff * 2 ** attempt)
+                chunk = rejected
+        else:
+            failures.extend(rejected)
+    return failures
+
+
+def parallel_execute(es, pages, workers=4, chunk_size=DEFAULT_CHUNK_SIZE, max_chunk_bytes=DEFAULT_MAX_CHUNK_BYTES,
+                     **kwargs):
+    """
+    Execute pages of actions with parallel workers.
+    Pages are read lazily, at most workers + 1 pages are in memory.
+    :param es: {Elasticsearch}
+    :param pages: {iterable} [({list}[{BulkAction}], checkpoint)] The checkpoint is passed back with the result.
+    :param workers: {int} The number of pages which are executed at the same time.
+    :param chunk_size: {int} The max number of actions in one request.
+    :param max_chunk_bytes: {int} The max bytes of one request.
+    :param kwargs: The other arguments of execute(). (max_retries, initial_backoff)
+    :return: {generator} [({int}, {list}, checkpoint)] in the order of pages
+        The number of actions of the page.
+        [{BulkAction}] The failed actions of the page.
+        The checkpoint of the page. All pages before it are finished too.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        running = deque()  # [(future, {int}, checkpoint)]
+        for actions, checkpoint in pages:
+            running.append((
+                executor.submit(execute, es, actions, chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes, **kwargs),
+                len(actions),
+                checkpoint,
+            ))
+            if len(running) >= workers:
+                future, count, page_checkpoint = running.popleft()
+                yield count, future.result(), page_checkpoint
+        while running:
+            future, count, page_checkpoint = running.popleft()
+            yield count, future.result(), page_checkpoint
@@ -0,0 +1,134 @@
+import time
+import threading
+from collections import OrderedDict
+from elasticsearch.serializer import JSONSerializer
+
+
+serializer = JSONSerializer()
+
+
+class DocumentCache(object):
+    """
+    The LRU cache with TTL for Document.get().
+    It stores the serialized hits of ElasticSearch. Every get returns a new copy of the hit,
+    so changing a document in place doesn't change the cache.
+    invalidate() remembers the version of the write, so the hit which was read before the write is not cached again.
+    example:
+        class SampleModel(db.Document):
+            _cache = db.DocumentCache(max_items=1000, ttl=60)
+    :attribute hits: {int} The number of cache hits.
+    :attribute misses: {int} The number of cache misses.
+    :attribute evictions: {int} The number of items evicted by the limit.
+    """
+    def __init__(self, max_items=1000, ttl=60, max_bytes=None):
+        """
+        Init the cache.
+        :param max_items: {int} The max number of cached documents.
+        :param ttl: {int or float} The seconds a cached document is fresh. None is forever.
+        :param max_bytes: {int} The max bytes of cached sources. None is unlimited.
+        """
+        self.max_items = max_items
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+        self.__items = OrderedDict()  # {key: (expire_at, size, {'_id', '_version'}, {string}source)}
+        self.__invalidated = OrderedDict()  # {key: {int}version} Versions of the last writes, max_items are kept.
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__items)
+
+    def get(self, key):
+        """
+        Get the copy of the cached hit.
+        :param key: The cache key.
+        :return: {dict or None} {'_id': {string}, '_version': {int}, '_source': {dict}}
+        """
+        with self.__lock:
+            item = self.__items.get(key)
+            if item is not None and item[0] is not None and item[0] < time.time():
+                self.__remove(key)
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self.__items.move_to_end(key)
+            self.hits += 1
+        hit = dict(item[2])
+        hit['_source'] = serializer.loads(item[3])
+        return hit
+
+    def set(self, key, hit):
+        """
+        Cache the copy of the hit.
+        The hit is skipped if it is older than the last invalidated version of the key.
+        The hit which is larger than max_bytes is not cached, and the cached item of the key is removed.
+        :param key: The cache key.
+        :param hit: {dict} {'_id': {string}, '_version': {int}, '_source': {dict}}
+        """
+        source = serializer.dumps(hit.get('_source', {}))
+        size = len(source.encode('utf-8'))
+        metadata = {x: y for x, y in hit.items() if x != '_source'}
+        expire_at = None if self.ttl is None else time.time() + self.ttl
+        with self.__lock:
+            version = self.__invalidated.get(key)
+            if version is not None and hit.get('_version') is not None and hit['_version'] < version:
+                return
+            if key in self.__items:
+                self.__remove(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self.__items[key] = (expire_at, size, metadata, source)
+            self.bytes += size
+            while len(self.__items) > self.max_items or \
+                    (self.max_bytes is not None and self.bytes > self.max_bytes):
+                self.__remove(next(iter(self.__items)))
+                self.evictions += 1
+
+    def invalidate(self, key, version=None):
+        """
+        Remove the item from the cache.
+        :param key: The cache key.
+        :param version: {int} The version of the document which is written.
+            Hits older than it are not cached by set(), they could be read before the write.
+        """
+        with self.__lock:
+            if key in self.__items:
+                self.__remove(key)
+            if version is not None:
+                self.__invalidated.pop(key, None)
+                self.__invalidated[key] = version
+                while len(self.__invalidated) > self.max_items:
+                    self.__invalidated.popitem(last=False)
+
+    def clear(self):
+        """
+        Remove all items and reset counters.
+        """
+        with self.__lock:
+            self.__items.clear()
+            self.__invalidated.clear()
+            self.bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        """
+        Get statistics of the cache.
+        :return: {dict} {'hits': {int}, 'misses': {int}, 'evictions': {int}, 'items': {int}, 'bytes': {int}}
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'items': len(self.__items),
+            'bytes': self.bytes,
+        }
+
+    def __remove(self, key):
+        size = self.__items.pop(key)[1]
+        self.bytes -= size
@@ -1,3 +1,5 @@
 from asahi.document import Document
+from asahi.cache import DocumentCache
 from asahi.properties import Property, StringProperty, IntegerProperty, FloatProperty,\
     BooleanProperty, DateTimeProperty, ListProperty, DictProperty, ReferenceProperty
+from asahi.aggregations import Terms, DateHistogram, Stats, Sum, Avg, Min, Max, Percentiles, Cardinality
@@ -1,41 +1,203 @@
 import logging
 from .properties import ReferenceProperty
+from .exceptions import PropertyNotExist
 
 
-def update_reference_properties(documents):
+def update_reference_properties(documents, include=None):
     """
     Update documents for reference property.
     :param documents: {list} [{Document}]
+    :param include: {list} The reference paths which should be resolved. ['author', 'author.company']
+        None is all reference properties of documents. (one level)
     :return:
     """
-    if not len(documents):
-        return
+    update_batch_reference_properties([(documents, include)])
+
+async def aupdate_reference_properties(documents, include=None):
+    """
+    Update documents for reference property with asyncio.
+    :param documents: {list} [{Document}]
+    :param include: {list} The reference paths which should be resolved. ['author', 'author.company']
+    :return:
+    """
+    await aupdate_batch_reference_properties([(documents, include)])
+
+def update_batch_reference_properties(groups):
+    """
+    Update reference properties of many groups of documents together.
+    Each level of references is fetched with one mget request for all groups and classes.
+    :param groups: {list} [({list}[{Document}], {list or None}include)]
+    :return:
+    """
+    items = []
+    for documents, include in groups:
+        items.extend(_get_reference_items(documents, include))
     data_table = {}  # {document_class: {document_id: {Document}}}
-    reference_properties = []  # all reference properties in this Document
+    while items:
+        fetch_table = _scan_reference_items(items, data_table)
 
-    # scan what kind of documents should be fetched
-    for property_name, property in documents[0]._properties.items():
-        if not isinstance(property, ReferenceProperty):
-            continue
-        if property.reference_class not in data_table:
-            data_table[property.reference_class] = {}
-        reference_properties.append(property)
+        # fetch documents of all classes of this level with one mget request
+        result_tables, docs = _get_mget_docs(fetch_table)
+        if docs:
+            for document_class in set([x for x, _ in docs]):
+                document_class.ensure_index()
+            es = docs[0][0]._es
+            response = es.mget(body={'docs': [x for _, x in docs]})
+            _update_mget_hits(result_tables, docs, response)
+        _update_data_table(result_tables, data_table)
 
-    # scan what id of documents should be fetched
-    for document in documents:
-        for property in reference_properties:  # loop all reference properties in the document
-            data_table[property.reference_class][getattr(document, property.name)] = None
+        items = _apply_reference_items(items, data_table)
+
+async def aupdate_batch_reference_properties(groups):
+    """
+    Update reference properties of many groups of documents together with asyncio.
+    :param groups: {list} [({list}[{Document}], {list or None}include)]
+    :return:
+    """
+    items = []
+    for documents, include in groups:
+        items.extend(_get_reference_items(documents, include))
+    data_table = {}  # {document_class: {document_id: {Document}}}
+    while items:
+        fetch_table = _scan_reference_items(items, data_table)
+
+        # fetch documents
+        result_tables, docs = _get_mget_docs(fetch_table)
+        if docs:
+            for document_class in set([x for x, _ in docs]):
+                await document_class.aensure_index()
+            es = docs[0][0]._async_es
+            response = await es.mget(body={'docs': [x for _, x in docs]})
+            _update_mget_hits(result_tables, docs, response)
+        _update_data_table(result_tables, data_table)
 
-    # fetch documents
-    for document_class, items in data_table.items():
-        for reference_document in document_class.get(list(items.keys()), fetch_reference=False):
-            data_table[document_class][reference_document._id] = reference_document
+        items = _apply_reference_items(items, data_table)
 
-    # update reference properties of documents
+def _parse_include(include):
+    """
+    Parse reference paths to the tree.
+    :param include: {list} ['author', 'author.company']
+    :return: {dict} {'author': {'company': {}}}
+    """
+    tree = {}
+    for path in include:
+        node = tree
+        for name in path.split('.'):
+            node = node.setdefault(name, {})
+    return tree
+
+def _get_reference_items(documents, include):
+    """
+    Pair documents with reference properties which should be resolved.
+    :param documents: {list} [{Document}]
+    :param include: {list or None} The reference paths.
+    :return: {list} [({Document}, {dict})] The document and the tree of paths. {property_name: {sub tree}}
+    """
+    if include is not None:
+        tree = _parse_include(include)
+        return [(x, tree) for x in documents] if tree else []
+
+    trees = {}  # {document_class: {property_name: {}}}
+    items = []
     for document in documents:
-        for property in reference_properties:  # loop all reference properties in the document
-            reference_document = data_table[property.reference_class].get(getattr(document, property.name))
+        tree = trees.get(document.__class__)
+        if tree is None:
+            tree = {x: {} for x, y in document._properties.items() if isinstance(y, ReferenceProperty)}
+            trees[document.__class__] = tree
+        if tree:
+            items.append((document, tree))
+    return items
+
+def _get_reference_property(document, property_name):
+    """
+    Get the reference property of the document.
+    :param document: {Document}
+    :param property_name: {string}
+    :return: {ReferenceProperty}
+    """
+    property = document._properties.get(property_name)
+    if not isinstance(property, ReferenceProperty):
+        raise PropertyNotExist('%s is not a reference property of %s' % (property_name, document.__class__.__name__))
+    return property
+
+def _scan_reference_items(items, data_table):
+    """
+    Scan what documents should be fetched.
+    Ids which were fetched in previous levels are not fetched again.
+    :param items: {list} [({Document}, {dict})]
+    :param data_table: {dict} {document_class: {document_id: {Document}}} Documents which were fetched.
+    :return: {dict} {document_class: [document_id]}
+    """
+    fetch_table = {}
+    for document, tree in items:
+        for property_name in tree:
+            property = _get_reference_property(document, property_name)
+            document_id = document._document.get(property.name)
+            if document_id is None:
+                continue
+            fetched = data_table.setdefault(property.reference_class, {})
+            if document_id in fetched:
+                continue
+            fetched[document_id] = None
+            fetch_table.setdefault(property.reference_class, []).append(document_id)
+    return fetch_table
+
+def _get_mget_docs(fetch_table):
+    """
+    Get cached hits and docs of the multi-index mget request.
+    :param fetch_table: {dict} {document_class: [document_id]}
+    :returns: {tuple} ({dict}, {list})
+        {document_class: {document_id: {hit}}} The cached hits.
+        [(document_class, {'_index': {string}, '_type': {string}, '_id': {string}})] The docs should be fetched.
+    """
+    result_tables = {}
+    docs = []
+    for document_class, ids in fetch_table.items():
+        result_tables[document_class], class_docs = document_class._get_mget_docs(ids)
+        docs.extend([(document_class, x) for x in class_docs])
+    return result_tables, docs
+
+def _update_mget_hits(result_tables, docs, response):
+    """
+    Put hits of the mget response into result tables of their classes.
+    Hits of the response are in the order of docs of the request.
+    :param result_tables: {dict} {document_class: {document_id: {hit}}}
+    :param docs: {list} [(document_class, {doc})]
+    :param response: {dict} The response of the mget request.
+    """
+    hits_table = {}  # {document_class: [{hit}]}
+    for (document_class, _), hit in zip(docs, response['docs']):
+        hits_table.setdefault(document_class, []).append(hit)
+    for document_class, hits in hits_table.items():
+        document_class._update_mget_hits(result_tables[document_class], hits)
+
+def _update_data_table(result_tables, data_table):
+    """
+    Build documents of hits into the data table.
+    :param result_tables: {dict} {document_class: {document_id: {hit}}}
+    :param data_table: {dict} {document_class: {document_id: {Document}}}
+    """
+    for document_class, result_table in result_tables.items():
+        for document_id, hit in result_table.items():
+            data_table[document_class][document_id] = document_class._from_hit(hit)
+
+def _apply_reference_items(items, data_table):
+    """
+    Update reference properties of documents by fetched documents.
+    :param items: {list} [({Document}, {dict})]
+    :param data_table: {dict} {document_class: {document_id: {Document}}}
+    :return: {list} [({Document}, {dict})] Referenced documents which have deeper paths.
+    """
+    next_items = []
+    for document, tree in items:
+        for property_name, sub_tree in tree.items():
+            property = _get_reference_property(document, property_name)
+            reference_document = data_table.get(property.reference_class, {}).get(document._document.get(property.name))
             if property.required and reference_document is None:
                 logging.warning("There are a reference class can't mapping")
                 continue
-            setattr(document, property.name, reference_document)
+            # not setattr: resolving doesn't change the stored id, so the property isn't dirty
+            document._reference_document[property.name] = reference_document
+            if reference_document is not None and sub_tree:
+                next_items.append((reference_document, sub_tree))
+    return next_items
@@ -1,12 +1,12 @@
-import sys, inspect
+import os, sys, inspect, json, time
 from django.db.models import signals
 from django.conf import settings
 from restkit import BasicAuth
 from couchdbkit import Server as CouchDBServer
 from couchdbkit.exceptions import ResourceNotFound
 from couchdbkit.resource import CouchdbResource
-from elasticsearch.exceptions import NotFoundError
-import utils
+from . import utils
+from . import bulk
 
 
 class Handler(object):
@@ -51,61 +51,216 @@ class Handler(object):
         db.save_doc(doc)
 
 
-    def re_index(self, document_class=None):
-        from document import Document
+    def sync_mapping(self, document_class=None):
+        """
+        Create indices with mappings of Document classes or put new properties into their mappings.
+        :param document_class: {Document} The default is all Document classes in INSTALLED_APPS.
+        """
         if document_class is None:
-            # re-index all indices
-            for app in settings.INSTALLED_APPS:
-                if "django" not in app:
-                    try:
-                        members = inspect.getmembers(sys.modules['%s.models' % app])
-                    except:
-                        continue
-                    for name, cls in members:
-                        is_document = False
-                        try:
-                            if issubclass(cls, Document) and name != 'Document':
-                                is_document = True
-                        except:
-                            pass
-                        if is_document:
-                            self.re_index(cls)
+            for document_class in self.__get_document_classes():
+                self.sync_mapping(document_class)
             return
 
+        result = document_class.sync_mapping()
+        if result['created']:
+            print('create `%s` in ElasticSearch' % document_class.get_index_name())
+        for name in result['added'] + result['updated']:
+            print('sync mapping `%s.%s`' % (document_class.__name__, name))
+        for name in result['conflicts']:
+            print('mapping `%s.%s` is changed, it requires re-index' % (document_class.__name__, name))
+
+    def ensure_indices(self):
+        """
+        Warm up: create indices of all Document classes in INSTALLED_APPS when the process starts.
+        """
+        from .document import ensure_indices
+
+        ensure_indices(self.__get_document_classes())
+
+    def re_index(self, document_class=None, page_size=1000, workers=4, checkpoint=None):
+        """
+        Re-index documents of CouchDB into ElasticSearch without downtime.
+        1. Create the next version of the index. (document_class.create_next_index())
+        2. Back-fill it from the view page by page with parallel _bulk requests.
+        3. Catch up on changes of CouchDB which were made while back-filling.
+        4. Swap the alias get_index_name() to the new index and delete the old index.
+        5. Catch up on changes which were made while swapping.
+        :param document_class: {Document} The default is all Document classes in INSTALLED_APPS.
+        :param page_size: {int} The number of documents of each page.
+        :param workers: {int} The number of parallel _bulk requests.
+        :param checkpoint: {string} The path of the checkpoint file.
+            If the checkpoint exists, re-index is resumed from it.
+            It is removed after re-index is finished.
+        :return: {dict} {'indexed': {int}, 'failed': [{string}]document id, 'seconds': {float}}
+        """
+        if document_class is None:
+            # re-index all indices
+            result = {'indexed': 0, 'failed': [], 'seconds': 0.0}
+            for document_class in self.__get_document_classes():
+                class_checkpoint = '%s.%s' % (checkpoint, document_class.__name__) if checkpoint else None
+                class_result = self.re_index(document_class, page_size, workers, class_checkpoint)
+                result['indexed'] += class_result['indexed']
+                result['failed'] += class_result['failed']
+                result['seconds'] += class_result['seconds']
+            return result
+
         es = utils.get_elasticsearch()
         db = document_class.get_db()
-        print('re-index `%s` in ElasticSearch' % db.dbname)
-        documents = db.view(
-            '%s/id' % db.dbname,
-            schema=document_class,
-            wrapper=None,
-            wrap_doc=True,
-        ).all()
-        try:
-            es.indices.delete(db.dbname)
-        except NotFoundError:
-            pass
-        es.indices.create(db.dbname)
-        if db.dbname == 'ispo_specials':
-            es.indices.put_mapping(
-                index=db.dbname,
+        state = self.__load_checkpoint(checkpoint)
+        if state is None:
+            state = {
+                'since': db.info()['update_seq'],  # changes after it are caught up after back-filling
+                'index': document_class.create_next_index(),
+                'last_id': None,
+                'indexed': 0,
+                'failed': [],
+            }
+            self.__save_checkpoint(checkpoint, state)
+            print('re-index `%s` into `%s`' % (db.dbname, state['index']))
+        else:
+            print('resume re-index `%s` into `%s` after `%s`' % (db.dbname, state['index'], state['last_id']))
+
+        start_time = time.time()
+        indexed = 0
+        # back-fill
+        pages = self.__iter_re_index_pages(db, document_class, state['index'], state['last_id'], page_size)
+        for count, failures, last_id in bulk.parallel_execute(es, pages, workers=workers):
+            indexed += count - len(failures)
+            state['indexed'] += count - len(failures)
+            state['failed'] += [x.id for x in failures]
+            state['last_id'] = last_id
+            self.__save_checkpoint(checkpoint, state)
+            seconds = time.time() - start_time
+            print('`%s`: %d indexed, %d failed, %.1f docs/s' % (
+                state['index'], state['indexed'], len(state['failed']), indexed / seconds if seconds else 0.0,
+            ))
+
+        # catch up until there are no changes, then swap the alias
+        for _ in range(5):
+            if not self.__catch_up(es, db, document_class, state, checkpoint, page_size):
+                break
+        document_class.swap_index(state['index'])
+        print('`%s` is the alias of `%s`' % (document_class.get_index_name(), state['index']))
+        self.__catch_up(es, db, document_class, state, checkpoint, page_size)
+
+        if state['failed']:
+            print('`%s`: failed ids %s' % (state['index'], ', '.join(state['failed'])))
+        if checkpoint and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        return {'indexed': state['indexed'], 'failed': state['failed'], 'seconds': time.time() - start_time}
+
+    def __iter_re_index_pages(self, db, document_class, index, last_id, page_size):
+        """
+        Read documents of the view page by page.
+        :param db: {couchdbkit.Database}
+        :param document_class: {Document}
+        :param index: {string} The index name.
+        :param last_id: {string} Start after this id. None is from the beginning.
+        :param page_size: {int}
+        :return: {generator} [({list}[{BulkAction}], {string}the last id of the page)]
+        """
+        while True:
+            params = {'limit': page_size}
+            if last_id is not None:
+                params['startkey'] = last_id
+                params['skip'] = 1
+            rows = list(db.view('%s/id' % db.dbname, wrapper=None, **params))
+            if not rows:
+                return
+            last_id = rows[-1]['key']
+            yield [bulk.BulkAction(
+                'index',
+                index=index,
                 doc_type=document_class.__name__,
-                body={
-                    'properties': {
-                        'groups': {'type': 'string', 'index': 'not_analyzed'}
-                    }
-                }
-            )
-        for doc in documents:
-            try:
-                es.index(
-                    index=db.dbname,
-                    doc_type=document_class.__name__,
-                    id=doc._id,
-                    body=doc._doc
-                )
-            except:
-                pass
+                id=row['id'],
+                body=row['value'],
+            ) for row in rows], last_id
+            if len(rows) < page_size:
+                return
+
+    def __catch_up(self, es, db, document_class, state, checkpoint, page_size):
+        """
+        Apply changes of CouchDB after state['since'] to the new index.
+        :param es: {Elasticsearch}
+        :param db: {couchdbkit.Database}
+        :param document_class: {Document}
+        :param state: {dict} The state of re-index. state['since'] is updated.
+        :param checkpoint: {string} The path of the checkpoint file.
+        :param page_size: {int}
+        :return: {int} The number of changes.
+        """
+        result = 0
+        while True:
+            response = db.res.get('_changes', since=state['since'], include_docs='true', limit=page_size).json_body
+            actions = []
+            for change in response['results']:
+                if change['id'].startswith('_design/'):
+                    continue
+                if change.get('deleted'):
+                    actions.append(bulk.BulkAction(
+                        'delete', index=state['index'], doc_type=document_class.__name__, id=change['id']))
+                else:
+                    actions.append(bulk.BulkAction(
+                        'index', index=state['index'], doc_type=document_class.__name__, id=change['id'],
+                        body=change['doc']))
+            failures = [x for x in bulk.execute(es, actions) if x.operation != 'delete']  # deleted before indexed
+            state['failed'] += [x.id for x in failures]
+            state['since'] = response['last_seq']
+            self.__save_checkpoint(checkpoint, state)
+            result += len(actions)
+            if len(response['results']) < page_size:
+                break
+        if result:
+            print('`%s`: caught up %d changes' % (state['index'], result))
+        return result
+
+    def __load_checkpoint(self, checkpoint):
+        """
+        Load the state of re-index.
+        :param checkpoint: {string} The path of the checkpoint file.
+        :return: {dict or None} {'last_id': {string}, 'indexed': {int}, 'failed': [{string}]}
+        """
+        if not checkpoint or not os.path.exists(checkpoint):
+            return None
+        with open(checkpoint) as f:
+            return json.load(f)
+
+    def __save_checkpoint(self, checkpoint, state):
+        """
+        Save the state of re-index. The file is replaced atomically.
+        :param checkpoint: {string} The path of the checkpoint file.
+        :param state: {dict}
+        """
+        if not checkpoint:
+            return
+        with open(checkpoint + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(checkpoint + '.tmp', checkpoint)
+
+    def __get_document_classes(self):
+        """
+        Get Document classes in models of INSTALLED_APPS.
+        :return: {list} [{Document}]
+        """
+        from .document import Document
+
+        result = []
+        for app in settings.INSTALLED_APPS:
+            if "django" not in app:
+                try:
+                    members = inspect.getmembers(sys.modules['%s.models' % app])
+                except:
+                    continue
+                for name, cls in members:
+                    is_document = False
+                    try:
+                        if issubclass(cls, Document) and name != 'Document':
+                            is_document = True
+                    except:
+                        pass
+                    if is_document:
+                        result.append(cls)
+        return result
 
     def __get_db_url(self, app_name):
         for database in self.databases:
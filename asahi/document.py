@@ -1,35 +1,114 @@
+import asyncio
+import threading
+from collections import OrderedDict
 from datetime import datetime
+from types import MappingProxyType
+from elasticsearch import helpers
 from . import utils
+from . import bulk
 from .query import Query
-from .properties import Property, StringProperty, IntegerProperty, DateTimeProperty, ListProxy
-from .exceptions import NotFoundError
-from .deep_query import update_reference_properties
+from .properties import Property, StringProperty, IntegerProperty, DateTimeProperty, ListProperty, DictProperty, \
+    ListProxy, SUBSTRING_ANALYSIS
+from .exceptions import NotFoundError, TransportError, BulkError, PropertyNotExist
+from .deep_query import update_reference_properties, aupdate_reference_properties
+from .refresh import touch_indices, in_refresh_scope
+from .session import get_current_session
 
 
-class Document(object):
+_ensured_indices = set()  # {(index name, document type)} indices which exist in this process
+_ensured_indices_lock = threading.Lock()  # guards _ensure_index_locks
+_ensure_index_locks = {}  # {(index name, document type): threading.Lock} one lock per index to ensure
+_ensuring_indices = {}  # {(event loop, (index name, document type)): asyncio.Task} in-flight async ensures
+# settings of the index while it is loaded by re-index, they are restored before the alias is swapped
+BULK_INDEX_SETTINGS = {'refresh_interval': '-1', 'number_of_replicas': 0}
+# times to replace the index which is auto-created by writes while the index without the alias is swapped
+SWAP_INDEX_RETRIES = 3
+
+
+def ensure_indices(document_classes):
+    """
+    Warm up: create indices of Document classes when the process starts,
+    so the first request doesn't pay for it.
+    :param document_classes: {list} [{Document}]
+    """
+    for document_class in document_classes:
+        document_class.ensure_index()
+
+def reset_ensured_indices():
+    """
+    Forget indices which are ensured. Call it after indices are deleted by others.
+    """
+    _ensured_indices.clear()
+
+
+class DocumentMeta(type):
+    """
+    Collect properties of the Document class once when the class is created.
+    """
+    @classmethod
+    def __prepare__(mcs, name, bases, **kwargs):
+        return OrderedDict()
+
+    def __new__(mcs, name, bases, attributes):
+        cls = super(DocumentMeta, mcs).__new__(mcs, name, bases, dict(attributes))
+        cls._declared_attributes = tuple(attributes.keys())  # keep the order of the class body
+        return cls
+
+    def __init__(cls, name, bases, attributes):
+        super(DocumentMeta, cls).__init__(name, bases, dict(attributes))
+        properties = OrderedDict()
+        for klass in reversed(cls.__mro__):
+            attribute_names = klass.__dict__.get('_declared_attributes', klass.__dict__.keys())
+            for attribute_name in attribute_names:
+                if attribute_name.startswith('__'):
+                    continue
+                attribute = klass.__dict__[attribute_name]
+                if isinstance(attribute, Property) or isinstance(attribute, ListProxy):
+                    properties[attribute_name] = attribute
+                elif attribute_name in properties:
+                    del properties[attribute_name]  # the property is overridden
+        for attribute_name, attribute in properties.items():
+            attribute.__property_config__(cls, attribute_name)
+        cls._properties = MappingProxyType(properties)
+
+
+class Document(object, metaclass=DocumentMeta):
     """
     :attribute _index: {string} You can set index of this Document.
     :attribute _id: {string}
     :attribute _version: {int}
     :attribute _document: {dict} {'property_name': (value)}
     :attribute _reference_document: {dict} {'property_name': {Document}}
-    :attribute _properties: {dict} {'property_name': {Property}}
+    :attribute _decoded: {dict} {'property_name': (value)} The cache of values converted to python.
+    :attribute _deferred: {set} {'property_name'} Properties which are not fetched yet.
+    :attribute _dirty: {set or None} {'property_name'} Properties which are changed after the document was fetched or saved.
+        None if the document is not fetched or saved yet, the whole document should be written.
+    :attribute _snapshots: {dict or None} {'property_name': {string}} Serialized values of ListProperty and DictProperty
+        when they were read after the document was fetched or saved. They are compared to find changes in place.
+        None until the first snapshot, most fetched documents don't need it.
+    :attribute _properties: {mappingproxy} {'property_name': {Property}} It is read-only and ordered by declarations.
     :attribute _es: {Elasticsearch}
+    :attribute _async_es: {AsyncElasticsearch} The client for the asyncio api.
+    :attribute _cache: {DocumentCache} Set the cache to enable the read-through cache of get().
     :attribute _index_name: {string}
+    :attribute _leading_wildcard: {string} 'allow', 'warn' or 'refuse' the leading wildcard regexp of like and unlike.
+        The default is settings.ASAHI_LEADING_WILDCARD. Set 'refuse' for large indices.
     """
     _id = StringProperty()
     _version = IntegerProperty()
-    _es = utils.get_elasticsearch()
-
-    def __new__(cls, *args, **kwargs):
-        cls._properties = cls.__get_properties()
-        cls._properties_in = cls  # memo cls._properties from which class
-        return object.__new__(cls, *args)
+    _es = utils.ElasticsearchDescriptor()
+    _async_es = utils.AsyncElasticsearchDescriptor()
+    _cache = None
+    _leading_wildcard = None
 
     def __init__(self, **kwargs):
         super(Document, self).__init__()
         self._document = {}
         self._reference_document = {}
+        self._decoded = {}
+        self._deferred = set()
+        self._dirty = None
+        self._snapshots = None
         for property_name, property in self._properties.items():
             if property_name in kwargs.keys():
                 setattr(self, property_name, kwargs[property_name])
@@ -37,33 +116,91 @@ class Document(object):
                 setattr(self, property_name, property.default)
 
     @classmethod
-    def __get_properties(cls):
+    def _from_hit(cls, hit, deferred=None):
         """
-        Get properties of this class.
-        :return: {dict} {'property_name': {Property}}
+        Build the document from the hit of ElasticSearch.
+        Values of _source are kept as raw json, properties decode them on the first access.
+        :param hit: {dict} {'_id': {string}, '_version': {int}, '_source': {dict}}
+        :param deferred: {set} The names of properties which were not fetched.
+        :return: {Document}
         """
-        properties = {}
-        for attribute_name in dir(cls):
-            if attribute_name.startswith('__'):
-                continue
-            attribute = getattr(cls, attribute_name)
-            if isinstance(attribute, Property) or isinstance(attribute, ListProxy):
-                properties[attribute_name] = attribute
-                attribute.__property_config__(cls, attribute_name)
-        return properties
+        document = cls.__new__(cls)
+        document._document = {}
+        document._reference_document = {}
+        document._decoded = {}
+        document._deferred = set()
+        document._dirty = None
+        document._snapshots = None
+        source = hit.get('_source', {})
+        for property_name, property in document._properties.items():
+            if property.name in source:
+                document._document[property.name] = source[property.name]
+            elif deferred and property_name in deferred:
+                document._deferred.add(property.name)
+            else:
+                setattr(document, property_name, property.default)
+        document._id = hit['_id']
+        document._version = hit['_version']
+        document._dirty = set()
+        return document
 
     @classmethod
     def get_properties(cls):
         """
-        Some time the class didn't call initial function but need get properties list.
-        :return: {dict} {'property_name': {Property}}
+        Get properties of this class. They are collected when the class is created.
+        :return: {mappingproxy} {'property_name': {Property}}
         """
-        if not hasattr(cls, '_properties_in') or not cls is cls._properties_in\
-                or not hasattr(cls, '_properties'):
-            cls._properties = cls.__get_properties()
-            cls._properties_in = cls
         return cls._properties
 
+    @classmethod
+    def _get_source_filter(cls, only=None, defer=None):
+        """
+        Get the _source filtering for get() and fetch().
+        :param only: {list} Only fetch these properties.
+        :param defer: {list} Don't fetch these properties.
+        :returns: {tuple} ({dict}, {set})
+            The params of ElasticSearch. {'_source_include': [], '_source_exclude': []}
+            The names of deferred properties.
+        """
+        properties = cls.get_properties()
+        for property_name in list(only or []) + list(defer or []):
+            if property_name not in properties:
+                raise PropertyNotExist('%s not in %s' % (property_name, cls.__name__))
+        if only is not None:
+            deferred = set(properties.keys()) - set(only)
+        else:
+            deferred = set([x for x, y in properties.items() if y.deferred])
+        deferred |= set(defer or [])
+        deferred -= {'_id', '_version'}
+        if not deferred:
+            return {}, deferred
+        if only is not None:
+            return {
+                '_source_include': [y.name for x, y in properties.items()
+                                     if x not in deferred and x not in ('_id', '_version')],
+            }, deferred
+        return {
+            '_source_exclude': [y.name for x, y in properties.items() if x in deferred],
+        }, deferred
+
+    def _load_deferred(self, names):
+        """
+        Load deferred properties from ElasticSearch.
+        :param names: {list} The names of properties.
+        """
+        response = self._es.get(
+            index=self.get_index_name(),
+            doc_type=self.__class__.__name__,
+            id=self._id,
+            _source_include=names,
+        )
+        for name in names:
+            self._document[name] = response['_source'].get(name)
+            self._decoded.pop(name, None)
+            if self._snapshots:
+                self._snapshots.pop(name, None)
+            self._deferred.discard(name)
+
     @classmethod
     def get_index_name(cls):
         if not hasattr(cls, '_index_name') or not cls._index_name:
@@ -74,70 +211,560 @@ class Document(object):
         return cls._index_name
 
     @classmethod
-    def get(cls, ids, fetch_reference=True):
+    def get_mapping(cls):
+        """
+        Get the mapping of this Document which is generated by properties.
+        :return: {dict} {'properties': {'property_name': {dict}}}
+        """
+        properties = OrderedDict()
+        for property_name, property in cls.get_properties().items():
+            if property_name in ('_id', '_version'):
+                continue  # they are metadata of ElasticSearch
+            mapping = property.get_mapping()
+            if mapping is not None:
+                properties[property.name] = mapping
+        return {'properties': properties}
+
+    @classmethod
+    def get_index_settings(cls):
+        """
+        Get settings of the index which are required by properties.
+        :return: {dict}
+        """
+        for property in cls.get_properties().values():
+            if isinstance(property, StringProperty) and property.searchable == 'substring':
+                return {'analysis': SUBSTRING_ANALYSIS}
+        return {}
+
+    @classmethod
+    def get_index_body(cls, alias=False):
+        """
+        Get the body to create the index of this Document.
+        :param alias: {bool} get_index_name() is the alias of the created index.
+        :return: {dict} {'settings': {dict}, 'mappings': {dict}, 'aliases': {dict}}
+        """
+        body = {
+            'mappings': {
+                cls.__name__: cls.get_mapping(),
+            }
+        }
+        index_settings = cls.get_index_settings()
+        if index_settings:
+            body['settings'] = index_settings
+        if alias:
+            body['aliases'] = {cls.get_index_name(): {}}
+        return body
+
+    @classmethod
+    def get_versioned_index_name(cls, version):
+        """
+        Get the name of the concrete index of the version.
+        get_index_name() is the alias of the live version, so it could be re-indexed without downtime.
+        :param version: {int}
+        :return: {string} '{index name}_v{version}'
+        """
+        return '%s_v%d' % (cls.get_index_name(), version)
+
+    @classmethod
+    def get_index_versions(cls):
+        """
+        Get concrete indices behind get_index_name().
+        :return: {list} [{string}] Index names. It is [get_index_name()] if the index was created without the alias.
+        """
+        es = cls._es
+        index_name = cls.get_index_name()
+        try:
+            response = es.indices.get_alias(name=index_name)
+        except NotFoundError:
+            response = {}
+        result = sorted([x for x, y in response.items() if index_name in y.get('aliases', {})])
+        if not result and es.indices.exists(index=index_name):
+            return [index_name]
+        return result
+
+    @classmethod
+    def create_next_index(cls, index_settings=None):
+        """
+        Create the next version of the index for re-index. The alias is not changed.
+        :param index_settings: {dict} Settings for loading documents. The default is BULK_INDEX_SETTINGS.
+        :return: {string} The name of the created index.
+        """
+        versions = [0]
+        prefix = '%s_v' % cls.get_index_name()
+        for index in cls.get_index_versions():
+            if index.startswith(prefix) and index[len(prefix):].isdigit():
+                versions.append(int(index[len(prefix):]))
+        index = cls.get_versioned_index_name(max(versions) + 1)
+        body = cls.get_index_body()
+        body.setdefault('settings', {}).update(index_settings or BULK_INDEX_SETTINGS)
+        cls._es.indices.create(index=index, body=body)
+        return index
+
+    @classmethod
+    def swap_index(cls, index):
+        """
+        Switch get_index_name() to the index atomically, then delete old versions.
+        Settings of the old version (refresh_interval, number_of_replicas) are applied to the index before swapping.
+        If the old index was created without the alias (indices before the versioned index),
+        this is the one-time migration: the old index is deleted before the alias is added.
+        See __replace_index_with_alias() for writes in that moment.
+        :param index: {string} The index which is created by create_next_index().
+        """
+        es = cls._es
+        index_name = cls.get_index_name()
+        old_indices = [x for x in cls.get_index_versions() if x != index]
+        es.indices.put_settings(index=index, body={'index': cls.__get_live_index_settings(old_indices)})
+        es.indices.refresh(index=index)
+        if index_name in old_indices:
+            old_indices.remove(index_name)
+            cls.__replace_index_with_alias(index)
+        else:
+            actions = [{'remove': {'index': x, 'alias': index_name}} for x in old_indices]
+            actions.append({'add': {'index': index, 'alias': index_name}})
+            es.indices.update_aliases(body={'actions': actions})
+        for old_index in old_indices:
+            es.indices.delete(index=old_index)
+        if cls._cache is not None:
+            cls._cache.clear()
+
+    @classmethod
+    def __replace_index_with_alias(cls, index):
+        """
+        Replace the concrete index get_index_name() with the alias of the index.
+        A write between deleting the index and adding the alias auto-creates the concrete index again,
+        then the alias can't be added. Documents of the auto-created index are copied into the index,
+        and it is deleted again up to SWAP_INDEX_RETRIES times.
+        :param index: {string} The index which the alias points to.
+        :raises TransportError: The alias still can't be added.
+        """
+        es = cls._es
+        index_name = cls.get_index_name()
+        for attempt in range(SWAP_INDEX_RETRIES + 1):
+            if attempt:
+                helpers.reindex(es, index_name, index)
+            try:
+                es.indices.delete(index=index_name)
+            except NotFoundError:
+                pass
+            try:
+                es.indices.update_aliases(body={'actions': [{'add': {'index': index, 'alias': index_name}}]})
+                return
+            except TransportError as e:
+                if attempt == SWAP_INDEX_RETRIES or not es.indices.exists(index=index_name):
+                    raise e
+
+    @classmethod
+    def __get_live_index_settings(cls, old_indices):
+        """
+        Get settings which are changed by BULK_INDEX_SETTINGS from the live index.
+        :param old_indices: {list} [{string}]
+        :return: {dict} {'refresh_interval': {string}, 'number_of_replicas': {int or string}}
+        """
+        result = {'refresh_interval': '1s', 'number_of_replicas': 1}
+        if old_indices:
+            response = cls._es.indices.get_settings(index=old_indices[-1])
+            for index_settings in response.values():
+                live_settings = index_settings.get('settings', {}).get('index', {})
+                for name in result:
+                    if name in live_settings:
+                        result[name] = live_settings[name]
+        return result
+
+    @classmethod
+    def ensure_index(cls):
+        """
+        Create the index of this Document if it doesn't exist.
+        The index is created as the version 1, get_index_name() is the alias of it.
+        It is checked once per process, concurrent threads wait for the first check of the same index
+        instead of creating it again. Other indices are not blocked by it.
+        """
+        key = (cls.get_index_name(), cls.__name__)
+        if key in _ensured_indices:
+            return
+        with _ensured_indices_lock:
+            lock = _ensure_index_locks.setdefault(key, threading.Lock())
+        with lock:
+            if key in _ensured_indices:
+                return
+            es = cls._es
+            if not es.indices.exists(index=key[0]):
+                try:
+                    es.indices.create(index=cls.get_versioned_index_name(1), body=cls.get_index_body(alias=True))
+                except TransportError as e:
+                    if not cls.__is_index_already_exists(e):
+                        raise e
+            _ensured_indices.add(key)
+
+    @classmethod
+    async def aensure_index(cls):
+        """
+        Create the index of this Document if it doesn't exist with asyncio.
+        Concurrent coroutines of the same index await the first check instead of creating it again.
+        """
+        key = (cls.get_index_name(), cls.__name__)
+        if key in _ensured_indices:
+            return
+        task_key = (asyncio.get_event_loop(), key)
+        task = _ensuring_indices.get(task_key)
+        if task is None:
+            task = asyncio.ensure_future(cls.__acreate_index(key))
+            _ensuring_indices[task_key] = task
+            task.add_done_callback(lambda x: _ensuring_indices.pop(task_key, None))
+        # shield the shared task, a cancelled waiter should not cancel the others
+        await asyncio.shield(task)
+
+    @classmethod
+    async def __acreate_index(cls, key):
+        """
+        Create the index if it doesn't exist with asyncio.
+        :param key: {tuple} (index name, document type)
+        """
+        es = cls._async_es
+        if not await es.indices.exists(index=key[0]):
+            try:
+                await es.indices.create(index=cls.get_versioned_index_name(1), body=cls.get_index_body(alias=True))
+            except TransportError as e:
+                if not cls.__is_index_already_exists(e):
+                    raise e
+        _ensured_indices.add(key)
+
+    @staticmethod
+    def __is_index_already_exists(error):
+        """
+        Is the error raised because the index was created by another process?
+        :param error: {TransportError}
+        :return: {bool}
+        """
+        return error.status_code == 400 and 'IndexAlreadyExists' in str(error.error)
+
+    @classmethod
+    def sync_mapping(cls):
+        """
+        Create the index with the mapping, or put new properties into the mapping of the existing index.
+        Changing the type or the analysis of the existing field requires re-index, so it is reported as the conflict.
+        :returns: {dict}
+            {
+                'created': {bool} The index is created.
+                'added': {list} Names of properties which are added into the mapping.
+                'updated': {list} Names of properties which get new sub fields or fielddata settings.
+                'conflicts': {list} Names of properties which are mapped differently.
+            }
+        """
+        es = cls._es
+        index_name = cls.get_index_name()
+        mapping = cls.get_mapping()
+        result = {
+            'created': False,
+            'added': [],
+            'updated': [],
+            'conflicts': [],
+        }
+        if not es.indices.exists(index=index_name):
+            es.indices.create(index=cls.get_versioned_index_name(1), body=cls.get_index_body(alias=True))
+            result['created'] = True
+            result['added'] = list(mapping['properties'].keys())
+            return result
+
+        current_properties = {}
+        response = es.indices.get_mapping(index=index_name, doc_type=cls.__name__)
+        for index_mapping in response.values():
+            current_properties.update(index_mapping.get('mappings', {}).get(cls.__name__, {}).get('properties', {}))
+        changes = OrderedDict()
+        for name, field_mapping in mapping['properties'].items():
+            if name not in current_properties:
+                result['added'].append(name)
+                changes[name] = field_mapping
+                continue
+            difference = cls.__diff_field_mapping(field_mapping, current_properties[name])
+            if difference == 'conflict':
+                result['conflicts'].append(name)
+            elif difference == 'updated':
+                result['updated'].append(name)
+                changes[name] = field_mapping
+        if changes:
+            es.indices.put_mapping(index=index_name, doc_type=cls.__name__, body={'properties': changes})
+        return result
+
+    @classmethod
+    def __diff_field_mapping(cls, expected, current):
+        """
+        Compare the generated mapping of the field with the mapping of the index.
+        :param expected: {dict} The generated mapping.
+        :param current: {dict} The mapping in the index.
+        :return: {string or None} 'conflict', 'updated' or None
+        """
+        if expected.get('type') != current.get('type', 'object'):  # the object mapping doesn't have the type
+            return 'conflict'
+        if expected.get('enabled', True) != current.get('enabled', True):
+            return 'conflict'
+        for key in ('index', 'analyzer', 'search_analyzer', 'format', 'doc_values'):
+            if expected.get(key) != current.get(key):
+                return 'conflict'
+        result = None
+        current_fields = current.get('fields', {})
+        for name, field_mapping in expected.get('fields', {}).items():
+            if name not in current_fields:
+                result = 'updated'
+            elif cls.__diff_field_mapping(field_mapping, current_fields[name]) is not None:
+                return 'conflict'
+        if expected.get('fielddata') != current.get('fielddata'):
+            result = 'updated'
+        return result
+
+    @classmethod
+    def get(cls, ids, fetch_reference=True, only=None, defer=None, include=None):
         """
         Get documents by ids.
         :param ids: {list or string} The documents' id.
+        :param only: {list} Only fetch these properties. The others are deferred.
+        :param defer: {list} Don't fetch these properties. Properties with deferred=True are deferred by default.
+        :param include: {list} Only resolve these reference paths. ['author', 'author.company']
         :return: {list or Document}
         """
         if ids is None:
             return None
-        es = utils.get_elasticsearch()
+        queued = cls.__get_queued_documents(ids)
+        if queued:
+            if not isinstance(ids, list):
+                return queued[ids]
+            fetched = cls.get([x for x in ids if x not in queued], fetch_reference, only, defer, include)
+            return cls.__merge_queued_documents(ids, fetched, queued)
+        es = cls._es
+        source_params, deferred = cls._get_source_filter(only, defer)
         if isinstance(ids, list):
             # fetch documents
             if not len(ids):
                 return []
 
-            def __get():
-                return es.mget(
+            result_table, missing_ids = cls.__get_cached_hits(ids)
+            if missing_ids:
+                cls.ensure_index()
+                response = es.mget(
                     index=cls.get_index_name(),
                     doc_type=cls.__name__,
                     body={
-                        'ids': list([x for x in set(ids) if not x is None])
+                        'ids': missing_ids
                     },
+                    **source_params
                 )
+                cls.__update_hits(result_table, response, cacheable=not deferred)
+            result = cls.__build_documents(ids, result_table, deferred)
+            if fetch_reference or include is not None:
+                update_reference_properties(result, include)
+            return result
 
+        # fetch the document
+        result_table, _ = cls.__get_cached_hits([ids])
+        hit = result_table.get(ids)
+        if hit is None:
+            cls.ensure_index()
             try:
-                response = __get()
-            except NotFoundError as e:
-                if 'IndexMissingException' in str(e):  # try to create index
-                    es.indices.create(index=cls.get_index_name())
-                    response = __get()
-                else:
-                    raise e
-            result_table = {x['_id']: x for x in response['docs'] if x['found']}
-            result = []
-            for document_id in ids:
-                document = result_table.get(document_id)
-                if document:
-                    result.append(cls(_id=document['_id'], _version=document['_version'], **document['_source']))
-            if fetch_reference:
-                update_reference_properties(result)
+                response = es.get(
+                    index=cls.get_index_name(),
+                    doc_type=cls.__name__,
+                    id=ids,
+                    **source_params
+                )
+            except NotFoundError:
+                return None
+            if not deferred:
+                cls.__cache_hit(response)
+            hit = response
+        result = cls._from_hit(hit, deferred)
+        if fetch_reference or include is not None:
+            update_reference_properties([result], include)
+        return result
+
+    @classmethod
+    async def aget(cls, ids, fetch_reference=True, only=None, defer=None, include=None):
+        """
+        Get documents by ids with asyncio.
+        :param ids: {list or string} The documents' id.
+        :param only: {list} Only fetch these properties. The others are deferred.
+        :param defer: {list} Don't fetch these properties. Properties with deferred=True are deferred by default.
+        :param include: {list} Only resolve these reference paths. ['author', 'author.company']
+        :return: {list or Document}
+        """
+        if ids is None:
+            return None
+        queued = cls.__get_queued_documents(ids)
+        if queued:
+            if not isinstance(ids, list):
+                return queued[ids]
+            fetched = await cls.aget([x for x in ids if x not in queued], fetch_reference, only, defer, include)
+            return cls.__merge_queued_documents(ids, fetched, queued)
+        es = cls._async_es
+        source_params, deferred = cls._get_source_filter(only, defer)
+        if isinstance(ids, list):
+            # fetch documents
+            if not len(ids):
+                return []
+
+            result_table, missing_ids = cls.__get_cached_hits(ids)
+            if missing_ids:
+                await cls.aensure_index()
+                response = await es.mget(
+                    index=cls.get_index_name(),
+                    doc_type=cls.__name__,
+                    body={
+                        'ids': missing_ids
+                    },
+                    **source_params
+                )
+                cls.__update_hits(result_table, response, cacheable=not deferred)
+            result = cls.__build_documents(ids, result_table, deferred)
+            if fetch_reference or include is not None:
+                await aupdate_reference_properties(result, include)
             return result
 
         # fetch the document
-        try:
-            def __get():
-                return es.get(
+        result_table, _ = cls.__get_cached_hits([ids])
+        hit = result_table.get(ids)
+        if hit is None:
+            await cls.aensure_index()
+            try:
+                response = await es.get(
                     index=cls.get_index_name(),
                     doc_type=cls.__name__,
                     id=ids,
+                    **source_params
                 )
+            except NotFoundError:
+                return None
+            if not deferred:
+                cls.__cache_hit(response)
+            hit = response
+        result = cls._from_hit(hit, deferred)
+        if fetch_reference or include is not None:
+            await aupdate_reference_properties([result], include)
+        return result
 
-            try:
-                response = __get()
-            except NotFoundError as e:
-                if 'IndexMissingException' in str(e):  # try to create index
-                    es.indices.create(index=cls.get_index_name())
-                    response = __get()
-                else:
-                    raise e
-            result = cls(_id=response['_id'], _version=response['_version'], **response['_source'])
-            if fetch_reference:
-                update_reference_properties([result])
-            return result
-        except NotFoundError:
-            return None
+    @classmethod
+    def __get_queued_documents(cls, ids):
+        """
+        Get documents which are queued in the current asahi.Session.
+        :param ids: {list or string} The documents' id.
+        :return: {dict} {document_id: {Document}} The document is None if it is queued to delete.
+        """
+        session = get_current_session()
+        if session is None:
+            return {}
+        return session.get_documents(cls, ids if isinstance(ids, list) else [ids])
+
+    @classmethod
+    def __merge_queued_documents(cls, ids, fetched, queued):
+        """
+        Merge fetched documents and queued documents by the order of ids.
+        :param ids: {list} The documents' id.
+        :param fetched: {list} [{Document}]
+        :param queued: {dict} {document_id: {Document}}
+        :return: {list} [{Document}]
+        """
+        result_table = {x._id: x for x in fetched}
+        result_table.update(queued)
+        return [result_table[x] for x in ids if result_table.get(x) is not None]
+
+    @classmethod
+    def _get_mget_docs(cls, ids):
+        """
+        Get cached hits and docs of the multi-index mget request for ids which are not cached.
+        It is used to fetch documents of many classes with one request.
+        :param ids: {list} The documents' id.
+        :returns: {tuple} ({dict}, {list})
+            {document_id: {hit}} The cached hits.
+            [{'_index': {string}, '_type': {string}, '_id': {string}}] The docs of the mget request.
+        """
+        result_table, missing_ids = cls.__get_cached_hits(ids)
+        index = cls.get_index_name()
+        return result_table, [{'_index': index, '_type': cls.__name__, '_id': x} for x in missing_ids]
+
+    @classmethod
+    def _update_mget_hits(cls, result_table, hits):
+        """
+        Put found hits of the multi-index mget request into the result table and the cache.
+        :param result_table: {dict} {document_id: {hit}}
+        :param hits: {list} Hits of this class in the mget response.
+        """
+        cls.__update_hits(result_table, {'docs': hits})
+
+    @classmethod
+    def __get_cached_hits(cls, ids):
+        """
+        Get hits of documents from the cache.
+        :param ids: {list} The documents' id.
+        :returns: {tuple} ({dict}, {list})
+            {document_id: {hit}} The cached hits.
+            [{string}] The ids which should be fetched from ElasticSearch.
+        """
+        result_table = {}
+        missing_ids = list([x for x in set(ids) if not x is None])
+        if cls._cache is not None:
+            for document_id in missing_ids:
+                hit = cls._cache.get(cls.__cache_key(document_id))
+                if hit is not None:
+                    result_table[document_id] = hit
+            missing_ids = [x for x in missing_ids if x not in result_table]
+        return result_table, missing_ids
+
+    @classmethod
+    def __update_hits(cls, result_table, response, cacheable=True):
+        """
+        Put found hits of the mget response into the result table and the cache.
+        :param result_table: {dict} {document_id: {hit}}
+        :param response: {dict} The response of mget.
+        :param cacheable: {bool} False if hits are partial documents.
+        """
+        for hit in response['docs']:
+            if hit.get('found', True):
+                result_table[hit['_id']] = hit
+                if cacheable:
+                    cls.__cache_hit(hit)
+
+    @classmethod
+    def __build_documents(cls, ids, result_table, deferred=None):
+        """
+        Build documents by the order of ids.
+        :param ids: {list} The documents' id.
+        :param result_table: {dict} {document_id: {hit}}
+        :param deferred: {set} The names of deferred properties.
+        :return: {list} [{Document}]
+        """
+        result = []
+        for document_id in ids:
+            document = result_table.get(document_id)
+            if document:
+                result.append(cls._from_hit(document, deferred))
+        return result
+
+    @classmethod
+    def __cache_key(cls, document_id):
+        """
+        Get the key of the document in the cache.
+        :param document_id: {string}
+        :return: {tuple}
+        """
+        return cls.__name__, document_id
+
+    @classmethod
+    def __cache_hit(cls, hit):
+        """
+        Put the hit of ElasticSearch into the cache.
+        :param hit: {dict} {'_id': {string}, '_version': {int}, '_source': {dict}}
+        """
+        if cls._cache is not None:
+            cls._cache.set(cls.__cache_key(hit['_id']), {
+                '_id': hit['_id'],
+                '_version': hit['_version'],
+                '_source': hit['_source'],
+            })
+
+    def _invalidate_cache(self, version=None):
+        """
+        Remove the document from the cache of the class.
+        :param version: {int} The version of the write. Hits which were read before it are not cached again.
+        """
+        if self._cache is not None and self._id:
+            self._cache.invalidate(self.__cache_key(self._id), version)
 
     @classmethod
     def where(cls, *args, **kwargs):
@@ -179,10 +806,125 @@ class Document(object):
         """
         cls._es.indices.refresh(index=cls.get_index_name())
 
-    def save(self, synchronized=False):
+    @classmethod
+    def save_many(cls, documents, synchronized=False, chunk_size=bulk.DEFAULT_CHUNK_SIZE,
+                  max_chunk_bytes=bulk.DEFAULT_MAX_CHUNK_BYTES, partial=False):
         """
-        Save the document.
+        Save documents with the _bulk api.
+        The _id and _version of each document are updated by the result.
+        Stored documents which are not changed are skipped.
+        :param documents: {list} [{Document}]
+        :param synchronized: {bool} Refresh indices after saving.
+        :param partial: {bool} Only send changed properties of stored documents with the update action.
+        :param chunk_size: {int} The max number of documents in one request.
+        :param max_chunk_bytes: {int} The max bytes of one request.
+        :return: {list} [{Document}]
+        In the asahi.Session block, documents are queued and saved when the block exits.
+        """
+        session = get_current_session()
+        if session is not None:
+            for document in documents:
+                session.add(document, 'save', partial, synchronized)
+            return documents
+        dirty_documents = [x for x in documents if not x._is_clean()]
+        for document_class in set([x.__class__ for x in dirty_documents]):
+            document_class.ensure_index()
+        actions = [x._generate_bulk_action('save', partial) for x in dirty_documents]
+        cls._execute_bulk(actions, synchronized, chunk_size, max_chunk_bytes)
+        return documents
+
+    @classmethod
+    def delete_many(cls, documents, synchronized=False, chunk_size=bulk.DEFAULT_CHUNK_SIZE,
+                    max_chunk_bytes=bulk.DEFAULT_MAX_CHUNK_BYTES):
+        """
+        Delete documents with the _bulk api.
+        :param documents: {list} [{Document}]
+        :param synchronized: {bool} Refresh indices after deleting.
+        :param chunk_size: {int} The max number of documents in one request.
+        :param max_chunk_bytes: {int} The max bytes of one request.
+        :return: {list} [{Document}]
+        In the asahi.Session block, documents are queued and deleted when the block exits.
+        """
+        session = get_current_session()
+        if session is not None:
+            for document in documents:
+                if document._id:
+                    session.add(document, 'delete', synchronized=synchronized)
+            return documents
+        actions = [x._generate_bulk_action('delete') for x in documents if x._id]
+        cls._execute_bulk(actions, synchronized, chunk_size, max_chunk_bytes)
+        return documents
+
+    def _generate_bulk_action(self, operation, partial=False):
+        """
+        Generate the action of the _bulk api for this document.
+        :param operation: {string} 'save' or 'delete'
+        :param partial: {bool} Only send changed properties of the stored document with the update action.
+        :return: {BulkAction}
+        """
+        if operation == 'delete':
+            return bulk.BulkAction(
+                'delete',
+                index=self.get_index_name(),
+                doc_type=self.__class__.__name__,
+                id=self._id,
+                item=self,
+            )
+        operation, params = self._generate_save_request(partial)
+        return bulk.BulkAction(
+            operation,
+            index=params['index'],
+            doc_type=params['doc_type'],
+            id=params['id'],
+            version=params['version'],
+            body=params['body'],
+            item=self,
+        )
+
+    @classmethod
+    def _execute_bulk(cls, actions, synchronized, chunk_size=bulk.DEFAULT_CHUNK_SIZE,
+                      max_chunk_bytes=bulk.DEFAULT_MAX_CHUNK_BYTES):
+        """
+        Execute bulk actions then refresh indices which were touched.
+        The _id and _version of saved documents are updated by the result.
+        :param actions: {list} [{BulkAction}]
+        :param synchronized: {bool} Refresh indices after the request.
+        :raises BulkError: Some actions are failed.
+        :raises TransportError: The request of a chunk is failed.
+            Documents of chunks which were finished before it are still updated, so retrying doesn't duplicate them.
         """
+        if not actions:
+            return
+        try:
+            failures = bulk.execute(cls._es, actions, chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes)
+        finally:
+            for action in actions:
+                version = None
+                if action.error is None and action.result:
+                    version = action.result.get('_version')
+                    if action.operation in ('index', 'update'):
+                        action.item._id = action.result.get('_id')
+                        action.item._version = version
+                        action.item._mark_saved()
+                action.item._invalidate_cache(version)
+            touch_indices({x.index: x.item.__class__ for x in actions})
+        if synchronized and not in_refresh_scope():
+            cls._es.indices.refresh(index=','.join(sorted(set([x.index for x in actions]))))
+        if failures:
+            raise BulkError([{
+                'document': x.item,
+                'status': x.result.get('status') if x.result else None,
+                'error': x.error,
+            } for x in failures])
+
+    def _prepare_save(self):
+        """
+        Prepare the document for saving.
+        Setup the default version and auto_now properties.
+        :return: {dict} The body of the document for ElasticSearch.
+        """
+        if self._deferred:
+            self._load_deferred(list(self._deferred))
         if self._version is None:
             self._version = 0
         for property_name, property in self._properties.items():
@@ -191,31 +933,169 @@ class Document(object):
         document = self._document.copy()
         del document['_id']
         del document['_version']
-        result = self._es.index(
+        return document
+
+    def _prepare_partial_save(self):
+        """
+        Prepare changed properties of the stored document for the _update api.
+        Deferred properties are not loaded.
+        :return: {dict} The partial document for ElasticSearch.
+        """
+        for property_name, property in self._properties.items():
+            if isinstance(property, DateTimeProperty) and property.auto_now and \
+                    property.name not in self._deferred and not getattr(self, property_name):
+                setattr(self, property_name, datetime.utcnow())
+        return {x: self._document.get(x) for x in self._get_changed_names()}
+
+    def _get_changed_names(self):
+        """
+        Get names of properties which are changed after the document was fetched or saved.
+        ListProperty and DictProperty which were read are compared with their snapshots.
+        :return: {set} {'property_name'}
+        """
+        result = self._dirty - {'_id', '_version'}
+        for name, snapshot in (self._snapshots or {}).items():
+            if name not in result and Property._dump_snapshot(self._document.get(name)) != snapshot:
+                result.add(name)
+        return result
+
+    def _mark_saved(self):
+        """
+        The document is written. Forget changes and snapshot values again, they could still be changed in place.
+        """
+        names = set(self._snapshots or ())
+        for property in self._properties.values():
+            # values which are set could be still referred by the caller
+            if isinstance(property, (ListProperty, DictProperty)) and \
+                    (self._dirty is None or property.name in self._dirty):
+                names.add(property.name)
+        self._dirty = set()
+        self._snapshots = {x: Property._dump_snapshot(self._document.get(x))
+                           for x in names if x not in self._deferred} or None
+
+    def _is_clean(self):
+        """
+        Is the document not changed after it was fetched or saved?
+        :return: {bool}
+        """
+        return self._dirty is not None and not self._get_changed_names()
+
+    def _generate_save_request(self, partial=False):
+        """
+        Generate the request which saves the document.
+        :param partial: {bool} Only send changed properties of the stored document with the _update api.
+        :returns: {tuple} ({string}, {dict})
+            The operation. 'index' or 'update'
+            The arguments of the operation. {'index', 'doc_type', 'id', 'version', 'body'}
+        """
+        if partial and self._dirty is not None:
+            operation = 'update'
+            body = {'doc': self._prepare_partial_save()}
+        else:
+            operation = 'index'
+            body = self._prepare_save()
+        return operation, {
+            'index': self.get_index_name(),
+            'doc_type': self.__class__.__name__,
+            'id': self._id,
+            'version': self._version,
+            'body': body,
+        }
+
+    def save(self, synchronized=False, partial=False):
+        """
+        Save the document.
+        The request is skipped when the stored document is not changed.
+        :param synchronized: {bool} Refresh the index after saving.
+            In the asahi.refresh_after() block, the index is refreshed once when the block exits.
+        :param partial: {bool} Only send changed properties with the _update api.
+            The version is checked, so ConflictError is raised if the document was changed by others.
+        In the asahi.Session block, the document is queued and saved when the block exits.
+        """
+        session = get_current_session()
+        if session is not None:
+            session.add(self, 'save', partial, synchronized)
+            return self
+        if not self._is_clean():
+            operation, params = self._generate_save_request(partial)
+            self.ensure_index()
+            result = getattr(self._es, operation)(**params)
+            self._id = result.get('_id')
+            self._version = result.get('_version')
+            self._mark_saved()
+            self._invalidate_cache(self._version)
+            touch_indices({self.get_index_name(): self.__class__})
+        if synchronized and not in_refresh_scope():
+            self._es.indices.refresh(index=self.get_index_name())
+        return self
+
+    def delete(self, synchronized=False):
+        """
+        Delete the document.
+        In the asahi.Session block, the document is queued and deleted when the block exits.
+        """
+        if not self._id:
+            return None
+        session = get_current_session()
+        if session is not None:
+            session.add(self, 'delete', synchronized=synchronized)
+            return self
+
+        result = self._es.delete(
             index=self.get_index_name(),
             doc_type=self.__class__.__name__,
             id=self._id,
-            version=self._version,
-            body=document
         )
-        self._id = result.get('_id')
-        self._version = result.get('_version')
-        if synchronized:
+        self._invalidate_cache(result.get('_version'))
+        touch_indices({self.get_index_name(): self.__class__})
+        if synchronized and not in_refresh_scope():
             self._es.indices.refresh(index=self.get_index_name())
         return self
 
-    def delete(self, synchronized=False):
+    async def asave(self, synchronized=False, partial=False):
         """
-        Delete the document.
+        Save the document with asyncio.
+        The request is skipped when the stored document is not changed.
+        :param synchronized: {bool} Refresh the index after saving.
+        :param partial: {bool} Only send changed properties with the _update api.
+        In the asahi.Session block, the document is queued and saved when the block exits.
+        """
+        session = get_current_session()
+        if session is not None:
+            session.add(self, 'save', partial, synchronized)
+            return self
+        if not self._is_clean():
+            operation, params = self._generate_save_request(partial)
+            await self.aensure_index()
+            result = await getattr(self._async_es, operation)(**params)
+            self._id = result.get('_id')
+            self._version = result.get('_version')
+            self._mark_saved()
+            self._invalidate_cache(self._version)
+            touch_indices({self.get_index_name(): self.__class__})
+        if synchronized and not in_refresh_scope():
+            await self._async_es.indices.refresh(index=self.get_index_name())
+        return self
+
+    async def adelete(self, synchronized=False):
+        """
+        Delete the document with asyncio.
+        In the asahi.Session block, the document is queued and deleted when the block exits.
         """
         if not self._id:
             return None
+        session = get_current_session()
+        if session is not None:
+            session.add(self, 'delete', synchronized=synchronized)
+            return self
 
-        self._es.delete(
+        result = await self._async_es.delete(
             index=self.get_index_name(),
             doc_type=self.__class__.__name__,
             id=self._id,
         )
-        if synchronized:
-            self._es.indices.refresh(index=self.get_index_name())
+        self._invalidate_cache(result.get('_version'))
+        touch_indices({self.get_index_name(): self.__class__})
+        if synchronized and not in_refresh_scope():
+            await self._async_es.indices.refresh(index=self.get_index_name())
         return self
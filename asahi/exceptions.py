@@ -15,6 +15,29 @@ class QuerySyntaxError(Exception):
     exception raised when asahi query syntax error
     """
     pass
+class LeadingWildcardWarning(UserWarning):
+    """
+    warning raised when like or unlike is compiled to the regexp with the leading wildcard
+    """
+    pass
+class BulkError(Exception):
+    """
+    exception raised when some items of the bulk request failed
+    """
+    def __init__(self, errors):
+        """
+        :param errors: {list} [{dict}] {'document': {Document}, 'status': {int}, 'error': {string}}
+        """
+        super(BulkError, self).__init__('%d document(s) failed' % len(errors))
+        self.errors = errors
+
+    @property
+    def conflicts(self):
+        """
+        Items which failed by the version conflict.
+        :return: {list} [{dict}] {'document': {Document}, 'status': 409, 'error': {string}}
+        """
+        return [x for x in self.errors if x['status'] == 409]
 ConflictError = exceptions.ConflictError
 NotFoundError = exceptions.NotFoundError
 ConnectionError = exceptions.ConnectionError
@@ -0,0 +1,1551 @@
+import base64
+import bisect
+import fnmatch
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from elasticsearch.serializer import JSONSerializer
+from elasticsearch.exceptions import NotFoundError, ConflictError, RequestError, TransportError
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:
+    ZoneInfo = None
+
+
+MEMORY_URL_SCHEME = 'memory://'
+DEFAULT_INDEX_SETTINGS = {'number_of_shards': 5, 'number_of_replicas': 1, 'refresh_interval': '1s'}
+LONG_TYPES = ('long', 'integer', 'short', 'byte')
+FLOAT_TYPES = ('double', 'float')
+DEFAULT_PERCENTS = [1.0, 5.0, 25.0, 50.0, 75.0, 95.0, 99.0]
+CALENDAR_INTERVALS = {
+    'year': 'year', '1y': 'year',
+    'quarter': 'quarter', '1q': 'quarter',
+    'month': 'month', '1M': 'month',
+    'week': 'week', '1w': 'week',
+    'day': 'day', '1d': 'day',
+    'hour': 'hour', '1h': 'hour',
+    'minute': 'minute', '1m': 'minute',
+    'second': 'second', '1s': 'second',
+}
+FIXED_INTERVAL_UNITS = {'ms': 1, 's': 1000, 'm': 60000, 'h': 3600000, 'd': 86400000, 'w': 604800000}
+_time_value = re.compile(r'^(-?\d+(?:\.\d+)?)(ms|s|m|h|d|w)?$')
+EPOCH = datetime(1970, 1, 1)
+
+_ideographs = '\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff'
+_standard_tokens = re.compile(r'[%s]|(?:(?![%s])\w)+' % (_ideographs, _ideographs))  # like the standard tokenizer
+_letters_and_digits = re.compile(r'[^\W_]+')
+_serializer = JSONSerializer()
+
+
+def is_memory_url(url):
+    """
+    Is the url of the in-memory engine? settings.ELASTICSEARCH_URL = 'memory://'
+    :param url: {string or list}
+    :return: {bool}
+    """
+    return isinstance(url, str) and url.startswith(MEMORY_URL_SCHEME)
+
+
+# ---------------------------------------------------------
+# Values
+# ---------------------------------------------------------
+def _copy(value):
+    """
+    Copy the json value, so callers could change it without changing stored documents.
+    """
+    if isinstance(value, dict):
+        return {x: _copy(y) for x, y in value.items()}
+    if isinstance(value, list):
+        return [_copy(x) for x in value]
+    return value
+
+def _to_json(body):
+    """
+    Convert the body like it is sent to ElasticSearch. (datetime is converted by the serializer)
+    :param body: {dict or string}
+    :return: {dict}
+    """
+    if isinstance(body, (str, bytes)):
+        return _serializer.loads(body)
+    return _serializer.loads(_serializer.dumps(body))
+
+def _as_list(value):
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return value
+    return [value]
+
+def _as_names(value):
+    """
+    Convert names of the parameter to the list. 'a,b' -> ['a', 'b']
+    :return: {list or None}
+    """
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return [x for x in value.split(',') if x]
+    return list(value)
+
+def _parse_date(value):
+    """
+    Parse the date like the dateOptionalTime format. Dates without the time zone are UTC.
+    :param value: {string, int, float or datetime} int and float are milliseconds of the epoch.
+    :return: {datetime or None} The naive datetime in UTC.
+    """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return EPOCH + timedelta(milliseconds=value)
+    if isinstance(value, str):
+        text = value.strip()
+        if text.endswith('Z'):
+            text = text[:-1] + '+00:00'
+        try:
+            value = datetime.fromisoformat(text)
+        except ValueError:
+            return None
+    if not isinstance(value, datetime):
+        return None
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+def _to_millis(value):
+    """
+    :param value: {datetime} The naive datetime in UTC.
+    :return: {int} Milliseconds of the epoch.
+    """
+    return (value - EPOCH) // timedelta(milliseconds=1)
+
+def _format_date(value):
+    """
+    :param value: {datetime} The naive datetime in UTC.
+    :return: {string} The dateOptionalTime format of ElasticSearch. '2016-10-18T00:00:00.000Z'
+    """
+    return '%s.%03dZ' % (value.strftime('%Y-%m-%dT%H:%M:%S'), value.microsecond // 1000)
+
+def _normalize(value, field_type):
+    """
+    Convert the value to the term of the field type.
+    :param value: The value of the document or the query.
+    :param field_type: {string or None} The type of the mapping. None is the dynamic field.
+    :return: The term. None if the value can't be converted.
+    """
+    if value is None or isinstance(value, (dict, list)):
+        return None
+    try:
+        if field_type in LONG_TYPES:
+            return int(float(value)) if isinstance(value, str) else int(value)
+        if field_type in FLOAT_TYPES:
+            return float(value)
+        if field_type == 'boolean':
+            if isinstance(value, str):
+                return value not in ('false', 'F', '0', 'off', 'no', '')
+            return bool(value)
+    except (TypeError, ValueError):
+        return None
+    if field_type == 'date' or isinstance(value, datetime):
+        return _parse_date(value)
+    if field_type == 'string' and not isinstance(value, str):
+        if isinstance(value, bool):
+            return 'true' if value else 'false'
+        return str(value)
+    return value
+
+def _rank(term):
+    """
+    Terms of different types are kept in separated ranges of the sorted index.
+    :return: {int}
+    """
+    if isinstance(term, (bool, int, float)):
+        return 0
+    if isinstance(term, datetime):
+        return 1
+    return 2
+
+def _to_number(term):
+    """
+    Convert the term for metrics aggregations. Dates are milliseconds of the epoch.
+    :return: {int or float or None} None if the term is not numeric.
+    """
+    if isinstance(term, bool):
+        return int(term)
+    if isinstance(term, (int, float)):
+        return term
+    if isinstance(term, datetime):
+        return _to_millis(term)
+    return None
+
+def _get_values(source, path):
+    """
+    Get values of the field in the document source. Values in lists are flattened.
+    :param source: {dict} The document source.
+    :param path: {list} ['extra', 'source']
+    :return: {list}
+    """
+    values = [source]
+    for name in path:
+        next_values = []
+        for value in values:
+            if isinstance(value, dict) and name in value:
+                next_values.append(value[name])
+        values = []
+        while next_values:
+            value = next_values.pop(0)
+            if isinstance(value, list):
+                next_values = value + next_values
+            elif value is not None:
+                values.append(value)
+    return values
+
+def _filter_source(source, include=None, exclude=None):
+    """
+    Filter top level fields of the document source.
+    :param source: {dict}
+    :param include: {list or None} Field names or wildcard patterns.
+    :param exclude: {list or None} Field names or wildcard patterns.
+    :return: {dict} The copied source.
+    """
+    result = {}
+    for name, value in source.items():
+        if include is not None and not [x for x in include if fnmatch.fnmatchcase(name, x.split('.', 1)[0])]:
+            continue
+        if exclude and [x for x in exclude if fnmatch.fnmatchcase(name, x)]:
+            continue
+        result[name] = _copy(value)
+    return result
+
+def _merge(target, changes):
+    """
+    Merge the partial document into the source like the _update api. Objects are merged, the others are replaced.
+    :param target: {dict} It is changed.
+    :param changes: {dict}
+    :return: {dict} target
+    """
+    for name, value in changes.items():
+        if isinstance(value, dict) and isinstance(target.get(name), dict):
+            _merge(target[name], value)
+        else:
+            target[name] = _copy(value)
+    return target
+
+def _merge_mapping(target, changes, path=''):
+    """
+    Merge the mapping like the put mapping api.
+    :raises RequestError: The type of the existing field is changed.
+    """
+    for name, value in changes.items():
+        current = target.get(name)
+        if isinstance(current, dict) and isinstance(value, dict):
+            if name not in ('properties', 'fields') and \
+                    current.get('type', 'object') != value.get('type', current.get('type', 'object')):
+                _raise(RequestError, 400, 'MergeMappingException[Merge failed with failures {[mapper [%s%s] '
+                                          'of different type, current_type [%s], merged_type [%s]]}]'
+                       % (path, name, current.get('type', 'object'), value.get('type')))
+            _merge_mapping(current, value, '%s%s.' % (path, name) if name not in ('properties', 'fields') else path)
+        else:
+            target[name] = _copy(value)
+
+def _normalize_settings(index_settings):
+    """
+    Flatten settings into the index level. {'index': {'refresh_interval': '1s'}, 'index.analysis': {}}
+    :return: {dict} {'refresh_interval': '1s', 'analysis': {}}
+    """
+    result = {}
+    for name, value in (index_settings or {}).items():
+        if name == 'index' and isinstance(value, dict):
+            result.update(_normalize_settings(value))
+        else:
+            result[name[6:] if name.startswith('index.') else name] = value
+    return result
+
+def _parse_time_value(value):
+    """
+    Parse the time value of settings. Numbers without the unit are milliseconds.
+    :param value: {string or int} '1s', '500ms', '-1'
+    :return: {float or None} Seconds. None is disabled. ('-1')
+    """
+    matched = _time_value.match(str(value).strip())
+    if matched is None or float(matched.group(1)) < 0:
+        return None
+    return float(matched.group(1)) * FIXED_INTERVAL_UNITS[matched.group(2) or 'ms'] / 1000.0
+
+def _stringify_settings(value):
+    """
+    Settings are returned as strings by the get settings api.
+    """
+    if isinstance(value, dict):
+        return {x: _stringify_settings(y) for x, y in value.items()}
+    if isinstance(value, list):
+        return [_stringify_settings(x) for x in value]
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value)
+
+def _generate_id():
+    """
+    Generate the id of the document like ElasticSearch. (url safe base64 of the uuid)
+    :return: {string}
+    """
+    return base64.urlsafe_b64encode(uuid.uuid4().bytes).decode('ascii').rstrip('=')
+
+def _raise(error_class, status_code, message):
+    """
+    Raise the exception like elasticsearch-py.
+    """
+    raise error_class(status_code, message, {'error': message, 'status': status_code})
+
+
+# ---------------------------------------------------------
+# Dates of date_histogram
+# ---------------------------------------------------------
+def _get_time_zone(name):
+    """
+    :param name: {string or None} '+08:00', 'UTC' or 'Asia/Taipei'
+    :return: {tzinfo}
+    """
+    if name in (None, '', 'UTC', 'Z'):
+        return timezone.utc
+    match = re.match(r'^([+-])(\d{1,2})(?::?(\d{2}))?$', str(name))
+    if match:
+        offset = timedelta(hours=int(match.group(2)), minutes=int(match.group(3) or 0))
+        return timezone(-offset if match.group(1) == '-' else offset)
+    try:
+        return ZoneInfo(name)
+    except Exception:
+        _raise(RequestError, 400, 'ElasticsearchIllegalArgumentException[The datetime zone id [%s] is not recognised]'
+               % name)
+
+def _parse_interval(interval):
+    """
+    :param interval: {string} 'month', '1M', '90m' or '1.5h'
+    :returns: {tuple} ({string or None}, {int or None})
+        The calendar unit.
+        The fixed interval in milliseconds.
+    """
+    if interval in CALENDAR_INTERVALS:
+        return CALENDAR_INTERVALS[interval], None
+    match = re.match(r'^(\d+(?:\.\d+)?)(ms|s|m|h|d|w)$', str(interval))
+    if not match:
+        _raise(RequestError, 400, 'SearchParseException[failed to parse the interval [%s]]' % interval)
+    return None, int(float(match.group(1)) * FIXED_INTERVAL_UNITS[match.group(2)])
+
+def _floor_date(value, unit):
+    """
+    Round down the local datetime to the calendar unit.
+    """
+    if unit == 'year':
+        return value.replace(month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
+    if unit == 'quarter':
+        return value.replace(month=(value.month - 1) // 3 * 3 + 1, day=1, hour=0, minute=0, second=0, microsecond=0)
+    if unit == 'month':
+        return value.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    if unit == 'week':
+        return (value - timedelta(days=value.weekday())).replace(hour=0, minute=0, second=0, microsecond=0)
+    if unit == 'day':
+        return value.replace(hour=0, minute=0, second=0, microsecond=0)
+    if unit == 'hour':
+        return value.replace(minute=0, second=0, microsecond=0)
+    if unit == 'minute':
+        return value.replace(second=0, microsecond=0)
+    return value.replace(microsecond=0)
+
+def _next_date(value, unit):
+    """
+    Get the start of the next calendar unit of the local datetime.
+    """
+    if unit in ('year', 'quarter', 'month'):
+        months = value.month - 1 + {'year': 12, 'quarter': 3, 'month': 1}[unit]
+        return value.replace(year=value.year + months // 12, month=months % 12 + 1)
+    return value + {
+        'week': timedelta(weeks=1),
+        'day': timedelta(days=1),
+        'hour': timedelta(hours=1),
+        'minute': timedelta(minutes=1),
+        'second': timedelta(seconds=1),
+    }[unit]
+
+
+# ---------------------------------------------------------
+# Indices
+# ---------------------------------------------------------
+class MemoryField(object):
+    """
+    The field of the document type resolved by the mapping.
+    """
+    __slots__ = ('type', 'indexed', 'analyzer', 'search_analyzer', 'source_path', 'mapped')
+
+    def __init__(self, mapping, source_path):
+        """
+        :param mapping: {dict or None} The mapping of the field. None is the dynamic field.
+        :param source_path: {list} The path of values in the source. The sub field 'name.raw' is indexed from 'name'.
+        """
+        mapping = mapping or {}
+        self.mapped = bool(mapping)
+        self.type = mapping.get('type', 'object' if 'properties' in mapping else None)
+        self.indexed = mapping.get('index') != 'no' and mapping.get('enabled', True)
+        if mapping.get('index') == 'not_analyzed':
+            self.analyzer = self.search_analyzer = 'keyword'
+        else:
+            self.analyzer = mapping.get('analyzer', 'standard')
+            self.search_analyzer = mapping.get('search_analyzer', self.analyzer)
+        self.source_path = source_path
+
+
+class MemoryFieldIndex(object):
+    """
+    The inverted index of one field.
+    Terms are in the hash index for term lookups. The sorted index of distinct terms for range queries
+    is built when it is used first after terms are changed, so adding and removing documents don't shift lists.
+    """
+    def __init__(self):
+        self.terms = {}  # {term: set(keys)}
+        self.keys = set()  # keys of documents which have any term
+        self.document_terms = {}  # {key: [term]}
+        self.sorted_terms = None  # [(rank, term)] distinct terms, None if terms are changed after it was built
+
+    def add(self, key, terms):
+        """
+        Index terms of the document.
+        :param key: {tuple} (document type, document id)
+        :param terms: {list}
+        """
+        terms = list(OrderedDict.fromkeys(terms))
+        if not terms:
+            return
+        self.document_terms[key] = terms
+        self.keys.add(key)
+        for term in terms:
+            keys = self.terms.get(term)
+            if keys is None:
+                keys = self.terms[term] = set()
+                self.sorted_terms = None
+            keys.add(key)
+
+    def remove(self, key):
+        """
+        Remove terms of the document.
+        :param key: {tuple} (document type, document id)
+        """
+        terms = self.document_terms.pop(key, None)
+        if terms is None:
+            return
+        self.keys.discard(key)
+        for term in terms:
+            keys = self.terms[term]
+            keys.discard(key)
+            if not keys:
+                del self.terms[term]
+                self.sorted_terms = None
+
+    def range(self, lower=None, include_lower=True, upper=None, include_upper=True):
+        """
+        Get keys of documents which have terms in the range. Bounds should be terms of the same type.
+        :return: {set}
+        """
+        if self.sorted_terms is None:
+            self.sorted_terms = sorted([(_rank(x), x) for x in self.terms])
+        sorted_terms = self.sorted_terms
+        rank = _rank(lower if lower is not None else upper)
+        if lower is None:
+            start = bisect.bisect_left(sorted_terms, (rank,))
+        elif include_lower:
+            start = bisect.bisect_left(sorted_terms, (rank, lower))
+        else:
+            start = bisect.bisect_right(sorted_terms, (rank, lower))
+        if upper is None:
+            end = bisect.bisect_left(sorted_terms, (rank + 1,))
+        elif include_upper:
+            end = bisect.bisect_right(sorted_terms, (rank, upper))
+        else:
+            end = bisect.bisect_left(sorted_terms, (rank, upper))
+        result = set()
+        for _, term in sorted_terms[start:end]:
+            result |= self.terms[term]
+        return result
+
+
+class MemoryIndex(object):
+    """
+    The index of the in-memory engine.
+    Like ElasticSearch, writes are visible to get right away, but they are searchable after the refresh.
+    The index is refreshed by refresh(), or before searching when refresh_interval passed since the last refresh.
+    Field indices are built when the field is searched first, then they are updated by refreshes.
+    """
+    def __init__(self, name, body=None):
+        """
+        Init the index.
+        :param name: {string} The index name.
+        :param body: {dict} The body of the create index api. {'settings', 'mappings', 'aliases'}
+        """
+        body = body or {}
+        self.name = name
+        self.settings = dict(DEFAULT_INDEX_SETTINGS)
+        self.settings.update(_normalize_settings(body.get('settings')))
+        self.mappings = {x: _copy(y) for x, y in (body.get('mappings') or {}).items()}
+        self.aliases = set((body.get('aliases') or {}).keys())
+        self.documents = OrderedDict()  # {(document type, document id): {'_source': {dict}, '_version': {int}}}
+        self.searchable = OrderedDict()  # documents of the last refresh
+        self.refreshed_at = time.monotonic()
+        self.__changed_keys = OrderedDict()  # {(document type, document id): None} writes after the last refresh
+        self.__field_indices = {}  # {field name: {MemoryFieldIndex}}
+        self.__fields = {}  # {(document type, field name): {MemoryField}}
+
+    def put_settings(self, index_settings):
+        """
+        Update settings. Field indices are rebuilt by the new analysis.
+        :param index_settings: {dict}
+        """
+        self.settings.update(_normalize_settings(index_settings))
+        self.__reset_fields()
+
+    def put_mapping(self, doc_type, mapping):
+        """
+        Merge the mapping of the document type. Field indices are rebuilt by the new mapping.
+        :param doc_type: {string}
+        :param mapping: {dict} {'properties': {dict}}
+        """
+        _merge_mapping(self.mappings.setdefault(doc_type, {}), mapping)
+        self.__reset_fields()
+
+    def put(self, key, source, version):
+        """
+        Store the document.
+        :param key: {tuple} (document type, document id)
+        :param source: {dict} The document source. It should not be changed after it is stored.
+        :param version: {int}
+        """
+        self.documents.pop(key, None)
+        self.documents[key] = {'_source': source, '_version': version}
+        self.__mark_changed(key)
+
+    def remove(self, key):
+        """
+        Remove the document.
+        :param key: {tuple} (document type, document id)
+        :return: {dict or None} The removed record.
+        """
+        record = self.documents.pop(key, None)
+        if record is not None:
+            self.__mark_changed(key)
+        return record
+
+    def refresh(self):
+        """
+        Make writes after the last refresh searchable.
+        """
+        for key in self.__changed_keys:
+            self.searchable.pop(key, None)
+            for field_index in self.__field_indices.values():
+                field_index.remove(key)
+            record = self.documents.get(key)
+            if record is not None:
+                self.searchable[key] = record
+                for name, field_index in self.__field_indices.items():
+                    field_index.add(key, self.get_terms(key, name))
+        self.__changed_keys.clear()
+        self.refreshed_at = time.monotonic()
+
+    def refresh_if_scheduled(self):
+        """
+        Refresh the index if refresh_interval passed since the last refresh. '-1' disables it.
+        """
+        interval = _parse_time_value(self.settings.get('refresh_interval', '1s'))
+        if interval is not None and time.monotonic() - self.refreshed_at >= interval:
+            self.refresh()
+
+    def __mark_changed(self, key):
+        self.__changed_keys.pop(key, None)
+        self.__changed_keys[key] = None
+
+    def get_field_index(self, name):
+        """
+        Get the index of the field. It is built when it is used first.
+        :param name: {string} The field name. 'title', 'extra.source', 'title.substring'
+        :return: {MemoryFieldIndex}
+        """
+        field_index = self.__field_indices.get(name)
+        if field_index is None:
+            field_index = MemoryFieldIndex()
+            for key in self.searchable:
+                field_index.add(key, self.get_terms(key, name))
+            self.__field_indices[name] = field_index
+        return field_index
+
+    def get_terms(self, key, name):
+        """
+        Analyze values of the field of the searchable document.
+        :param key: {tuple} (document type, document id)
+        :param name: {string} The field name.
+        :return: {list}
+        """
+        field = self.get_field(key[0], name)
+        result = []
+        for value in _get_values(self.searchable[key]['_source'], field.source_path):
+            result.extend(self.analyze(field, value))
+        return result
+
+    def get_field(self, doc_type, name):
+        """
+        Resolve the field by the mapping of the document type.
+        :param doc_type: {string or None} None: the field of any document type which maps it.
+        :param name: {string} The field name.
+        :return: {MemoryField}
+        """
+        field = self.__fields.get((doc_type, name))
+        if field is not None:
+            return field
+        if doc_type is None:
+            fields = [self.get_field(x, name) for x in self.mappings]
+            field = ([x for x in fields if x.mapped] or [MemoryField(None, name.split('.'))])[0]
+        else:
+            mapping = self.mappings.get(doc_type)
+            source_path = []
+            for part in name.split('.'):
+                if mapping is not None and part in mapping.get('fields', {}):
+                    mapping = mapping['fields'][part]  # the sub field is indexed from the same value
+                    continue
+                source_path.append(part)
+                mapping = mapping.get('properties', {}).get(part) if mapping is not None else None
+            field = MemoryField(mapping, source_path)
+        self.__fields[(doc_type, name)] = field
+        return field
+
+    def analyze(self, field, value, search=False):
+        """
+        Convert the value to terms of the field.
+        :param field: {MemoryField}
+        :param value: The value of the document or the query.
+        :param search: {bool} Use the search analyzer.
+        :return: {list}
+        """
+        if not field.indexed:
+            return []
+        if field.type == 'string' or (field.type is None and isinstance(value, str)):
+            text = _normalize(value, 'string')
+            if text is None:
+                return []
+            return self.__tokenize(field.search_analyzer if search else field.analyzer, text)
+        term = _normalize(value, field.type)
+        return [] if term is None else [term]
+
+    def __tokenize(self, analyzer, text):
+        """
+        Split the text by the analyzer. Custom analyzers with the nGram tokenizer are supported.
+        :param analyzer: {string} The analyzer name.
+        :param text: {string}
+        :return: {list}
+        """
+        if analyzer == 'keyword':
+            return [text]
+        analysis = self.settings.get('analysis', {})
+        definition = analysis.get('analyzer', {}).get(analyzer)
+        if not definition or definition.get('type') != 'custom':
+            return _standard_tokens.findall(text.lower())
+        tokenizer = analysis.get('tokenizer', {}).get(definition.get('tokenizer'), {})
+        if tokenizer.get('type') in ('nGram', 'ngram'):
+            min_gram = int(tokenizer.get('min_gram', 1))
+            max_gram = int(tokenizer.get('max_gram', 2))
+            tokens = []
+            for word in _letters_and_digits.findall(text):
+                for size in range(min_gram, max_gram + 1):
+                    tokens.extend([word[x:x + size] for x in range(len(word) - size + 1)])
+        elif definition.get('tokenizer') == 'keyword':
+            tokens = [text]
+        else:
+            tokens = _standard_tokens.findall(text)
+        if 'lowercase' in definition.get('filter', []):
+            tokens = [x.lower() for x in tokens]
+        return tokens
+
+    def __reset_fields(self):
+        self.__fields.clear()
+        self.__field_indices.clear()
+
+
+    # -----------------------------------------------------
+    # Queries and filters
+    # -----------------------------------------------------
+    def match(self, query):
+        """
+        Get keys of searchable documents which are matched by the query or the filter.
+        Documents are not scored, the query context and the filter context are the same.
+        :param query: {dict or None} The query of ElasticSearch. None matches all documents.
+        :return: {set} {(document type, document id)}
+        """
+        if not query:
+            return set(self.searchable)
+        if len(query) != 1:
+            _raise(RequestError, 400, 'QueryParsingException[[%s] expected one clause, got %s]'
+                   % (self.name, sorted(query.keys())))
+        (clause, body), = query.items()
+        if clause == 'match_all':
+            return set(self.searchable)
+        if clause == 'bool':
+            return self.__match_bool(body)
+        if clause == 'filtered':
+            return self.match(body.get('query')) & self.match(body.get('filter'))
+        if clause in ('query', 'fquery'):
+            return self.match(body.get('query') if clause == 'fquery' else body)
+        if clause in ('and', 'or'):
+            filters = body.get('filters', []) if isinstance(body, dict) else body
+            results = [self.match(x) for x in filters]
+            if not results:
+                return set()
+            return set.intersection(*results) if clause == 'and' else set.union(*results)
+        if clause == 'not':
+            return set(self.searchable) - self.match(body.get('filter', body.get('query', body)))
+        if clause == 'ids':
+            ids = set(body.get('values', []))
+            doc_types = _as_names(body.get('type'))
+            return set([x for x in self.searchable if x[1] in ids and (not doc_types or x[0] in doc_types)])
+        if clause in ('exists', 'missing'):
+            keys = self.get_field_index(body['field']).keys
+            return set(keys) if clause == 'exists' else set(self.searchable) - keys
+        name, value = self.__get_field_clause(clause, body)
+        if clause == 'match':
+            return self.__match_text(name, value)
+        if clause == 'term':
+            return self.__match_terms(name, [value.get('value') if isinstance(value, dict) else value])
+        if clause == 'terms':
+            return self.__match_terms(name, value)
+        if clause == 'range':
+            return self.__match_range(name, value)
+        if clause in ('regexp', 'prefix', 'wildcard'):
+            return self.__match_pattern(clause, name, value.get('value') if isinstance(value, dict) else value)
+        _raise(RequestError, 400, 'QueryParsingException[[%s] No query registered for [%s]]' % (self.name, clause))
+
+    def __get_field_clause(self, clause, body):
+        """
+        Get the field and the value of the field clause. {'term': {'name': 'value', '_cache': true}}
+        :return: {tuple} ({string}, value)
+        """
+        items = [(x, y) for x, y in body.items() if x not in ('_cache', '_name', 'boost', 'execution')]
+        if len(items) != 1:
+            _raise(RequestError, 400, 'QueryParsingException[[%s] [%s] query expects one field]' % (self.name, clause))
+        return items[0]
+
+    def __match_bool(self, body):
+        must = _as_list(body.get('must'))
+        should = _as_list(body.get('should'))
+        result = set(self.searchable)
+        for query in must:
+            result &= self.match(query)
+        for query in _as_list(body.get('must_not')):
+            result -= self.match(query)
+        if not should:
+            return result
+        minimum = body.get('minimum_should_match', 0 if must else 1)
+        if isinstance(minimum, str):
+            minimum = len(should) * int(minimum[:-1]) // 100 if minimum.endswith('%') else int(minimum)
+        if minimum <= 0:
+            return result
+        if minimum == 1:
+            return result & set.union(*[self.match(x) for x in should])
+        counts = {}
+        for query in should:
+            for key in self.match(query) & result:
+                counts[key] = counts.get(key, 0) + 1
+        return set([x for x, y in counts.items() if y >= minimum])
+
+    def __match_text(self, name, options):
+        if not isinstance(options, dict):
+            options = {'query': options}
+        field = self.get_field(None, name)
+        terms = self.analyze(field, options.get('query'), search=True)
+        if not terms:
+            return set()
+        field_index = self.get_field_index(name)
+        results = [field_index.terms.get(x, set()) for x in terms]
+        if str(options.get('operator', 'or')).lower() == 'and':
+            return set.intersection(*results)
+        return set.union(*results)
+
+    def __match_terms(self, name, values):
+        field = self.get_field(None, name)
+        field_index = self.get_field_index(name)
+        result = set()
+        for value in values:
+            term = value if field.type is None and isinstance(value, str) else _normalize(value, field.type)
+            result |= field_index.terms.get(term, set())
+        return result
+
+    def __match_range(self, name, options):
+        field = self.get_field(None, name)
+        bounds = {}
+        for operator, value in options.items():
+            if operator in ('gt', 'gte', 'lt', 'lte', 'from', 'to'):
+                bounds[operator] = value if field.type is None and isinstance(value, str) else \
+                    _normalize(value, field.type)
+        lower, include_lower = bounds.get('gte', bounds.get('from')), True
+        if 'gt' in bounds:
+            lower, include_lower = bounds['gt'], False
+        elif 'from' in bounds and not options.get('include_lower', True):
+            include_lower = False
+        upper, include_upper = bounds.get('lte', bounds.get('to')), True
+        if 'lt' in bounds:
+            upper, include_upper = bounds['lt'], False
+        elif 'to' in bounds and not options.get('include_upper', True):
+            include_upper = False
+        if lower is None and upper is None:
+            return set(self.get_field_index(name).keys)
+        if lower is not None and upper is not None and _rank(lower) != _rank(upper):
+            return set()
+        return self.get_field_index(name).range(lower, include_lower, upper, include_upper)
+
+    def __match_pattern(self, clause, name, pattern):
+        if clause == 'prefix':
+            expression = re.escape(pattern) + '.*'
+        elif clause == 'wildcard':
+            expression = fnmatch.translate(pattern)
+        else:
+            expression = pattern
+        try:
+            expression = re.compile(expression, re.DOTALL)
+        except re.error as e:
+            _raise(RequestError, 400, 'QueryParsingException[[%s] invalid regexp [%s]: %s]' % (self.name, pattern, e))
+        result = set()
+        for term, keys in self.get_field_index(name).terms.items():
+            if isinstance(term, str) and expression.fullmatch(term):
+                result |= keys
+        return result
+
+
+# ---------------------------------------------------------
+# The client
+# ---------------------------------------------------------
+class MemoryElasticsearch(object):
+    """
+    The in-process engine with the api of the ElasticSearch client which is used by asahi.
+    Like ElasticSearch, get and mget are realtime, but search and count see writes after the index is refreshed.
+    (refresh(), synchronized=True, asahi.refresh_after() or refresh_interval of the index)
+    settings.ELASTICSEARCH_URL = 'memory://'
+    Clients of the same url share documents in this process.
+    """
+    def __init__(self):
+        self.indices = MemoryIndicesClient(self)
+        self._indices = {}  # {index name: {MemoryIndex}}
+        self._scrolls = {}  # {scroll id: {'hits': [(MemoryIndex, key, record)], 'size': {int}, 'params': {dict}}}
+        self._lock = threading.RLock()
+
+    def reset(self):
+        """
+        Delete all indices. Indices ensured by asahi are forgotten too.
+        """
+        from .document import reset_ensured_indices
+
+        with self._lock:
+            self._indices.clear()
+            self._scrolls.clear()
+        reset_ensured_indices()
+
+    def _resolve_indices(self, index, ignore_missing=False):
+        """
+        Resolve index names and aliases to indices.
+        :param index: {string or list or None} None and '_all' are all indices.
+        :param ignore_missing: {bool}
+        :return: {list} [{MemoryIndex}]
+        """
+        names = _as_names(index)
+        if not names or names == ['_all']:
+            return [self._indices[x] for x in sorted(self._indices)]
+        result = []
+        for name in names:
+            matched = [y for x, y in sorted(self._indices.items())
+                       if fnmatch.fnmatchcase(x, name) or [z for z in y.aliases if fnmatch.fnmatchcase(z, name)]]
+            if not matched and not ignore_missing:
+                _raise(NotFoundError, 404, 'IndexMissingException[[%s] missing]' % name)
+            result.extend([x for x in matched if x not in result])
+        return result
+
+    def _get_write_index(self, index):
+        """
+        Get the index to write. The index is created with the dynamic mapping if it doesn't exist.
+        :param index: {string} The index name or the alias of one index.
+        :return: {MemoryIndex}
+        """
+        indices = self._resolve_indices(index, ignore_missing=True)
+        if not indices:
+            self._indices[index] = MemoryIndex(index)
+            return self._indices[index]
+        if len(indices) > 1:
+            _raise(RequestError, 400, 'ElasticsearchIllegalArgumentException[Alias [%s] has more than one indices '
+                                      'associated with it [%s], can\'t execute a single index op]'
+                   % (index, ', '.join([x.name for x in indices])))
+        return indices[0]
+
+    def _find_document(self, index, doc_type, id):
+        """
+        Find the document.
+        :return: {tuple} ({MemoryIndex}, {tuple}key, {dict}record) key and record are None if it is not found.
+        """
+        indices = self._resolve_indices(index)
+        doc_types = _as_names(doc_type)
+        if doc_types == ['_all']:
+            doc_types = None
+        for memory_index in indices:
+            for type_name in doc_types or [x[0] for x in memory_index.documents if x[1] == id]:
+                record = memory_index.documents.get((type_name, id))
+                if record is not None:
+                    return memory_index, (type_name, id), record
+        return (indices[0] if indices else None), None, None
+
+    @staticmethod
+    def __check_version(memory_index, key, record, version, version_type='internal'):
+        """
+        Check the version for the optimistic concurrency control.
+        :param version: {int or None} 0 and None are not checked.
+        :return: {int} The version of the written document.
+        """
+        current = record['_version'] if record else -1
+        if version_type in ('external', 'external_gt', 'external_gte'):
+            version = int(version)
+            if (version_type == 'external_gte' and version < current) or \
+                    (version_type != 'external_gte' and version <= current):
+                _raise(ConflictError, 409, 'VersionConflictEngineException[[%s][0] [%s][%s]: version conflict, '
+                                           'current [%s], provided [%s]]'
+                       % (memory_index.name, key[0], key[1], current, version))
+            return version
+        if version not in (None, 0, '0') and int(version) != current:
+            _raise(ConflictError, 409, 'VersionConflictEngineException[[%s][0] [%s][%s]: version conflict, '
+                                       'current [%s], provided [%s]]'
+                   % (memory_index.name, key[0], key[1], current, version))
+        return current + 1 if record else 1
+
+    @staticmethod
+    def __get_source_params(params, body=None):
+        """
+        Get source filtering of the request.
+        :return: {tuple} ({bool}fetch the source, {list or None}include, {list or None}exclude)
+        """
+        body_source = (body or {}).get('_source')
+        source = params.get('_source', body_source)
+        include = _as_names(params.get('_source_include'))
+        exclude = _as_names(params.get('_source_exclude'))
+        if source in (False, 'false'):
+            return False, None, None
+        if isinstance(source, dict):
+            include = include or _as_names(source.get('include', source.get('includes')))
+            exclude = exclude or _as_names(source.get('exclude', source.get('excludes')))
+        elif source not in (None, True, 'true'):
+            include = include or _as_names(source)
+        return True, include, exclude
+
+    def __build_hit(self, memory_index, key, record, source_params, version=False, found=None):
+        fetch_source, include, exclude = source_params
+        hit = {'_index': memory_index.name, '_type': key[0], '_id': key[1]}
+        if version:
+            hit['_version'] = record['_version']
+        if found is not None:
+            hit['found'] = found
+        else:
+            hit['_score'] = 1.0
+        if fetch_source:
+            hit['_source'] = _filter_source(record['_source'], include, exclude)
+        return hit
+
+
+    # -----------------------------------------------------
+    # Document apis
+    # -----------------------------------------------------
+    def get(self, index, id, doc_type='_all', **params):
+        with self._lock:
+            memory_index, key, record = self._find_document(index, doc_type, id)
+            if record is None:
+                raise NotFoundError(404, _serializer.dumps({
+                    '_index': memory_index.name if memory_index else index, '_type': doc_type, '_id': id, 'found': False,
+                }), {'found': False})
+            return self.__build_hit(memory_index, key, record, self.__get_source_params(params), True, True)
+
+    def mget(self, body, index=None, doc_type=None, **params):
+        with self._lock:
+            if 'docs' in body:
+                docs = body['docs']
+            else:
+                docs = [{'_id': x} for x in body.get('ids', [])]
+            result = []
+            source_params = self.__get_source_params(params)
+            for doc in docs:
+                doc_index = doc.get('_index', index)
+                doc_type_name = doc.get('_type', doc_type)
+                try:
+                    memory_index, key, record = self._find_document(doc_index, doc_type_name, doc['_id'])
+                except NotFoundError as e:
+                    result.append({'_index': doc_index, '_type': doc_type_name, '_id': doc['_id'], 'error': e.error})
+                    continue
+                if record is None:
+                    result.append({'_index': memory_index.name, '_type': doc_type_name, '_id': doc['_id'],
+                                   'found': False})
+                    continue
+                doc_source_params = source_params
+                if '_source' in doc:
+                    doc_source_params = self.__get_source_params({}, doc)
+                result.append(self.__build_hit(memory_index, key, record, doc_source_params, True, True))
+            return {'docs': result}
+
+    def index(self, index, doc_type, body, id=None, **params):
+        with self._lock:
+            memory_index = self._get_write_index(index)
+            id = _generate_id() if id is None else str(id)
+            key = (doc_type, id)
+            record = memory_index.documents.get(key)
+            if params.get('op_type') == 'create' and record is not None:
+                _raise(ConflictError, 409, 'DocumentAlreadyExistsException[[%s][0] [%s][%s]: document already exists]'
+                       % (memory_index.name, doc_type, id))
+            version = self.__check_version(memory_index, key, record, params.get('version'),
+                                           params.get('version_type', 'internal'))
+            memory_index.put(key, _to_json(body), version)
+            return {'_index': memory_index.name, '_type': doc_type, '_id': id, '_version': version,
+                    'created': record is None}
+
+    def create(self, index, doc_type, body, id=None, **params):
+        params['op_type'] = 'create'
+        return self.index(index, doc_type, body, id, **params)
+
+    def update(self, index, doc_type, id, body=None, **params):
+        with self._lock:
+            body = _to_json(body or {})
+            if 'script' in body:
+                _raise(RequestError, 400, 'ElasticsearchIllegalArgumentException[scripts are not supported '
+                                          'by the in-memory engine]')
+            memory_index = self._get_write_index(index)
+            key = (doc_type, str(id))
+            record = memory_index.documents.get(key)
+            if record is None:
+                if 'upsert' not in body and not body.get('doc_as_upsert'):
+                    _raise(NotFoundError, 404, 'DocumentMissingException[[%s][0] [%s][%s]: document missing]'
+                           % (memory_index.name, doc_type, id))
+                version = self.__check_version(memory_index, key, record, params.get('version'))
+                memory_index.put(key, body.get('upsert', body.get('doc', {})), version)
+            else:
+                version = self.__check_version(memory_index, key, record, params.get('version'))
+                source = _merge(_copy(record['_source']), body.get('doc', {}))
+                if body.get('detect_noop') and source == record['_source']:
+                    version = record['_version']
+                else:
+                    memory_index.put(key, source, version)
+            return {'_index': memory_index.name, '_type': doc_type, '_id': key[1], '_version': version}
+
+    def delete(self, index, doc_type, id, **params):
+        with self._lock:
+            memory_index = self._get_write_index(index)
+            key = (doc_type, str(id))
+            record = memory_index.documents.get(key)
+            if record is None:
+                raise NotFoundError(404, _serializer.dumps({
+                    '_index': memory_index.name, '_type': doc_type, '_id': key[1], 'found': False,
+                }), {'found': False})
+            version = self.__check_version(memory_index, key, record, params.get('version'),
+                                           params.get('version_type', 'internal'))
+            memory_index.remove(key)
+            return {'_index': memory_index.name, '_type': doc_type, '_id': key[1], '_version': version, 'found': True}
+
+    def bulk(self, body, index=None, doc_type=None, **params):
+        """
+        Execute actions of the _bulk api. Each action succeeds or fails alone.
+        """
+        with self._lock:
+            if isinstance(body, (str, bytes)):
+                if isinstance(body, bytes):
+                    body = body.decode('utf-8')
+                lines = [_serializer.loads(x) for x in body.split('\n') if x.strip()]
+            else:
+                lines = [_serializer.loads(x) if isinstance(x, str) else x for x in body]
+            items = []
+            position = 0
+            while position < len(lines):
+                (operation, header), = lines[position].items()
+                position += 1
+                source = None
+                if operation != 'delete':
+                    source = lines[position]
+                    position += 1
+                items.append({operation: self.__execute_bulk_action(operation, header, source, index, doc_type)})
+            return {
+                'took': 1,
+                'errors': any(['error' in list(x.values())[0] for x in items]),
+                'items': items,
+            }
+
+    def __execute_bulk_action(self, operation, header, source, index, doc_type):
+        index = header.get('_index', index)
+        doc_type = header.get('_type', doc_type)
+        id = header.get('_id')
+        params = {}
+        if header.get('_version') is not None:
+            params['version'] = header['_version']
+        if header.get('_version_type'):
+            params['version_type'] = header['_version_type']
+        try:
+            if operation in ('index', 'create'):
+                if operation == 'create':
+                    params['op_type'] = 'create'
+                result = self.index(index, doc_type, source, id, **params)
+                result['status'] = 201 if result['created'] else 200
+            elif operation == 'update':
+                result = self.update(index, doc_type, id, source, **params)
+                result['status'] = 200
+            elif operation == 'delete':
+                try:
+                    result = self.delete(index, doc_type, id, **params)
+                    result['status'] = 200
+                except NotFoundError:
+                    result = {'_index': index, '_type': doc_type, '_id': id, '_version': 1, 'found': False,
+                              'status': 404}
+            else:
+                _raise(RequestError, 400, 'ActionRequestValidationException[Malformed action [%s]]' % operation)
+        except TransportError as e:
+            return {'_index': index, '_type': doc_type, '_id': id, 'status': e.status_code, 'error': e.error}
+        return result
+
+
+    # -----------------------------------------------------
+    # Search apis
+    # -----------------------------------------------------
+    def search(self, index=None, doc_type=None, body=None, **params):
+        with self._lock:
+            return self.__search(index, doc_type, body or {}, params)
+
+    def count(self, index=None, doc_type=None, body=None, **params):
+        with self._lock:
+            hits = self.__get_matched_hits(index, doc_type, (body or {}).get('query'))
+            return {'count': len(hits), '_shards': {'total': 1, 'successful': 1, 'failed': 0}}
+
+    def msearch(self, body, index=None, doc_type=None, **params):
+        """
+        Execute searches. The failed search is returned as {'error': {string}, 'status': {int}}.
+        Searches see the same documents, writes of other threads wait for the whole request.
+        """
+        if isinstance(body, (str, bytes)):
+            if isinstance(body, bytes):
+                body = body.decode('utf-8')
+            body = [_serializer.loads(x) for x in body.split('\n') if x.strip()]
+        responses = []
+        with self._lock:
+            for position in range(0, len(body), 2):
+                header = dict(body[position])
+                search_body = body[position + 1]
+                search_index = header.pop('index', index)
+                search_doc_type = header.pop('type', doc_type)
+                try:
+                    responses.append(self.search(search_index, search_doc_type, search_body, **header))
+                except TransportError as e:
+                    responses.append({'error': e.error, 'status': e.status_code})
+        return {'responses': responses}
+
+    def scroll(self, scroll_id=None, body=None, **params):
+        with self._lock:
+            scroll_id = scroll_id or (body or {}).get('scroll_id')
+            context = self._scrolls.get(scroll_id)
+            if context is None:
+                _raise(NotFoundError, 404, 'SearchContextMissingException[No search context found for id [%s]]'
+                       % scroll_id)
+            hits = context['hits'][:context['size']]
+            del context['hits'][:context['size']]
+            return self.__build_search_response(hits, context['total'], context['params'], scroll_id=scroll_id)
+
+    def clear_scroll(self, scroll_id=None, body=None, **params):
+        with self._lock:
+            scroll_ids = _as_names(scroll_id) or _as_names((body or {}).get('scroll_id')) or []
+            missing = [x for x in scroll_ids if x not in self._scrolls]
+            for x in scroll_ids:
+                self._scrolls.pop(x, None)
+            if missing:
+                _raise(NotFoundError, 404, 'SearchContextMissingException[No search context found for id [%s]]'
+                       % missing[0])
+            return {}
+
+    def __search(self, index, doc_type, body, params):
+        hits = self.__get_matched_hits(index, doc_type, body.get('query'))
+        if params.get('terminate_after'):
+            hits = hits[:int(params['terminate_after'])]
+        total = len(hits)
+        sort_items = _as_list(body.get('sort'))
+        if sort_items:
+            hits = self.__sort_hits(hits, sort_items)
+        aggregations_body = body.get('aggs', body.get('aggregations'))
+        aggregations = self.__aggregate([(x, y) for x, y, _ in hits], aggregations_body) \
+            if aggregations_body else None
+        skip = int(params.get('from', body.get('from')) or 0)
+        size = params.get('size', body.get('size'))
+        size = 10 if size is None else int(size)
+        hits = hits[skip:]
+        scroll_id = None
+        if params.get('scroll'):
+            scroll_id = _generate_id()
+            self._scrolls[scroll_id] = {
+                'hits': hits[size:],
+                'size': size,
+                'total': total,
+                'params': {'body': body, 'params': params},
+            }
+        response = self.__build_search_response(hits[:size], total, {'body': body, 'params': params}, scroll_id)
+        if aggregations is not None:
+            response['aggregations'] = aggregations
+        if params.get('terminate_after'):
+            response['terminated_early'] = total >= int(params['terminate_after'])
+        return response
+
+    def __get_matched_hits(self, index, doc_type, query):
+        """
+        :return: {list} [({MemoryIndex}, {tuple}key, {dict}record)] Searchable documents in the order of writes.
+        """
+        doc_types = _as_names(doc_type)
+        if doc_types == ['_all']:
+            doc_types = None
+        result = []
+        for memory_index in self._resolve_indices(index):
+            memory_index.refresh_if_scheduled()
+            keys = memory_index.match(query)
+            result.extend([(memory_index, x, y) for x, y in memory_index.searchable.items()
+                           if x in keys and (not doc_types or x[0] in doc_types)])
+        return result
+
+    def __build_search_response(self, hits, total, request, scroll_id=None):
+        source_params = self.__get_source_params(request['params'], request['body'])
+        version = request['params'].get('version', request['body'].get('version', False)) in (True, 'true')
+        response = {
+            'took': 1,
+            'timed_out': False,
+            '_shards': {'total': 1, 'successful': 1, 'failed': 0},
+            'hits': {
+                'total': total,
+                'max_score': None,
+                'hits': [self.__build_hit(x, y, z, source_params, version) for x, y, z in hits],
+            },
+        }
+        if scroll_id is not None:
+            response['_scroll_id'] = scroll_id
+        return response
+
+    def __sort_hits(self, hits, sort_items):
+        """
+        Sort hits by sort items. Multi-valued fields are sorted by the min value ascending, the max value descending.
+        """
+        for sort_item in reversed(sort_items):
+            if isinstance(sort_item, str):
+                name, options = sort_item, {}
+            else:
+                (name, options), = sort_item.items()
+            if isinstance(options, str):
+                options = {'order': options}
+            descending = options.get('order', 'desc' if name == '_score' else 'asc') == 'desc'
+            if name in ('_score', '_doc'):
+                continue
+            values = []
+            for memory_index, key, record in hits:
+                if name in ('_id', '_uid'):
+                    terms = [key[1]]
+                else:
+                    terms = memory_index.get_field_index(name).document_terms.get(key)
+                if terms:
+                    terms = [(_rank(x), x) for x in terms]
+                    values.append(max(terms) if descending else min(terms))
+                else:
+                    values.append(None)
+            present = sorted([(x, y) for x, y in zip(hits, values) if y is not None],
+                             key=lambda x: x[1], reverse=descending)
+            missing = [x for x, y in zip(hits, values) if y is None]
+            if options.get('missing') == '_first':
+                hits = missing + [x for x, _ in present]
+            else:
+                hits = [x for x, _ in present] + missing
+        return hits
+
+
+    # -----------------------------------------------------
+    # Aggregations
+    # -----------------------------------------------------
+    def __aggregate(self, documents, aggregations_body):
+        """
+        Run aggregations on documents.
+        :param documents: {list} [({MemoryIndex}, {tuple}key)]
+        :param aggregations_body: {dict} {name: {aggregation type: {options}, 'aggs': {dict}}}
+        :return: {dict} {name: {result}}
+        """
+        result = {}
+        for name, body in aggregations_body.items():
+            sub_aggregations = body.get('aggs', body.get('aggregations'))
+            items = [(x, y) for x, y in body.items() if x not in ('aggs', 'aggregations', 'meta')]
+            if len(items) != 1:
+                _raise(RequestError, 400, 'SearchParseException[Expected one aggregation type in [%s]]' % name)
+            (aggregation_type, options), = items
+            if aggregation_type == 'terms':
+                result[name] = self.__aggregate_terms(documents, options, sub_aggregations)
+            elif aggregation_type == 'date_histogram':
+                result[name] = self.__aggregate_date_histogram(documents, options, sub_aggregations)
+            elif aggregation_type in ('sum', 'avg', 'min', 'max', 'stats', 'value_count', 'percentiles',
+                                      'cardinality'):
+                result[name] = self.__aggregate_metrics(aggregation_type, documents, options)
+            else:
+                _raise(RequestError, 400, 'SearchParseException[Could not find aggregator type [%s] in [%s]]'
+                       % (aggregation_type, name))
+        return result
+
+    @staticmethod
+    def __get_document_terms(documents, field):
+        """
+        :return: {list} [[term]] Terms of each document.
+        """
+        field_indices = {}
+        result = []
+        for memory_index, key in documents:
+            field_index = field_indices.get(memory_index.name)
+            if field_index is None:
+                field_index = field_indices[memory_index.name] = memory_index.get_field_index(field)
+            result.append(field_index.document_terms.get(key, []))
+        return result
+
+    def __build_bucket(self, term, documents, sub_aggregations):
+        if isinstance(term, bool):
+            bucket = {'key': int(term), 'key_as_string': 'T' if term else 'F'}
+        elif isinstance(term, datetime):
+            bucket = {'key': _to_millis(term), 'key_as_string': _format_date(term)}
+        else:
+            bucket = {'key': term}
+        bucket['doc_count'] = len(documents)
+        if sub_aggregations:
+            bucket.update(self.__aggregate(documents, sub_aggregations))
+        return bucket
+
+    def __aggregate_terms(self, documents, options, sub_aggregations):
+        groups = OrderedDict()  # {term: [document]}
+        for document, terms in zip(documents, self.__get_document_terms(documents, options['field'])):
+            for term in terms:
+                groups.setdefault(term, []).append(document)
+        order = options.get('order', {'_count': 'desc'})
+        (order_by, direction), = order.items()
+        if order_by in ('_term', '_key'):
+            terms = sorted(groups, key=lambda x: (_rank(x), x), reverse=direction == 'desc')
+        else:
+            terms = sorted(groups, key=lambda x: (_rank(x), x))
+            terms.sort(key=lambda x: len(groups[x]), reverse=direction != 'asc')
+        terms = [x for x in terms if len(groups[x]) >= options.get('min_doc_count', 1)]
+        size = int(options.get('size', 10)) or len(terms)
+        return {
+            'doc_count_error_upper_bound': 0,
+            'sum_other_doc_count': sum([len(groups[x]) for x in terms[size:]]),
+            'buckets': [self.__build_bucket(x, groups[x], sub_aggregations) for x in terms[:size]],
+        }
+
+    def __aggregate_date_histogram(self, documents, options, sub_aggregations):
+        unit, fixed_interval = _parse_interval(options.get('interval', 'day'))
+        time_zone = _get_time_zone(options.get('time_zone'))
+        to_local = lambda x: x.replace(tzinfo=timezone.utc).astimezone(time_zone).replace(tzinfo=None)
+        to_utc = lambda x: x.replace(tzinfo=time_zone).astimezone(timezone.utc).replace(tzinfo=None)
+
+        def get_bucket_key(value):
+            if unit is not None:
+                return to_utc(_floor_date(to_local(value), unit))
+            offset = _to_millis(to_local(value)) - _to_millis(value)
+            return EPOCH + timedelta(milliseconds=(_to_millis(value) + offset) // fixed_interval * fixed_interval
+                                     - offset)
+
+        groups = {}  # {bucket key: [document]}
+        for document, terms in zip(documents, self.__get_document_terms(documents, options['field'])):
+            for bucket_key in set([get_bucket_key(x) for x in terms if isinstance(x, datetime)]):
+                groups.setdefault(bucket_key, []).append(document)
+        min_doc_count = int(options.get('min_doc_count', 1))
+        keys = sorted(groups)
+        if min_doc_count == 0 and keys:
+            keys = []
+            bucket_key = min(groups)
+            while bucket_key <= max(groups):
+                keys.append(bucket_key)
+                if unit is not None:
+                    bucket_key = to_utc(_next_date(to_local(bucket_key), unit))
+                else:
+                    bucket_key = get_bucket_key(bucket_key + timedelta(milliseconds=fixed_interval))
+        return {
+            'buckets': [self.__build_bucket(x, groups.get(x, []), sub_aggregations)
+                        for x in keys if len(groups.get(x, [])) >= min_doc_count],
+        }
+
+    def __aggregate_metrics(self, aggregation_type, documents, options):
+        terms = self.__get_document_terms(documents, options['field'])
+        if aggregation_type == 'cardinality':
+            return {'value': len(set([x for document_terms in terms for x in document_terms]))}
+        values = [_to_number(x) for document_terms in terms for x in document_terms]
+        values = [x for x in values if x is not None]
+        if aggregation_type == 'value_count':
+            return {'value': len(values)}
+        if aggregation_type == 'sum':
+            return {'value': float(sum(values))}
+        if aggregation_type == 'percentiles':
+            return {'values': {str(float(x)): self.__get_percentile(sorted(values), float(x))
+                               for x in options.get('percents', DEFAULT_PERCENTS)}}
+        summary = {
+            'count': len(values),
+            'min': float(min(values)) if values else None,
+            'max': float(max(values)) if values else None,
+            'avg': float(sum(values)) / len(values) if values else None,
+            'sum': float(sum(values)),
+        }
+        if aggregation_type == 'stats':
+            return summary
+        return {'value': summary[aggregation_type]}
+
+    @staticmethod
+    def __get_percentile(values, percent):
+        """
+        Get the percentile of sorted values with the linear interpolation.
+        :return: {float or None}
+        """
+        if not values:
+            return None
+        position = (len(values) - 1) * percent / 100.0
+        lower = int(position)
+        upper = min(lower + 1, len(values) - 1)
+        return float(values[lower] + (values[upper] - values[lower]) * (position - lower))
+
+
+class MemoryIndicesClient(object):
+    """
+    The indices api of the in-memory engine.
+    """
+    def __init__(self, client):
+        self.client = client
+
+    def exists(self, index, **params):
+        with self.client._lock:
+            return all([self.client._resolve_indices(x, ignore_missing=True) for x in _as_names(index)])
+
+    def create(self, index, body=None, **params):
+        with self.client._lock:
+            if self.client._resolve_indices(index, ignore_missing=True):
+                _raise(RequestError, 400, 'IndexAlreadyExistsException[[%s] already exists]' % index)
+            memory_index = MemoryIndex(index, _to_json(body or {}))
+            for alias in memory_index.aliases:
+                if alias in self.client._indices:
+                    _raise(RequestError, 400, 'InvalidAliasNameException[[%s] an index exists with the same name '
+                                              'as the alias]' % alias)
+            self.client._indices[index] = memory_index
+            return {'acknowledged': True}
+
+    def delete(self, index, **params):
+        with self.client._lock:
+            for memory_index in self.client._resolve_indices(index):
+                del self.client._indices[memory_index.name]
+            return {'acknowledged': True}
+
+    def refresh(self, index=None, **params):
+        with self.client._lock:
+            for memory_index in self.client._resolve_indices(index):
+                memory_index.refresh()
+            return {'_shards': {'total': 1, 'successful': 1, 'failed': 0}}
+
+    def put_mapping(self, doc_type, body, index=None, **params):
+        with self.client._lock:
+            mapping = body.get(doc_type, body)
+            for memory_index in self.client._resolve_indices(index):
+                memory_index.put_mapping(doc_type, mapping)
+            return {'acknowledged': True}
+
+    def get_mapping(self, index=None, doc_type=None, **params):
+        with self.client._lock:
+            doc_types = _as_names(doc_type)
+            result = {}
+            for memory_index in self.client._resolve_indices(index):
+                result[memory_index.name] = {'mappings': {
+                    x: _copy(y) for x, y in memory_index.mappings.items() if not doc_types or x in doc_types
+                }}
+            return result
+
+    def put_settings(self, body, index=None, **params):
+        with self.client._lock:
+            for memory_index in self.client._resolve_indices(index):
+                memory_index.put_settings(body)
+            return {'acknowledged': True}
+
+    def get_settings(self, index=None, name=None, **params):
+        with self.client._lock:
+            return {x.name: {'settings': {'index': _stringify_settings(x.settings)}}
+                    for x in self.client._resolve_indices(index)}
+
+    def get_alias(self, index=None, name=None, **params):
+        with self.client._lock:
+            names = _as_names(name)
+            result = {}
+            for memory_index in self.client._resolve_indices(index):
+                aliases = [x for x in sorted(memory_index.aliases)
+                           if not names or [y for y in names if fnmatch.fnmatchcase(x, y)]]
+                if aliases or not names:
+                    result[memory_index.name] = {'aliases': {x: {} for x in aliases}}
+            if names and not result:
+                _raise(NotFoundError, 404, 'alias [%s] missing' % name)
+            return result
+
+    def exists_alias(self, index=None, name=None, **params):
+        try:
+            self.get_alias(index=index, name=name)
+        except NotFoundError:
+            return False
+        return True
+
+    def update_aliases(self, body, **params):
+        """
+        Add and remove aliases atomically. Nothing is changed if any action fails.
+        """
+        with self.client._lock:
+            aliases = {x: set(y.aliases) for x, y in self.client._indices.items()}
+            for action in body.get('actions', []):
+                (operation, options), = action.items()
+                indices = _as_names(options.get('indices', options.get('index')))
+                names = _as_names(options.get('aliases', options.get('alias')))
+                for memory_index in self.client._resolve_indices(indices):
+                    for name in names:
+                        if operation == 'add':
+                            if name in self.client._indices:
+                                _raise(RequestError, 400, 'InvalidAliasNameException[[%s] an index exists with the '
+                                                          'same name as the alias]' % name)
+                            aliases[memory_index.name].add(name)
+                        elif operation == 'remove':
+                            if name not in aliases[memory_index.name]:
+                                _raise(NotFoundError, 404, 'AliasesMissingException[aliases [[%s]] missing]' % name)
+                            aliases[memory_index.name].discard(name)
+                        else:
+                            _raise(RequestError, 400, 'ElasticsearchIllegalArgumentException[Unsupported action '
+                                                      '[%s]]' % operation)
+            for index_name, index_aliases in aliases.items():
+                self.client._indices[index_name].aliases = index_aliases
+            return {'acknowledged': True}
+
+
+# ---------------------------------------------------------
+# The asyncio client
+# ---------------------------------------------------------
+class AsyncMemoryProxy(object):
+    """
+    Expose methods of the in-memory client as coroutines.
+    """
+    def __init__(self, target):
+        self.target = target
+
+    def __getattr__(self, name):
+        method = getattr(self.target, name)
+
+        async def call(*args, **kwargs):
+            return method(*args, **kwargs)
+        return call
+
+
+class AsyncMemoryElasticsearch(AsyncMemoryProxy):
+    """
+    The asyncio client of the in-memory engine. It shares documents with the synchronous client.
+    """
+    def __init__(self, client):
+        """
+        :param client: {MemoryElasticsearch}
+        """
+        super(AsyncMemoryElasticsearch, self).__init__(client)
+        self.indices = AsyncMemoryProxy(client.indices)
+
+    async def close(self):
+        pass
+
+    async def aclose(self):
+        pass
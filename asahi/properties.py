@@ -1,30 +1,88 @@
 from datetime import datetime
+from elasticsearch.serializer import JSONSerializer
 from .exceptions import BadValueError
 
 
+serializer = JSONSerializer()
+
+
+# The analysis settings of the index for StringProperty(searchable='substring').
+# Values are indexed as 1~3 grams. The query is split to 3 grams, so every gram of the query is a term of the index.
+SUBSTRING_ANALYSIS = {
+    'tokenizer': {
+        'asahi_ngram': {
+            'type': 'nGram',
+            'min_gram': 1,
+            'max_gram': 3,
+            'token_chars': ['letter', 'digit'],
+        },
+        'asahi_trigram': {
+            'type': 'nGram',
+            'min_gram': 3,
+            'max_gram': 3,
+            'token_chars': ['letter', 'digit'],
+        },
+    },
+    'analyzer': {
+        'asahi_ngram': {
+            'type': 'custom',
+            'tokenizer': 'asahi_ngram',
+            'filter': ['lowercase'],
+        },
+        'asahi_ngram_search': {
+            'type': 'custom',
+            'tokenizer': 'asahi_trigram',
+            'filter': ['lowercase'],
+        },
+    },
+}
+
 class Property(object):
-    def __init__(self, default=None, required=False):
+    # The value is indexed as one term, so the query can match it with term/terms/range filters.
+    exact_match = False
+    # The field type of the ElasticSearch mapping.
+    mapping_type = 'string'
+
+    def __init__(self, default=None, required=False, deferred=False,
+                 index=True, doc_values=None, eager_global_ordinals=False):
         """
         Init the Property.
         :param default: The default value.
         :param required: {bool} Is this failed required?
+        :param deferred: {bool} Don't fetch this property with get() or fetch() unless it is asked for.
+            It is loaded when it is accessed.
+        :param index: {bool} Is the value indexed? The property which is not indexed can't be queried.
+        :param doc_values: {bool} Keep values on the disk for sorting and aggregations instead of the heap.
+            None is the default of ElasticSearch.
+        :param eager_global_ordinals: {bool} Build global ordinals on refresh for the property used by group_by().
         :return:
         """
         self.document_class = None
         self.name = None
         self.default = default
         self.required=required
+        self.deferred = deferred
+        self.index = index
+        self.doc_values = doc_values
+        self.eager_global_ordinals = eager_global_ordinals
 
     def __get__(self, document_instance, document_class):
         if document_instance is None:
             return self
 
+        self._load(document_instance)
+        # the decoded value is cached until the property is set again
+        decoded = document_instance._decoded
+        if self.name in decoded:
+            return decoded[self.name]
         value = document_instance._document.get(self.name)
-        if value is None:
-            return None
-        return self._to_python(value)
+        if value is not None:
+            value = self._to_python(value)
+        decoded[self.name] = value
+        return value
 
     def __set__(self, document_instance, value):
+        self._mark_set(document_instance)
         if value is None:
             if self.required:
                 raise BadValueError('%s is required' % self.name)
@@ -32,6 +90,69 @@ class Property(object):
         else:
             document_instance._document[self.name] = self._to_json(value)
 
+    def get_mapping(self):
+        """
+        Get the mapping of this property for ElasticSearch.
+        :return: {dict or None} None is the dynamic mapping.
+        """
+        mapping = {'type': self.mapping_type}
+        if not self.index:
+            mapping['index'] = 'no'
+        if self.doc_values is not None:
+            mapping['doc_values'] = self.doc_values
+        if self.eager_global_ordinals:
+            mapping['fielddata'] = {'loading': 'eager_global_ordinals'}
+        return mapping
+
+    def _load(self, document_instance):
+        """
+        Load the value if it was deferred when the document was fetched.
+        :param document_instance: {Document}
+        """
+        if document_instance._deferred and self.name in document_instance._deferred:
+            document_instance._load_deferred([self.name])
+
+    def _mark_set(self, document_instance):
+        """
+        The value of the property is replaced.
+        Drop the decoded value and the deferred mark.
+        :param document_instance: {Document}
+        """
+        document_instance._decoded.pop(self.name, None)
+        document_instance._deferred.discard(self.name)
+        self._mark_dirty(document_instance)
+
+    def _mark_dirty(self, document_instance):
+        """
+        The value of the property should be written by the next save().
+        :param document_instance: {Document}
+        """
+        if document_instance._dirty is not None:
+            document_instance._dirty.add(self.name)
+
+    def _take_snapshot(self, document_instance):
+        """
+        Keep the serialized value of the stored document before the value is returned,
+        because it could be changed in place. The next save() compares it to find the change.
+        :param document_instance: {Document}
+        """
+        if document_instance._dirty is None:
+            return
+        if document_instance._snapshots is None:
+            document_instance._snapshots = {}
+        elif self.name in document_instance._snapshots:
+            return
+        document_instance._snapshots[self.name] = self._dump_snapshot(document_instance._document.get(self.name))
+
+    @staticmethod
+    def _dump_snapshot(value):
+        """
+        Serialize the value for the snapshot.
+        :param value: The json value of the property.
+        :return: {string}
+        """
+        return serializer.dumps(value)
+
     def __property_config__(self, document_class, property_name):
         """
         Setup the property.
@@ -59,26 +180,78 @@ class Property(object):
         return str(value)
 
 class StringProperty(Property):
+    substring_field = 'ngram'  # the sub field name for searchable='substring'
     _to_python = str
     _to_json = str
 
+    def __init__(self, *args, analyzed=True, searchable=None, **kwargs):
+        """
+        Init the string property.
+        :param analyzed: {bool} Is the value analyzed for the full text search?
+            The not analyzed value is matched exactly by equal and contains.
+        :param searchable: {string} 'substring': index the ngram sub field, so like and unlike don't scan all terms.
+        """
+        super(StringProperty, self).__init__(*args, **kwargs)
+        if searchable not in (None, 'substring'):
+            raise ValueError('searchable should be None or "substring"')
+        self.analyzed = analyzed
+        self.exact_match = not analyzed
+        self.searchable = searchable
+
+    def get_mapping(self):
+        """
+        Get the mapping of this property for ElasticSearch.
+        :return: {dict}
+        """
+        mapping = super(StringProperty, self).get_mapping()
+        if self.index and not self.analyzed:
+            mapping['index'] = 'not_analyzed'
+        if self.searchable == 'substring':
+            mapping['fields'] = {
+                self.substring_field: {
+                    'type': 'string',
+                    'analyzer': 'asahi_ngram',
+                    'search_analyzer': 'asahi_ngram_search',
+                },
+            }
+        return mapping
+
 class IntegerProperty(Property):
+    exact_match = True
+    mapping_type = 'long'
     _to_python = int
     _to_json = int
 
 class FloatProperty(Property):
+    exact_match = True
+    mapping_type = 'double'
     _to_python = float
     _to_json = float
 
 class BooleanProperty(Property):
+    exact_match = True
+    mapping_type = 'boolean'
     _to_python = bool
     _to_json = bool
 
 class DateTimeProperty(Property):
+    exact_match = True
+    mapping_type = 'date'
+    mapping_format = 'dateOptionalTime'  # yyyy-MM-ddTHH:mm:ssZ of _to_json()
+
     def __init__(self, auto_now=False, *args, **kwargs):
         super(DateTimeProperty, self).__init__(*args, **kwargs)
         self.auto_now = auto_now
 
+    def get_mapping(self):
+        """
+        Get the mapping of this property for ElasticSearch.
+        :return: {dict}
+        """
+        mapping = super(DateTimeProperty, self).get_mapping()
+        mapping['format'] = self.mapping_format
+        return mapping
+
     @classmethod
     def _to_python(cls, value):
         """
@@ -121,19 +294,49 @@ class ListProperty(Property):
         if item_type not in [str, int, float, bool, datetime] and not issubclass(item_type, dict):
             raise ValueError('Item type %s is not acceptable' % item_type.__name__)
         self.item_type = item_type
+        self.exact_match = item_type in [int, float, bool, datetime]
+
+    def get_mapping(self):
+        """
+        Get the mapping of items for ElasticSearch. ElasticSearch doesn't have the list type.
+        :return: {dict}
+        """
+        if issubclass(self.item_type, dict):
+            return {'type': 'object', 'enabled': self.index}
+        mapping = super(ListProperty, self).get_mapping()
+        mapping['type'] = {
+            str: 'string',
+            int: 'long',
+            float: 'double',
+            bool: 'boolean',
+            datetime: 'date',
+        }[self.item_type]
+        if self.item_type is datetime:
+            mapping['format'] = DateTimeProperty.mapping_format
+        return mapping
 
     def __get__(self, document_instance, document_class):
         if document_instance is None:
             return self
+        self._load(document_instance)
         if document_instance._document.get(self.name) is None:
             return None
+        # the list could be changed in place
+        self._take_snapshot(document_instance)
         if self.item_type is dict:
             return document_instance._document[self.name]
-        elif issubclass(self.item_type, dict):
-            return [self.item_type(**x) for x in document_instance._document[self.name]]
-        return ListProxy(document_instance._document, self.name, self.item_type)
+        decoded = document_instance._decoded
+        if self.name not in decoded:
+            if issubclass(self.item_type, dict):
+                # replace the stored items, so changes of items are saved
+                items = [self.item_type(**x) for x in document_instance._document[self.name]]
+                document_instance._document[self.name] = decoded[self.name] = items
+            else:
+                decoded[self.name] = ListProxy(document_instance._document, self.name, self.item_type)
+        return decoded[self.name]
 
     def __set__(self, document_instance, value):
+        self._mark_set(document_instance)
         if self.item_type is datetime:
             document_instance._document[self.name] = [DateTimeProperty._to_json(x) for x in value]
         elif issubclass(self.item_type, dict):
@@ -155,12 +358,25 @@ class DictProperty(Property):
         """
         super(DictProperty, self).__init__(*args, **kwargs)
 
+    def get_mapping(self):
+        """
+        Get the mapping of this property for ElasticSearch.
+        Fields in the dict are mapped dynamically.
+        :return: {dict}
+        """
+        return {'type': 'object', 'enabled': self.index}
+
     def __get__(self, document_instance, document_class):
         if document_instance is None:
             return self
+        self._load(document_instance)
+        if document_instance._document.get(self.name) is not None:
+            # the dict could be changed in place
+            self._take_snapshot(document_instance)
         return document_instance._document[self.name]
 
     def __set__(self, document_instance, value):
+        self._mark_set(document_instance)
         document_instance._document[self.name] = value
 
 class ReferenceProperty(Property):
@@ -172,12 +388,27 @@ class ReferenceProperty(Property):
             raise TypeError('Reference class should be Document')
         self.reference_class = reference_class
 
+    def get_mapping(self):
+        """
+        Get the mapping of this property for ElasticSearch. The reference id is not analyzed.
+        :return: {dict}
+        """
+        mapping = super(ReferenceProperty, self).get_mapping()
+        if self.index:
+            mapping['index'] = 'not_analyzed'
+        return mapping
+
     def __get__(self, document_instance, document_class):
         if document_instance is None:
             return self
-        return document_instance._reference_document.get(self.name) or document_instance._document.get(self.name)
+        self._load(document_instance)
+        if self.name in document_instance._reference_document:
+            # the resolved document, None if the reference is not found
+            return document_instance._reference_document[self.name]
+        return document_instance._document.get(self.name)
 
     def __set__(self, document_instance, value):
+        self._mark_set(document_instance)
         if value is None:
             if self.required:
                 raise BadValueError('%s is required' % self.name)
@@ -186,6 +417,7 @@ class ReferenceProperty(Property):
         elif isinstance(value, str):
             # set reference id
             document_instance._document[self.name] = value
+            document_instance._reference_document.pop(self.name, None)
         else:
             if not isinstance(value, self.reference_class):
                 raise ValueError('Value should be %s' % self.document_class)
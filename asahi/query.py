@@ -1,7 +1,15 @@
 import re
+import threading
+import warnings
+from collections import OrderedDict
 from datetime import datetime
-from .deep_query import update_reference_properties
-from .exceptions import NotFoundError, PropertyNotExist, QuerySyntaxError
+from concurrent.futures import ThreadPoolExecutor
+from . import utils
+from .deep_query import update_reference_properties, aupdate_reference_properties
+from .batch import QuerySpec
+from .aggregations import generate_aggregations_body, parse_aggregations_response
+from .properties import StringProperty
+from .exceptions import NotFoundError, PropertyNotExist, QuerySyntaxError, LeadingWildcardWarning
 
 
 class QueryOperation(object):
@@ -35,6 +43,103 @@ class QueryCell(object):
         self.sub_queries = sub_queries
 
 
+class QueryParameter(object):
+    """
+    The placeholder of the value in the compiled query template.
+    """
+    __slots__ = ('index', 'convert')
+
+    def __init__(self, index, convert=None):
+        """
+        :param index: {int} The index of the value in query parameters.
+        :param convert: {function} Convert the value when it is bound.
+        """
+        self.index = index
+        self.convert = convert
+
+    def derive(self, convert):
+        """
+        Get the parameter of the same value with one more conversion.
+        :param convert: {function}
+        :return: {QueryParameter}
+        """
+        if self.convert is None:
+            return QueryParameter(self.index, convert)
+        previous = self.convert
+        return QueryParameter(self.index, lambda x: convert(previous(x)))
+
+
+
+class QueryTemplate(object):
+    """
+    The elastic search query which has QueryParameters, values are bound to it without compiling asahi queries again.
+    Dicts and lists of the template are prepared in post-order, so binding copies each of them once
+    and fills nested nodes and QueryParameters without recursion.
+    """
+    __slots__ = ('nodes',)
+
+    def __init__(self, template):
+        """
+        :param template: {dict or list} The elastic search query which has QueryParameters.
+        """
+        self.nodes = []  # [({dict or list} the copy of scalar and constant items, [(key or index, kind, reference)])]
+        self.__prepare(template)
+
+    def __prepare(self, node):
+        """
+        Prepare the dict or the list of the template and its children.
+        :param node: {dict or list}
+        :return: {int} The index of the prepared node in self.nodes.
+        """
+        items = node.copy()
+        others = []
+        for key, value in (node.items() if type(node) is dict else enumerate(node)):
+            if type(value) in (dict, list):
+                items[key] = None
+                others.append((key, 0, self.__prepare(value)))
+            elif type(value) is QueryParameter:
+                items[key] = None
+                others.append((key, 1, value))
+        self.nodes.append((items, others))
+        return len(self.nodes) - 1
+
+    def bind(self, values):
+        """
+        Build the elastic search query from values.
+        :param values: {list} The values of query parameters.
+        :return: {dict or list} The new elastic search query.
+        """
+        built = []
+        for items, others in self.nodes:
+            result = items.copy()
+            for key, kind, reference in others:
+                if kind == 0:
+                    result[key] = built[reference]
+                elif reference.convert is None:
+                    result[key] = values[reference.index]
+                else:
+                    result[key] = reference.convert(values[reference.index])
+            built.append(result)
+        return built[-1]
+
+
+_query_templates = OrderedDict()  # {query shape: ({QueryTemplate or None}, {QueryTemplate}, {tuple})} The LRU cache.
+_query_templates_lock = threading.Lock()
+QUERY_TEMPLATES_LIMIT = 1024
+_operation_codes = {
+    'equal': QueryOperation.equal,
+    'unequal': QueryOperation.unequal,
+    'less': QueryOperation.less,
+    'less_equal': QueryOperation.less_equal,
+    'greater': QueryOperation.greater,
+    'greater_equal': QueryOperation.greater_equal,
+    'like': QueryOperation.like,
+    'unlike': QueryOperation.unlike,
+    'contains': QueryOperation.contains,
+    'among': QueryOperation.contains,
+}
+
+
 class Query(object):
     """
     An asahi query object.
@@ -42,6 +147,9 @@ class Query(object):
     def __init__(self, document_class):
         self.contains_empty = False
         self.document_class = document_class
+        self.only_members = None
+        self.deferred_members = set()
+        self.scoring = None  # None: documents are scored unless the query is sorted by order_by()
         self.items = [
             QueryCell(QueryOperation.all)
         ]
@@ -140,6 +248,20 @@ class Query(object):
             ))
         return self
 
+    def filter(self, *args, **kwargs):
+        """
+        Intersect the query in the filter context.
+        Documents are not scored, so ElasticSearch caches filters of exact match properties.
+        The whole query is compiled in the filter context. It is the default when the query has order_by().
+        :param args: The same as intersect(). It could be empty to only switch the context.
+        :param kwargs: The same as intersect().
+        :return: {asahi.query.Query}
+        """
+        self.scoring = False
+        if args:
+            return self.intersect(*args, **kwargs)
+        return self
+
     def order_by(self, member, descending=False):
         """
         Append the order query.
@@ -160,14 +282,36 @@ class Query(object):
         return self
 
 
+    def only(self, *members):
+        """
+        Only fetch these properties. The others are deferred and loaded when they are accessed.
+        :param members: {string} The property names of the document.
+        :return: {asahi.query.Query}
+        """
+        self.document_class._get_source_filter(only=members)  # validate members
+        self.only_members = set(members)
+        return self
+
+    def defer(self, *members):
+        """
+        Don't fetch these properties. They are loaded when they are accessed.
+        :param members: {string} The property names of the document.
+        :return: {asahi.query.Query}
+        """
+        self.document_class._get_source_filter(defer=members)  # validate members
+        self.deferred_members |= set(members)
+        return self
+
+
     # -----------------------------------------------------
     # The methods for fetch documents by the query.
     # -----------------------------------------------------
-    def fetch(self, limit=1000, skip=0, fetch_reference=True):
+    def fetch(self, limit=1000, skip=0, fetch_reference=True, include=None):
         """
         Fetch documents by the query.
         :param limit: {int} The size of the pagination. (The limit of the result items.)
         :param skip: {int} The offset of the pagination. (Skip x items.)
+        :param include: {list} Only resolve these reference paths. ['author', 'author.company']
         :returns: {tuple}
             ({list}[{Document}], {int}total)
             The documents.
@@ -177,76 +321,125 @@ class Query(object):
             return [], 0
 
         es = self.document_class._es
-        def __search():
-            return es.search(
-                index=self.document_class.get_index_name(),
-                body=self.__generate_elasticsearch_search_body(self.items, limit, skip),
-                version=True
-            )
-        try:
-            search_result = __search()
-        except NotFoundError as e:
-            if 'IndexMissingException' in str(e):  # try to create index
-                es.indices.create(index=self.document_class.get_index_name())
-                search_result = __search()
-            else:
-                raise e
+        source_params, deferred = self.document_class._get_source_filter(self.only_members, self.deferred_members)
+        self.document_class.ensure_index()
+        search_result = es.search(
+            index=self.document_class.get_index_name(),
+            body=self.__generate_elasticsearch_search_body(self.items, limit, skip),
+            version=True,
+            **source_params
+        )
 
-        result = []
-        for hits in search_result['hits']['hits']:
-            result.append(self.document_class(_id=hits['_id'], _version=hits['_version'], **hits['_source']))
-        if fetch_reference:
-            update_reference_properties(result)
+        result = self.__build_documents(search_result, deferred)
+        if fetch_reference or include is not None:
+            update_reference_properties(result, include)
         return result, search_result['hits']['total']
 
-    def first(self, fetch_reference=True):
+    def iter(self, batch_size=100, fetch_reference=True, scroll='1m', include=None):
+        """
+        Iterate documents by the query with the scroll api.
+        The next batch is fetched in the background while the caller processes the current batch.
+        The scroll context is cleared when the iteration is finished, closed or garbage collected.
+        :param batch_size: {int} The number of documents of each request.
+        :param fetch_reference: {bool} Update reference properties of each batch.
+        :param scroll: {string} How long ElasticSearch keeps the scroll context between requests.
+        :param include: {list} Only resolve these reference paths. ['author', 'author.company']
+        :return: {generator} [{Document}]
+        """
+        if self.contains_empty:
+            return
+
+        es = self.document_class._es
+        source_params, deferred = self.document_class._get_source_filter(self.only_members, self.deferred_members)
+        self.document_class.ensure_index()
+        search_result = es.search(
+            index=self.document_class.get_index_name(),
+            body=self.__generate_elasticsearch_search_body(self.items, batch_size, 0),
+            scroll=scroll,
+            version=True,
+            **source_params
+        )
+
+        scroll_id = search_result.get('_scroll_id')
+        executor = ThreadPoolExecutor(max_workers=1)
+        next_batch = None
+        try:
+            while search_result['hits']['hits']:
+                scroll_id = search_result.get('_scroll_id', scroll_id)
+                if len(search_result['hits']['hits']) < batch_size:
+                    next_batch = None
+                else:
+                    # prefetch the next batch
+                    next_batch = executor.submit(es.scroll, scroll_id=scroll_id, scroll=scroll)
+                documents = self.__build_documents(search_result, deferred)
+                if fetch_reference or include is not None:
+                    update_reference_properties(documents, include)
+                for document in documents:
+                    yield document
+                if next_batch is None:
+                    break
+                search_result = next_batch.result()
+        finally:
+            executor.shutdown(wait=True)
+            if next_batch is not None and not next_batch.cancelled() and next_batch.exception() is None:
+                scroll_id = next_batch.result().get('_scroll_id', scroll_id)
+            if scroll_id:
+                try:
+                    es.clear_scroll(scroll_id=scroll_id)
+                except NotFoundError:
+                    pass  # the scroll context was expired
+
+    def first(self, fetch_reference=True, include=None):
         """
         Fetch the first document.
+        :param include: {list} Only resolve these reference paths. ['author', 'author.company']
         :return: {asahi.document.Document or None}
         """
-        documents, total = self.fetch(1, 0, fetch_reference=fetch_reference)
+        documents, total = self.fetch(1, 0, fetch_reference=fetch_reference, include=include)
         if total == 0:
             return None
         else:
             return documents[0]
 
-    def count(self):
+    def exists(self):
+        """
+        Is there any document matched by the query?
+        ElasticSearch stops searching after the first matched document.
+        :return: {bool}
+        """
+        if self.contains_empty:
+            return False
+        return self.count(upto=1) > 0
+
+    def count(self, upto=None):
         """
         Count documents by the query.
-        :return: {int}
+        :param upto: {int} Stop counting after x documents are matched. (for "99+" badges)
+        :return: {int} It is not greater than upto.
         """
         if self.contains_empty:
             return 0
 
-        query, _ = self.__compile_queries(self.items)
         es = self.document_class._es
+        self.document_class.ensure_index()
+        if upto is not None:
+            search_result = es.search(
+                index=self.document_class.get_index_name(),
+                body=self.__generate_count_body(),
+                terminate_after=upto,
+            )
+            return min(search_result['hits']['total'], upto)
+
+        query, _ = self.__compile_queries(self.items, filter_context=True)
         if query is None:
-            def __count():
-                return es.count(self.document_class.get_index_name())
-            try:
-                count_result = __count()
-            except NotFoundError as e:
-                if 'IndexMissingException' in str(e):  # try to create index
-                    es.indices.create(index=self.document_class.get_index_name())
-                    count_result = __count()
-                else:
-                    raise e
+            count_result = es.count(self.document_class.get_index_name())
         else:
-            def __count():
-                return es.count(
-                    index=self.document_class.get_index_name(),
-                    body={
-                        'query': query
-                    },
-                )
-            try:
-                count_result = __count()
-            except NotFoundError as e:
-                if 'IndexMissingException' in str(e):  # try to create index
-                    es.indices.create(index=self.document_class.get_index_name())
-                    count_result = __count()
-                else:
-                    raise e
+            count_result = es.count(
+                index=self.document_class.get_index_name(),
+                body={
+                    'query': query
+                },
+            )
         return count_result['count']
 
     def group_by(self, member, limit=10, descending=True):
@@ -263,43 +456,209 @@ class Query(object):
                 key: 'term'
             }
         """
-        if member.split('.', 1)[0] not in self.document_class.get_properties().keys():
-            raise PropertyNotExist('%s not in %s' % (member, self.document_class.__name__))
+        query_body = self.__generate_group_by_body(member, limit, descending)
         es = self.document_class._es
-        es_query, sort_items = self.__compile_queries(self.items)
-        query_body = {
-            'size': 0,
-            'aggs': {
-                'group': {
-                    'terms': {
-                        'field': member,
-                        'size': limit,
-                        'order': {
-                            '_count': 'desc' if descending else 'asc'
-                        }
-                    }
-                }
-            }
-        }
-        if es_query:
-            query_body['query'] = es_query
+        self.document_class.ensure_index()
+        search_result = es.search(
+            index=self.document_class.get_index_name(),
+            body=query_body,
+        )
+
+        return search_result['aggregations']['group']['buckets']
+
+    def aggregate(self, **aggregations):
+        """
+        Run many aggregations in one request.
+        :param aggregations: {name: {asahi.aggregations.Aggregation}}
+        :return: {dict} {name: result}
+            Terms, DateHistogram: {list}[{Bucket}] bucket.key, bucket.doc_count, bucket['sub aggregation']
+            Sum, Avg, Min, Max: {float or None}
+            Stats: {dict} {'count', 'min', 'max', 'avg', 'sum'}
+            Percentiles: {dict} {{float}percent: {float}value}
+            Cardinality: {int}
+        """
+        query_body = self.__generate_aggregate_body(aggregations)
+        es = self.document_class._es
+        self.document_class.ensure_index()
+        search_result = es.search(
+            index=self.document_class.get_index_name(),
+            body=query_body,
+        )
+
+        return parse_aggregations_response(self.document_class, aggregations, search_result.get('aggregations', {}))
+
+
+    # -----------------------------------------------------
+    # The methods for the multi-search. (asahi.msearch)
+    # -----------------------------------------------------
+    def fetch_spec(self, limit=1000, skip=0, fetch_reference=True, include=None):
+        """
+        The spec of fetch() for asahi.msearch().
+        :param limit: {int} The size of the pagination. (The limit of the result items.)
+        :param skip: {int} The offset of the pagination. (Skip x items.)
+        :param fetch_reference: {bool} Update reference properties of documents.
+        :param include: {list} Only resolve these reference paths. ['author', 'author.company']
+        :return: {asahi.batch.QuerySpec} The result is ({list}[{Document}], {int}total).
+        """
+        if self.contains_empty:
+            return QuerySpec(self, 'fetch', result=([], 0))
 
-        def __search():
-            return es.search(
+        source_params, deferred = self.document_class._get_source_filter(self.only_members, self.deferred_members)
+        body = self.__generate_elasticsearch_search_body(self.items, limit, skip)
+        body['version'] = True
+        if '_source_include' in source_params:
+            body['_source'] = {'include': source_params['_source_include']}
+        elif '_source_exclude' in source_params:
+            body['_source'] = {'exclude': source_params['_source_exclude']}
+        return QuerySpec(self, 'fetch', body=body, fetch_reference=fetch_reference, deferred=deferred, include=include)
+
+    def count_spec(self):
+        """
+        The spec of count() for asahi.msearch().
+        :return: {asahi.batch.QuerySpec} The result is {int}.
+        """
+        if self.contains_empty:
+            return QuerySpec(self, 'count', result=0)
+
+        return QuerySpec(self, 'count', body=self.__generate_count_body())
+
+    def group_by_spec(self, member, limit=10, descending=True):
+        """
+        The spec of group_by() for asahi.msearch().
+        :param member: {string} The property name of the document.
+        :param limit: {int} The number of returns.
+        :param descending: {bool} Is sorted by descending?
+        :return: {asahi.batch.QuerySpec} The result is {list}[{dict}].
+        """
+        return QuerySpec(self, 'group_by', body=self.__generate_group_by_body(member, limit, descending))
+
+    def aggregate_spec(self, **aggregations):
+        """
+        The spec of aggregate() for asahi.msearch().
+        :param aggregations: {name: {asahi.aggregations.Aggregation}}
+        :return: {asahi.batch.QuerySpec} The result is {dict} {name: result}.
+        """
+        return QuerySpec(self, 'aggregate', body=self.__generate_aggregate_body(aggregations), aggregations=aggregations)
+
+
+    # -----------------------------------------------------
+    # The asyncio methods for fetch documents by the query.
+    # -----------------------------------------------------
+    async def afetch(self, limit=1000, skip=0, fetch_reference=True, include=None):
+        """
+        Fetch documents by the query with asyncio.
+        :param limit: {int} The size of the pagination. (The limit of the result items.)
+        :param skip: {int} The offset of the pagination. (Skip x items.)
+        :param include: {list} Only resolve these reference paths. ['author', 'author.company']
+        :returns: {tuple}
+            ({list}[{Document}], {int}total)
+            The documents.
+            The total items.
+        """
+        if self.contains_empty:
+            return [], 0
+
+        es = self.document_class._async_es
+        source_params, deferred = self.document_class._get_source_filter(self.only_members, self.deferred_members)
+        await self.document_class.aensure_index()
+        search_result = await es.search(
+            index=self.document_class.get_index_name(),
+            body=self.__generate_elasticsearch_search_body(self.items, limit, skip),
+            version=True,
+            **source_params
+        )
+
+        result = self.__build_documents(search_result, deferred)
+        if fetch_reference or include is not None:
+            await aupdate_reference_properties(result, include)
+        return result, search_result['hits']['total']
+
+    async def afirst(self, fetch_reference=True, include=None):
+        """
+        Fetch the first document with asyncio.
+        :param include: {list} Only resolve these reference paths. ['author', 'author.company']
+        :return: {asahi.document.Document or None}
+        """
+        documents, total = await self.afetch(1, 0, fetch_reference=fetch_reference, include=include)
+        if total == 0:
+            return None
+        else:
+            return documents[0]
+
+    async def aexists(self):
+        """
+        Is there any document matched by the query with asyncio?
+        :return: {bool}
+        """
+        if self.contains_empty:
+            return False
+        return await self.acount(upto=1) > 0
+
+    async def acount(self, upto=None):
+        """
+        Count documents by the query with asyncio.
+        :param upto: {int} Stop counting after x documents are matched.
+        :return: {int}
+        """
+        if self.contains_empty:
+            return 0
+
+        es = self.document_class._async_es
+        await self.document_class.aensure_index()
+        if upto is not None:
+            search_result = await es.search(
                 index=self.document_class.get_index_name(),
-                body=query_body,
+                body=self.__generate_count_body(),
+                terminate_after=upto,
             )
-        try:
-            search_result = __search()
-        except NotFoundError as e:
-            if 'IndexMissingException' in str(e):  # try to create index
-                es.indices.create(index=self.document_class.get_index_name())
-                search_result = __search()
-            else:
-                raise e
+            return min(search_result['hits']['total'], upto)
+
+        query, _ = self.__compile_queries(self.items, filter_context=True)
+        count_result = await es.count(
+            index=self.document_class.get_index_name(),
+            body={'query': query} if query else None,
+        )
+        return count_result['count']
+
+    async def agroup_by(self, member, limit=10, descending=True):
+        """
+        Aggregations with asyncio.
+        :param member: {string} The property name of the document.
+        :param limit: {int} The number of returns.
+        :param descending: {bool} Is sorted by descending?
+        :returns: {list}
+            {list}[{dict}]
+            {
+                doc_count: {int},
+                key: 'term'
+            }
+        """
+        query_body = self.__generate_group_by_body(member, limit, descending)
+        es = self.document_class._async_es
+        await self.document_class.aensure_index()
+        search_result = await es.search(
+            index=self.document_class.get_index_name(),
+            body=query_body,
+        )
 
         return search_result['aggregations']['group']['buckets']
 
+    async def aaggregate(self, **aggregations):
+        """
+        Run many aggregations in one request with asyncio.
+        :param aggregations: {name: {asahi.aggregations.Aggregation}}
+        :return: {dict} {name: result}
+        """
+        query_body = self.__generate_aggregate_body(aggregations)
+        es = self.document_class._async_es
+        await self.document_class.aensure_index()
+        search_result = await es.search(
+            index=self.document_class.get_index_name(),
+            body=query_body,
+        )
+
+        return parse_aggregations_response(self.document_class, aggregations, search_result.get('aggregations', {}))
+
 
     # -----------------------------------------------------
     # Private methods.
@@ -323,14 +682,181 @@ class Query(object):
             result['query'] = es_query
         return result
 
-    def __compile_queries(self, queries):
+    def __generate_count_body(self):
+        """
+        Generate the elastic search search body which doesn't fetch hits.
+        :return: {dict} The elastic search search body
+        """
+        query, _ = self.__compile_queries(self.items, filter_context=True)
+        body = {'size': 0}
+        if query:
+            body['query'] = query
+        return body
+
+    def __generate_group_by_body(self, member, limit, descending):
+        """
+        Generate the elastic search search body for the group_by.
+        :param member: {string} The property name of the document.
+        :param limit: {int} The number of returns.
+        :param descending: {bool} Is sorted by descending?
+        :return: {dict} The elastic search search body
+        """
+        if member.split('.', 1)[0] not in self.document_class.get_properties().keys():
+            raise PropertyNotExist('%s not in %s' % (member, self.document_class.__name__))
+        es_query, _ = self.__compile_queries(self.items, filter_context=True)
+        query_body = {
+            'size': 0,
+            'aggs': {
+                'group': {
+                    'terms': {
+                        'field': member,
+                        'size': limit,
+                        'order': {
+                            '_count': 'desc' if descending else 'asc'
+                        }
+                    }
+                }
+            }
+        }
+        if es_query:
+            query_body['query'] = es_query
+        return query_body
+
+    def __generate_aggregate_body(self, aggregations):
+        """
+        Generate the elastic search search body for the aggregate.
+        :param aggregations: {dict} {name: {asahi.aggregations.Aggregation}}
+        :return: {dict} The elastic search search body
+        """
+        if not aggregations:
+            raise QuerySyntaxError('aggregate() needs at least one aggregation')
+        es_query, _ = self.__compile_queries(self.items, filter_context=True)
+        query_body = {
+            'size': 0,
+            'aggs': generate_aggregations_body(self.document_class, aggregations),
+        }
+        if es_query:
+            query_body['query'] = es_query
+        return query_body
+
+    def __build_documents(self, search_result, deferred=None):
+        """
+        Build documents by hits of the search result.
+        :param search_result: {dict} The response of the search.
+        :param deferred: {set} The names of deferred properties.
+        :return: {list} [{Document}]
+        """
+        result = []
+        for hits in search_result['hits']['hits']:
+            result.append(self.document_class._from_hit(hits, deferred))
+        return result
+
+    def __compile_queries(self, queries, filter_context=None):
         """
         Compile asahi query cells to the elastic search query.
+        The query is compiled once for each query shape, then values are bound to the template.
         :param queries: {list} The asahi query cells.
+        :param filter_context: {bool} Compile the query in the filter context which doesn't score documents.
+            The default is decided by self.scoring and order_by().
         :returns: {tuple} ({dict or None}, {list})
             The elastic search query dict.
             The elastic search sort list.
         """
+        if filter_context is None:
+            if self.scoring is None:
+                filter_context = any([x.operation & QueryOperation.order_desc == QueryOperation.order_desc
+                                      for x in queries])
+            else:
+                filter_context = not self.scoring
+        values = []
+        shape = (self.document_class, filter_context, self.__get_query_shape(queries, values))
+        with _query_templates_lock:
+            template = _query_templates.get(shape)
+            if template is not None:
+                _query_templates.move_to_end(shape)
+        if template is None:
+            parameterized_queries = self.__parameterize_queries(queries, [0])
+            query, sort_items = self.__compile_query_template(parameterized_queries, filter_context)
+            if filter_context and query is not None:
+                query = {
+                    'filtered': {
+                        'filter': query
+                    }
+                }
+            template = (
+                None if query is None else QueryTemplate(query),
+                QueryTemplate(sort_items),
+                self.__get_leading_wildcard_members(parameterized_queries),
+            )
+            with _query_templates_lock:
+                _query_templates[shape] = template
+                while len(_query_templates) > QUERY_TEMPLATES_LIMIT:
+                    _query_templates.popitem(last=False)
+        query, sort_items, leading_wildcard_members = template
+        if leading_wildcard_members:
+            self.__check_leading_wildcard(leading_wildcard_members)
+        return None if query is None else query.bind(values), sort_items.bind(values)
+
+    def __get_query_shape(self, queries, values):
+        """
+        Get the shape of asahi query cells. Queries with the same shape are compiled to the same template.
+        :param queries: {list} The asahi query cells.
+        :param values: {list} Values of query cells are appended into this list.
+        :return: {tuple} The hashable shape.
+        """
+        shape = []
+        for query in queries:
+            if query.sub_queries:
+                shape.append((query.operation, self.__get_query_shape(query.sub_queries, values)))
+            elif query.value is None:
+                shape.append((query.operation, query.member))
+            elif self.__is_values(query.value):
+                # the list is one parameter, so lists of any length have the same shape
+                values.append(list(query.value))
+                shape.append((query.operation, query.member, list))
+            else:
+                if isinstance(query.value, str):
+                    values.append(re.sub(r'[<>]', '', query.value))
+                else:
+                    values.append(query.value)
+                shape.append((query.operation, query.member, None))
+        return tuple(shape)
+
+    def __parameterize_queries(self, queries, counter):
+        """
+        Copy asahi query cells with QueryParameters instead of values.
+        It walks query cells in the same order as __get_query_shape().
+        :param queries: {list} The asahi query cells.
+        :param counter: {list} [{int}] The index of the next parameter.
+        :return: {list} The asahi query cells.
+        """
+        result = []
+        for query in queries:
+            if query.sub_queries:
+                result.append(QueryCell(
+                    query.operation,
+                    member=query.member,
+                    sub_queries=self.__parameterize_queries(query.sub_queries, counter),
+                ))
+                continue
+            if query.value is None:
+                value = None
+            else:
+                value = QueryParameter(counter[0])
+                counter[0] += 1
+            result.append(QueryCell(query.operation, member=query.member, value=value))
+        return result
+
+    def __compile_query_template(self, queries, filter_context=False):
+        """
+        Compile asahi query cells to the elastic search query.
+        :param queries: {list} The asahi query cells.
+        :param filter_context: {bool} Compile query cells to the elastic search filter.
+        :returns: {tuple} ({dict or None}, {list})
+            The elastic search query dict. (or the filter dict)
+            The elastic search sort list.
+        """
+        compile_query = self.__compile_filter if filter_context else self.__compile_query
         sort_items = []
         necessary_items = []
         optional_items = []
@@ -338,23 +864,21 @@ class Query(object):
         for query in queries:
             if query.sub_queries:
                 # compile sub queries
-                sub_query, sub_sort_items = self.__compile_queries(query.sub_queries)
+                sub_query, sub_sort_items = self.__compile_query_template(query.sub_queries, filter_context)
                 if sub_query and query.operation & QueryOperation.intersection == QueryOperation.intersection:
                     # intersect
                     necessary_items.append(sub_query)
                     last_item_is_necessary = True
             else:
-                if isinstance(query.value, str):
-                    query.value = re.sub(r'[<>]', '', query.value)
                 if query.operation & QueryOperation.intersection == QueryOperation.intersection:
                     # intersect
-                    query_item = self.__compile_query(query)
+                    query_item = compile_query(query)
                     if query_item:
                         necessary_items.append(query_item)
                         last_item_is_necessary = True
                 elif query.operation & QueryOperation.union == QueryOperation.union:
                     # union
-                    query_item = self.__compile_query(query)
+                    query_item = compile_query(query)
                     if query_item:
                         if last_item_is_necessary:
                             necessary_item = necessary_items.pop()
@@ -380,6 +904,17 @@ class Query(object):
                         }
                     })
 
+        if filter_context:
+            if len(necessary_items):
+                optional_items.append(necessary_items[0] if len(necessary_items) == 1 else {
+                    'bool': {
+                        'must': necessary_items,
+                    }
+                })
+            if len(optional_items) > 1:
+                return {'bool': {'should': optional_items}}, sort_items
+            return (optional_items[0] if optional_items else None), sort_items
+
         if len(necessary_items):
             optional_items.append({
                 'bool': {
@@ -404,6 +939,10 @@ class Query(object):
         :return: {dict} The elastic search query.
         """
         operation = query.operation & QueryOperation.normal_operation_mask
+        if operation & QueryOperation.unlike == QueryOperation.unlike:  # like or unlike
+            substring_query = self.__compile_substring_query(query)
+            if substring_query is not None:
+                return substring_query
         if operation & QueryOperation.like == QueryOperation.like:
             return {
                 'bool': {
@@ -418,7 +957,7 @@ class Query(object):
                         },
                         {
                             'regexp': {
-                                query.member: '.*%s.*' % query.value
+                                query.member: self.__convert_value(query.value, self.__convert_regexp_for_query)
                             }
                         },
                     ]
@@ -445,7 +984,7 @@ class Query(object):
                             'bool': {
                                 'must_not': {
                                     'regexp': {
-                                        query.member: '.*%s.*' % query.value
+                                        query.member: self.__convert_value(query.value, self.__convert_regexp_for_query)
                                     }
                                 }
                             }
@@ -456,54 +995,40 @@ class Query(object):
         elif operation & QueryOperation.contains == QueryOperation.contains:
             return {
                 'bool': {
-                    'should': [{'match': {query.member: {'query': x, 'operator': 'and'}}} for x in query.value],
+                    'should': self.__map_values(
+                        query.value, lambda x: {'match': {query.member: {'query': x, 'operator': 'and'}}}
+                    ),
                 }
             }
         elif operation & QueryOperation.greater_equal == QueryOperation.greater_equal:
-            if isinstance(query.value, datetime):
-                query_value = self.__convert_datetime_for_query(query.value)
-            else:
-                query_value = query.value
             return {
                 'range': {
                     query.member: {
-                        'gte': query_value
+                        'gte': self.__convert_value(query.value, self.__convert_range_for_query)
                     }
                 }
             }
         elif operation & QueryOperation.greater == QueryOperation.greater:
-            if isinstance(query.value, datetime):
-                query_value = self.__convert_datetime_for_query(query.value)
-            else:
-                query_value = query.value
             return {
                 'range': {
                     query.member: {
-                        'gt': query_value
+                        'gt': self.__convert_value(query.value, self.__convert_range_for_query)
                     }
                 }
             }
         elif operation & QueryOperation.less_equal == QueryOperation.less_equal:
-            if isinstance(query.value, datetime):
-                query_value = self.__convert_datetime_for_query(query.value)
-            else:
-                query_value = query.value
             return {
                 'range': {
                     query.member: {
-                        'lte': query_value
+                        'lte': self.__convert_value(query.value, self.__convert_range_for_query)
                     }
                 }
             }
         elif operation & QueryOperation.less == QueryOperation.less:
-            if isinstance(query.value, datetime):
-                query_value = self.__convert_datetime_for_query(query.value)
-            else:
-                query_value = query.value
             return {
                 'range': {
                     query.member: {
-                        'lt': query_value
+                        'lt': self.__convert_value(query.value, self.__convert_range_for_query)
                     }
                 }
             }
@@ -556,7 +1081,209 @@ class Query(object):
                     }
                 }
 
-    def __convert_datetime_for_query(self, date_time):
+    def __compile_substring_query(self, query):
+        """
+        Compile like and unlike to the query on the ngram sub field of StringProperty(searchable='substring').
+        The long value is matched by all of its 3 grams, the short value is one term of the sub field.
+        :param query: The asahi query cell.
+        :return: {dict or None} None if the member doesn't have the ngram sub field.
+        """
+        property = self.__get_property(query.member)
+        if not isinstance(property, StringProperty) or property.searchable != 'substring':
+            return None
+        field = '%s.%s' % (query.member, property.substring_field)
+        items = [
+            {
+                'match': {
+                    field: {
+                        'query': query.value,
+                        'operator': 'and',
+                    }
+                }
+            },
+            {
+                'term': {
+                    field: self.__convert_value(query.value, self.__convert_term_for_substring)
+                }
+            },
+        ]
+        if query.operation & QueryOperation.like == QueryOperation.like:
+            return {'bool': {'should': items}}
+        return {'bool': {'must_not': items}}
+
+    def __get_leading_wildcard_members(self, queries):
+        """
+        Get members of like and unlike query cells which are compiled to the leading wildcard regexp.
+        :param queries: {list} The asahi query cells.
+        :return: {tuple} ({string})
+        """
+        result = []
+        for query in queries:
+            if query.sub_queries:
+                result.extend(self.__get_leading_wildcard_members(query.sub_queries))
+                continue
+            operation = query.operation & QueryOperation.normal_operation_mask
+            if operation & QueryOperation.unlike != QueryOperation.unlike:
+                continue
+            property = self.__get_property(query.member)
+            if not isinstance(property, StringProperty) or property.searchable != 'substring':
+                result.append(query.member)
+        return tuple(result)
+
+    def __check_leading_wildcard(self, members):
+        """
+        Check the policy of the regexp with the leading wildcard. It is checked each time values are bound.
+        The policy is document_class._leading_wildcard or settings.ASAHI_LEADING_WILDCARD.
+        :param members: {tuple} ({string}) Members of like and unlike query cells with the leading wildcard.
+        """
+        policy = getattr(self.document_class, '_leading_wildcard', None) or utils.get_leading_wildcard()
+        if policy == 'allow':
+            return
+        for member in members:
+            message = 'like on %s.%s scans all terms of the index with the leading wildcard regexp, ' \
+                      'use StringProperty(searchable="substring") instead' % (self.document_class.__name__, member)
+            if policy == 'refuse':
+                raise QuerySyntaxError(message)
+            warnings.warn(message, LeadingWildcardWarning)
+
+    def __compile_filter(self, query):
+        """
+        Parse the asahi query cell to elastic search filter.
+        Exact match properties are compiled to term, terms, missing and exists filters.
+        The others are compiled to the query filter of __compile_query().
+        :param query: The asahi query cell.
+        :return: {dict} The elastic search filter.
+        """
+        operation = query.operation & QueryOperation.normal_operation_mask
+        if operation & QueryOperation.like == QueryOperation.like or \
+                operation & QueryOperation.unlike == QueryOperation.unlike:
+            return {'query': self.__compile_query(query)}
+        elif operation & QueryOperation.contains == QueryOperation.contains:
+            if not self.__is_exact_match(query.member):
+                return {'query': self.__compile_query(query)}
+            return {
+                'terms': {
+                    query.member: self.__map_values(query.value, self.__convert_range_for_query)
+                }
+            }
+        elif operation in (QueryOperation.greater_equal, QueryOperation.greater,
+                           QueryOperation.less_equal, QueryOperation.less):
+            return self.__compile_query(query)
+        elif operation & QueryOperation.equal == QueryOperation.equal:
+            if query.value is None:
+                return {
+                    'missing': {
+                        'field': query.member
+                    }
+                }
+            elif not self.__is_exact_match(query.member):
+                return {'query': self.__compile_query(query)}
+            return {
+                'term': {
+                    query.member: self.__convert_value(query.value, self.__convert_range_for_query)
+                }
+            }
+        elif operation & QueryOperation.unequal == QueryOperation.unequal:
+            if query.value is None:
+                return {
+                    'exists': {
+                        'field': query.member
+                    }
+                }
+            elif not self.__is_exact_match(query.member):
+                return {'query': self.__compile_query(query)}
+            return {
+                'bool': {
+                    'must_not': {
+                        'term': {
+                            query.member: self.__convert_value(query.value, self.__convert_range_for_query)
+                        }
+                    }
+                }
+            }
+
+    def __is_exact_match(self, member):
+        """
+        Is the member indexed as one term?
+        :param member: {string} The member of the query cell.
+        :return: {bool}
+        """
+        property = self.__get_property(member)
+        return property is not None and property.exact_match
+
+    def __get_property(self, member):
+        """
+        Get the property of the member.
+        :param member: {string} The member of the query cell.
+        :return: {Property or None} None if the member is the field in the property like 'dict_property.key'.
+        """
+        if '.' in member:
+            return None
+        return self.document_class.get_properties().get(member)
+
+    def __convert_value(self, value, convert):
+        """
+        Convert the value of the query cell. The conversion of QueryParameter is deferred to binding.
+        :param value: The value or {QueryParameter}.
+        :param convert: {function}
+        :return: The converted value or {QueryParameter}.
+        """
+        if isinstance(value, QueryParameter):
+            return value.derive(convert)
+        return convert(value)
+
+    @staticmethod
+    def __map_values(values, convert):
+        """
+        Convert each value of the list in the query cell.
+        :param values: {list} The values or {QueryParameter} of the whole list.
+        :param convert: {function}
+        :return: {list} The converted values or {QueryParameter}.
+        """
+        if isinstance(values, QueryParameter):
+            return values.derive(lambda items: [convert(x) for x in items])
+        return [convert(x) for x in values]
+
+    @staticmethod
+    def __is_values(value):
+        """
+        Is the value of the query cell the list of values? Sets, tuples and generators are also accepted.
+        :param value:
+        :return: {bool}
+        """
+        return hasattr(value, '__iter__') and not isinstance(value, (str, bytes, dict))
+
+    @staticmethod
+    def __convert_regexp_for_query(value):
+        """
+        Convert the value to the regexp which matches the value in any position.
+        :param value: {string}
+        :return: {string}
+        """
+        return '.*%s.*' % value
+
+    @staticmethod
+    def __convert_term_for_substring(value):
+        """
+        Convert the value to the term of the ngram sub field.
+        :param value: {string}
+        :return: {string}
+        """
+        return value.lower()
+
+    @staticmethod
+    def __convert_range_for_query(value):
+        """
+        Convert the value for the range query.
+        :param value:
+        :return:
+        """
+        if isinstance(value, datetime):
+            return Query.__convert_datetime_for_query(value)
+        return value
+
+    @staticmethod
+    def __convert_datetime_for_query(date_time):
         """
         Convert datetime data for query.
         :param date_time: {datetime}
@@ -575,18 +1302,7 @@ class Query(object):
             raise QuerySyntaxError
         key = list(kwargs.keys())[0]
         try:
-            operation = {
-                'equal': QueryOperation.equal,
-                'unequal': QueryOperation.unequal,
-                'less': QueryOperation.less,
-                'less_equal': QueryOperation.less_equal,
-                'greater': QueryOperation.greater,
-                'greater_equal': QueryOperation.greater_equal,
-                'like': QueryOperation.like,
-                'unlike': QueryOperation.unlike,
-                'contains': QueryOperation.contains,
-                'among': QueryOperation.contains,
-            }[key]
+            operation = _operation_codes[key]
         except KeyError:
             raise QuerySyntaxError
         return operation, kwargs[key]
@@ -0,0 +1,110 @@
+import asyncio
+import contextvars
+import time
+from . import utils
+
+
+_current_scope = contextvars.ContextVar('asahi_refresh_scope', default=None)
+
+
+class RefreshAfter(object):
+    """
+    Collect indices which are touched by saves and deletes in the block,
+    then refresh each index once when the block exits.
+    example:
+        with asahi.refresh_after():
+            for model in models:
+                model.save(synchronized=True)  # indices are refreshed once at the end
+        async with asahi.refresh_after():
+            await model.asave()
+    """
+    def __init__(self, wait_for=False):
+        """
+        Init the scope.
+        :param wait_for: {bool} Don't force the refresh.
+            Block until the next scheduled refresh of ElasticSearch (settings.ASAHI_REFRESH_INTERVAL) instead.
+        """
+        self.wait_for = wait_for
+        self.indices = {}  # {index name: document class}
+        self.last_write = None
+        self.__token = None
+
+    def touch(self, indices):
+        """
+        Record indices which are written.
+        :param indices: {dict} {index name: document class}
+        """
+        self.indices.update(indices)
+        self.last_write = time.monotonic()
+
+    def __enter__(self):
+        self.__token = _current_scope.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _current_scope.reset(self.__token)
+        if not self.indices:
+            return False
+        if self.wait_for:
+            time.sleep(self.__get_wait_seconds())
+        else:
+            for document_class, indices in self.__group_indices():
+                document_class._es.indices.refresh(index=','.join(indices))
+        return False
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        _current_scope.reset(self.__token)
+        if not self.indices:
+            return False
+        if self.wait_for:
+            await asyncio.sleep(self.__get_wait_seconds())
+        else:
+            for document_class, indices in self.__group_indices():
+                await document_class._async_es.indices.refresh(index=','.join(indices))
+        return False
+
+    def __get_wait_seconds(self):
+        """
+        Get seconds until the next scheduled refresh after the last write.
+        :return: {float}
+        """
+        return max(0.0, utils.get_refresh_interval() - (time.monotonic() - self.last_write))
+
+    def __group_indices(self):
+        """
+        Group indices by the client, so indices of one cluster are refreshed with one request.
+        :return: {list} [({Document}, [{string}])] A document class of the client and index names.
+        """
+        groups = {}  # {client: (document class, [index name])}
+        for index, document_class in sorted(self.indices.items()):
+            groups.setdefault(id(document_class._es), (document_class, []))[1].append(index)
+        return list(groups.values())
+
+
+def refresh_after(wait_for=False):
+    """
+    Refresh indices which are touched by saves and deletes in the block once when the block exits.
+    It replaces synchronized=True of each save and delete in the block.
+    :param wait_for: {bool} Wait for the next scheduled refresh instead of forcing one.
+    :return: {RefreshAfter}
+    """
+    return RefreshAfter(wait_for)
+
+def touch_indices(indices):
+    """
+    Record indices which are written in the current refresh_after() block.
+    :param indices: {dict} {index name: document class}
+    """
+    scope = _current_scope.get()
+    if scope is not None:
+        scope.touch(indices)
+
+def in_refresh_scope():
+    """
+    Is the code running in a refresh_after() block?
+    :return: {bool}
+    """
+    return _current_scope.get() is not None
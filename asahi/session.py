@@ -0,0 +1,161 @@
+import contextvars
+from collections import OrderedDict
+from . import bulk
+
+
+_current_session = contextvars.ContextVar('asahi_session', default=None)
+
+
+class Session(object):
+    """
+    The unit of work: save() and delete() in the block are queued,
+    then they are sent with one _bulk request when the block exits.
+    example:
+        with asahi.Session():
+            model.name = 'asahi'
+            model.save()  # queued
+            other.delete()  # queued
+        # saved and deleted with one _bulk request
+    Documents queued in the session are returned by Document.get() without requests.
+    Exceptions raised in the block discard queued writes.
+    save_many(), delete_many(), asave() and adelete() are queued too, so writes are sent in the order of calls.
+    """
+    def __init__(self, synchronized=False, chunk_size=bulk.DEFAULT_CHUNK_SIZE,
+                 max_chunk_bytes=bulk.DEFAULT_MAX_CHUNK_BYTES):
+        """
+        Init the session.
+        :param synchronized: {bool} Refresh indices after the commit.
+        :param chunk_size: {int} The max number of documents in one request.
+        :param max_chunk_bytes: {int} The max bytes of one request.
+        """
+        self.synchronized = synchronized
+        self.chunk_size = chunk_size
+        self.max_chunk_bytes = max_chunk_bytes
+        self.pending = OrderedDict()  # {id(document): (operation, document, partial)}
+        self.__token = None
+
+    def add(self, document, operation='save', partial=False, synchronized=False):
+        """
+        Queue the write of the document.
+        Repeated writes of the same instance are merged, the last operation wins and moves to the end of the queue.
+        :param document: {Document}
+        :param operation: {string} 'save' or 'delete'
+        :param partial: {bool} Save the document with the update action.
+        :param synchronized: {bool} Refresh indices after the commit.
+        """
+        key = id(document)
+        previous = self.pending.get(key)
+        if previous is not None and previous[0] == 'save' and operation == 'save':
+            partial = partial and previous[2]  # the full save includes changes of the partial save
+        self.pending.pop(key, None)
+        self.pending[key] = (operation, document, partial)
+        self.synchronized = self.synchronized or synchronized
+
+    def get_documents(self, document_class, ids):
+        """
+        Get queued documents.
+        :param document_class: {Document}
+        :param ids: {list} The documents' id.
+        :return: {dict} {document_id: {Document}} The document is None if it is queued to delete.
+        """
+        ids = set(ids)
+        result = {}
+        for operation, document, _ in self.pending.values():
+            if document.__class__ is document_class and document._id and document._id in ids:
+                result[document._id] = document if operation == 'save' else None
+        return result
+
+    def commit(self):
+        """
+        Send queued writes with one _bulk request.
+        Stored documents which are not changed are skipped.
+        :raises asahi.exceptions.BulkError:
+            error.errors are failed items. error.conflicts are items which failed by the version conflict.
+        """
+        pending = [x for x in self.pending.values()
+                   if (x[0] == 'save' and not x[1]._is_clean()) or (x[0] == 'delete' and x[1]._id)]
+        self.pending.clear()
+        if not pending:
+            return
+        for document_class in set([x[1].__class__ for x in pending]):
+            document_class.ensure_index()
+        actions = [document._generate_bulk_action(operation, partial) for operation, document, partial in pending]
+        pending[0][1]._execute_bulk(actions, self.synchronized, self.chunk_size, self.max_chunk_bytes)
+
+    def rollback(self):
+        """
+        Discard queued writes.
+        """
+        self.pending.clear()
+
+    def __enter__(self):
+        self.__token = _current_session.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _current_session.reset(self.__token)
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+
+
+class SessionMiddleware(object):
+    """
+    The django middleware which runs each request in the asahi.Session.
+    Writes are committed after the view, they are discarded if the view raises or the response is the server error.
+    It supports both styles of django middleware:
+        settings.MIDDLEWARE = [..., 'asahi.session.SessionMiddleware']  # django >= 1.10
+        settings.MIDDLEWARE_CLASSES = (..., 'asahi.session.SessionMiddleware')  # django < 1.10
+    """
+    def __init__(self, get_response=None):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        self.process_request(request)
+        try:
+            response = self.get_response(request)
+        except Exception as e:
+            self.process_exception(request, e)
+            raise
+        return self.process_response(request, response)
+
+    def process_request(self, request):
+        session = Session()
+        session.__enter__()
+        request._asahi_session = session
+
+    def process_exception(self, request, exception):
+        session = self.__pop_session(request)
+        if session is not None:
+            session.__exit__(type(exception), exception, exception.__traceback__)
+
+    def process_response(self, request, response):
+        session = self.__pop_session(request)
+        if session is not None:
+            if getattr(response, 'status_code', 200) >= 500:
+                session.rollback()
+            session.__exit__(None, None, None)
+        return response
+
+    @staticmethod
+    def __pop_session(request):
+        """
+        Get the session of the request. It is None if the session was closed or process_request() was skipped.
+        :param request: {HttpRequest}
+        :return: {Session or None}
+        """
+        session = getattr(request, '_asahi_session', None)
+        if isinstance(session, Session):
+            request._asahi_session = None
+            return session
+        return None
+
+
+def get_current_session():
+    """
+    Get the session of the current block.
+    :return: {Session or None}
+    """
+    return _current_session.get()
@@ -1,15 +1,122 @@
+import os
+import asyncio
+import threading
+import weakref
 from django.conf import settings
 import elasticsearch
+from .memory import MemoryElasticsearch, AsyncMemoryElasticsearch, is_memory_url
 
 
-def get_elasticsearch():
+_clients = {}  # {url: {Elasticsearch}}
+_clients_lock = threading.Lock()
+_clients_pid = os.getpid()  # the process which created clients in _clients
+_async_clients = weakref.WeakKeyDictionary()  # {event_loop: {url: {AsyncElasticsearch}}}
+
+
+def get_elasticsearch(url=None):
     """
     Get the connection for ElasticSearch.
-    :return: {Elasticsearch}
+    The client is shared by the whole process, so keep-alive connections are reused.
+    Clients created by the parent process are dropped after fork.
+    'memory://' is the in-process engine of asahi.memory, documents are shared by clients of the same url.
+    :param url: {string or list} The url of ElasticSearch. The default is settings.ELASTICSEARCH_URL.
+    :return: {Elasticsearch or asahi.memory.MemoryElasticsearch}
+    """
+    global _clients_pid
+    if url is None:
+        url = getattr(settings, 'ELASTICSEARCH_URL', 'http://localhost:9200')
+    key = tuple(url) if isinstance(url, list) else url
+    pid = os.getpid()
+    if pid == _clients_pid:
+        client = _clients.get(key)
+        if client is not None:
+            return client
+
+    with _clients_lock:
+        if pid != _clients_pid:
+            _clients.clear()
+            _clients_pid = pid
+        client = _clients.get(key)
+        if client is None and is_memory_url(url):
+            client = MemoryElasticsearch()
+            _clients[key] = client
+        elif client is None:
+            client = elasticsearch.Elasticsearch(url, maxsize=get_maxsize(key))
+            _clients[key] = client
+        return client
+
+def get_async_elasticsearch(url=None):
+    """
+    Get the asyncio connection for ElasticSearch.
+    The client is shared by coroutines of the same event loop.
+    :param url: {string} The url of ElasticSearch. The default is settings.ELASTICSEARCH_URL.
+    :return: {asahi.aio.AsyncElasticsearch or asahi.memory.AsyncMemoryElasticsearch}
+    """
+    from .aio import AsyncElasticsearch
+
+    if url is None:
+        url = getattr(settings, 'ELASTICSEARCH_URL', 'http://localhost:9200')
+    if isinstance(url, list):
+        url = url[0]
+    clients = _async_clients.setdefault(asyncio.get_event_loop(), {})
+    client = clients.get(url)
+    if client is None and is_memory_url(url):
+        client = AsyncMemoryElasticsearch(get_elasticsearch(url))
+        clients[url] = client
+    elif client is None:
+        client = AsyncElasticsearch(url, maxsize=get_maxsize(url))
+        clients[url] = client
+    return client
+
+async def close_async_clients():
+    """
+    Close and drop asyncio clients of the current event loop.
+    Await it before the event loop is closed, otherwise connections of the aiohttp session are leaked.
+    """
+    clients = _async_clients.pop(asyncio.get_event_loop(), {})
+    for client in clients.values():
+        await client.aclose()
+
+def get_maxsize(url):
+    """
+    Get the max number of keep-alive connections per host for the client of the url.
+    :param url: {string or tuple} The url of ElasticSearch. The tuple of hosts if the url is the list.
+    :return: {int} settings.ELASTICSEARCH_MAXSIZES[url], the default is settings.ELASTICSEARCH_MAXSIZE.
+    """
+    maxsizes = getattr(settings, 'ELASTICSEARCH_MAXSIZES', {})
+    if url in maxsizes:
+        return maxsizes[url]
+    return getattr(settings, 'ELASTICSEARCH_MAXSIZE', 10)
+
+def reset_elasticsearch():
+    """
+    Drop all shared clients. The next get_elasticsearch() will create new clients.
+    asyncio clients are not closed, await close_async_clients() before it in the event loop.
     """
-    return elasticsearch.Elasticsearch(
-        getattr(settings, 'ELASTICSEARCH_URL', 'http://localhost:9200')
-    )
+    global _clients_lock, _clients_pid
+    _clients_lock = threading.Lock()
+    _clients.clear()
+    _async_clients.clear()
+    _clients_pid = os.getpid()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_elasticsearch)
+
+
+class ElasticsearchDescriptor(object):
+    """
+    The shared client of ElasticSearch as a class attribute.
+    """
+    def __get__(self, instance, owner):
+        return get_elasticsearch()
+
+class AsyncElasticsearchDescriptor(object):
+    """
+    The asyncio client of ElasticSearch for the current event loop as a class attribute.
+    """
+    def __get__(self, instance, owner):
+        return get_async_elasticsearch()
+
 
 def get_index_prefix():
     """
@@ -17,3 +124,17 @@ def get_index_prefix():
     :return: {string}
     """
     return getattr(settings, 'ASAHI_DB_PREFIX', '')
+
+def get_leading_wildcard():
+    """
+    Get the policy of the regexp with the leading wildcard which is generated by like and unlike.
+    :return: {string} 'allow', 'warn' or 'refuse'
+    """
+    return getattr(settings, 'ASAHI_LEADING_WILDCARD', 'allow')
+
+def get_refresh_interval():
+    """
+    Get the refresh interval of indices. refresh_after(wait_for=True) waits for it.
+    :return: {float} Seconds.
+    """
+    return getattr(settings, 'ASAHI_REFRESH_INTERVAL', 1.0)
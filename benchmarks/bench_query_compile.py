@@ -0,0 +1,48 @@
+"""
+Benchmark the compile cost of asahi queries.
+    $ python3 benchmarks/bench_query_compile.py
+"uncached" clears compiled query templates before each compile (the cost before query templates),
+"cached" binds new values to the compiled template.
+"""
+import os
+import sys
+import timeit
+from datetime import datetime
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from django.conf import settings
+settings.configure()
+from asahi import db, query as asahi_query
+
+
+class BenchDocument(db.Document):
+    name = db.StringProperty()
+    email = db.StringProperty()
+    category = db.IntegerProperty()
+    age = db.IntegerProperty()
+    created_at = db.DateTimeProperty()
+
+
+def build_query(index):
+    return BenchDocument.where('category', contains=[1, 3, index % 5])\
+        .where('age', greater_equal=index % 30)\
+        .where('created_at', less=datetime(2014, 12, 1))\
+        .where(lambda x: x.where('name', like='asahi%d' % index).union('email', like='asahi%d' % index))\
+        .order_by('created_at', descending=True)
+
+
+def compile_queries(queries, cached):
+    for query in queries:
+        if not cached:
+            asahi_query._query_templates.clear()
+        query._Query__compile_queries(query.items)
+
+
+def main(number=10000):
+    queries = [build_query(x) for x in range(number)]
+    for cached in [False, True]:
+        seconds = timeit.timeit(lambda: compile_queries(queries, cached), number=1)
+        print('%-8s %8.2f us/query' % ('cached' if cached else 'uncached', seconds / number * 1000000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,323 @@
+"""
+Benchmark the overhead of asahi without ElasticSearch.
+Responses of ElasticSearch are replayed by the stub client, so only asahi's own work is measured.
+    $ python3 benchmarks/bench_suite.py                   # compare with benchmarks/baseline.json
+    $ python3 benchmarks/bench_suite.py --save-baseline   # record the baseline of this machine
+    $ python3 benchmarks/bench_suite.py query_compile     # only run these benchmarks
+Each benchmark reports the best time per operation of some repeats, and the peak memory of one run (tracemalloc).
+Short benchmarks are looped until one repeat takes MIN_REPEAT_SECONDS.
+Times are also reported relative to the reference workload of the same run, so they are comparable between machines.
+The exit code is 1 if a benchmark uses more memory than the baseline over the memory tolerance,
+or its relative time is slower than the baseline over the (wide) time tolerance.
+--warn-only-time reports time regressions as warnings, for noisy machines.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from django.conf import settings
+settings.configure()
+from asahi import db
+from asahi.deep_query import update_reference_properties
+
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+REFERENCE_NAME = '_reference'
+MIN_REPEAT_SECONDS = 0.2
+
+
+# ---------------------------------------------------------
+# The stub client
+# ---------------------------------------------------------
+class StubIndicesClient(object):
+    def exists(self, index):
+        return True
+
+    def refresh(self, index=None):
+        return {}
+
+
+class StubElasticsearch(object):
+    """
+    Replay recorded responses. Documents of mget are looked up in the table.
+    """
+    def __init__(self):
+        self.indices = StubIndicesClient()
+        self.search_response = None
+        self.documents = {}  # {(document type, document id): {hit}}
+
+    def search(self, index=None, body=None, **params):
+        return self.search_response
+
+    def mget(self, body, index=None, doc_type=None, **params):
+        if 'docs' in body:
+            keys = [(x['_type'], x['_id']) for x in body['docs']]
+        else:
+            keys = [(doc_type, x) for x in body['ids']]
+        return {'docs': [self.documents.get(x, {'_id': x[1], 'found': False}) for x in keys]}
+
+
+stub_es = StubElasticsearch()
+db.Document._es = stub_es
+
+
+# ---------------------------------------------------------
+# Documents
+# ---------------------------------------------------------
+class BenchCompany(db.Document):
+    name = db.StringProperty()
+
+class BenchUser(db.Document):
+    name = db.StringProperty()
+    email = db.StringProperty(analyzed=False)
+    company = db.ReferenceProperty(BenchCompany)
+
+class BenchArticle(db.Document):
+    title = db.StringProperty()
+    category = db.IntegerProperty()
+    score = db.FloatProperty()
+    published = db.BooleanProperty()
+    tags = db.ListProperty(str)
+    created_at = db.DateTimeProperty()
+    author = db.ReferenceProperty(BenchUser)
+    editor = db.ReferenceProperty(BenchUser)
+
+
+def generate_article_hit(index):
+    return {
+        '_id': 'article-%d' % index,
+        '_version': 1,
+        '_source': {
+            'title': 'asahi %d' % index,
+            'category': index % 7,
+            'score': index / 3.0,
+            'published': index % 2 == 0,
+            'tags': ['tag-%d' % x for x in range(index % 5)],
+            'created_at': (datetime(2016, 1, 1) + timedelta(minutes=index)).isoformat() + 'Z',
+            'author': 'user-%d' % (index % 100),
+            'editor': 'user-%d' % (index % 37),
+        },
+    }
+
+def record_documents():
+    for index in range(10):
+        stub_es.documents[('BenchCompany', 'company-%d' % index)] = {
+            '_id': 'company-%d' % index, '_version': 1, 'found': True, '_source': {'name': 'rinse %d' % index},
+        }
+    for index in range(100):
+        stub_es.documents[('BenchUser', 'user-%d' % index)] = {
+            '_id': 'user-%d' % index, '_version': 1, 'found': True, '_source': {
+                'name': 'user %d' % index, 'email': 'user%d@rinse.io' % index, 'company': 'company-%d' % (index % 10),
+            },
+        }
+
+def build_query(index):
+    return BenchArticle.where('category', contains=[1, 3, index % 5])\
+        .where('score', greater_equal=index % 30)\
+        .where('created_at', less=datetime(2016, 12, 1))\
+        .where(lambda x: x.where('title', like='asahi%d' % index).union('tags', equal='tag-%d' % index))\
+        .where(lambda x: x.where('published', equal=True).union('author', unequal=None))\
+        .order_by('created_at', descending=True)
+
+
+# ---------------------------------------------------------
+# Benchmarks
+# ---------------------------------------------------------
+def bench_reference():
+    """
+    Plain python work without asahi. Other times are divided by it to cancel the speed of the machine.
+    """
+    sources = [generate_article_hit(x)['_source'] for x in range(1000)]
+    def run():
+        for source in sources:
+            document = dict(source)
+            document['tags'] = list(document['tags'])
+            '%s %s' % (document['title'], document['created_at'])
+    return run, len(sources)
+
+def bench_query_compile():
+    """
+    Compile realistic query trees. The template of the shape is cached after the first query.
+    :return: {tuple} ({function}, {int}operations)
+    """
+    queries = [build_query(x) for x in range(1000)]
+    def run():
+        for query in queries:
+            query._Query__compile_queries(query.items)
+    return run, len(queries)
+
+def bench_fetch(size):
+    """
+    Build documents from hits of the search response.
+    """
+    def setup():
+        stub_es.search_response = {'hits': {'total': size, 'hits': [generate_article_hit(x) for x in range(size)]}}
+        def run():
+            BenchArticle.all().fetch(size, fetch_reference=False)
+        return run, size
+    return setup
+
+def bench_fetch_read():
+    """
+    Build documents from hits and read all properties of them.
+    """
+    size = 1000
+    stub_es.search_response = {'hits': {'total': size, 'hits': [generate_article_hit(x) for x in range(size)]}}
+    def run():
+        documents, _ = BenchArticle.all().fetch(size, fetch_reference=False)
+        for document in documents:
+            document.title, document.category, document.score, document.published
+            list(document.tags), document.created_at
+    return run, size
+
+def bench_list_proxy():
+    """
+    Append, index and iterate ListProperty values.
+    """
+    article = BenchArticle._from_hit(generate_article_hit(0))
+    def run():
+        article.tags = []
+        tags = article.tags
+        for x in range(1000):
+            tags.append('tag-%d' % x)
+        for x in range(1000):
+            tags[x]
+        list(tags)
+    return run, 1000
+
+def bench_datetime_property():
+    """
+    Convert DateTimeProperty values from and to json.
+    """
+    values = [(datetime(2016, 1, 1) + timedelta(minutes=x)).isoformat() + '.123Z' for x in range(1000)]
+    def run():
+        for value in values:
+            db.DateTimeProperty._to_json(db.DateTimeProperty._to_python(value))
+    return run, len(values)
+
+def bench_update_reference_properties():
+    """
+    Resolve author, editor and author.company of 1000 articles. (2 mget requests)
+    """
+    hits = [generate_article_hit(x) for x in range(1000)]
+    def run():
+        articles = [BenchArticle._from_hit(x) for x in hits]
+        update_reference_properties(articles, ['author', 'editor', 'author.company'])
+    return run, len(hits)
+
+BENCHMARKS = [
+    ('query_compile', bench_query_compile),
+    ('fetch_1k', bench_fetch(1000)),
+    ('fetch_10k', bench_fetch(10000)),
+    ('fetch_read_1k', bench_fetch_read),
+    ('list_proxy', bench_list_proxy),
+    ('datetime_property', bench_datetime_property),
+    ('update_reference_properties', bench_update_reference_properties),
+]
+
+
+# ---------------------------------------------------------
+# Runner
+# ---------------------------------------------------------
+def time_loops(run, loops):
+    """
+    :return: {float} Seconds of running the benchmark loops times.
+    """
+    start = time.perf_counter()
+    for _ in range(loops):
+        run()
+    return time.perf_counter() - start
+
+def measure(setup, repeat, min_repeat_seconds=MIN_REPEAT_SECONDS):
+    """
+    Measure the benchmark.
+    :param setup: {function} It returns ({function}run, {int}operations).
+    :param repeat: {int} Times to repeat. The best time is reported.
+    :param min_repeat_seconds: {float} The run is looped until one repeat takes this time.
+    :return: {dict} {'us_per_op': {float}, 'peak_bytes': {int}}
+    """
+    run, operations = setup()
+    run()  # warm up caches of compiled query templates
+    loops = 1
+    while time_loops(run, loops) < min_repeat_seconds:
+        loops *= 2
+    best = min([time_loops(run, loops) for _ in range(repeat)]) / loops
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'us_per_op': best / operations * 1000000, 'peak_bytes': peak}
+
+def compare(name, result, baseline, key, tolerance):
+    """
+    Compare the value of the result with the baseline.
+    :param key: {string} 'relative' or 'peak_bytes'
+    :return: {list} [{string}] Regressions.
+    """
+    if key not in baseline.get(name, {}):
+        return []
+    if result[key] > baseline[name][key] * (1 + tolerance):
+        return ['%s %s: %.2f > %.2f (baseline) + %d%%' % (
+            name, key, result[key], baseline[name][key], tolerance * 100)]
+    return []
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark asahi without ElasticSearch.')
+    parser.add_argument('names', nargs='*', help='Benchmarks to run. The default is all.')
+    parser.add_argument('--repeat', type=int, default=7)
+    parser.add_argument('--memory-tolerance', type=float, default=0.1,
+                        help='The allowed regression ratio of the peak memory. (0.1: 10%%)')
+    parser.add_argument('--time-tolerance', type=float, default=1.0,
+                        help='The allowed regression ratio of the relative time. (1.0: 100%%)')
+    parser.add_argument('--warn-only-time', action='store_true', help='Time regressions are only warnings.')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true')
+    args = parser.parse_args(argv)
+
+    record_documents()
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    reference_us = measure(bench_reference, args.repeat)['us_per_op']
+    print('%-30s %10.2f us/op' % ('reference', reference_us))
+    results = {REFERENCE_NAME: {'us_per_op': reference_us}}
+    regressions = []
+    slowdowns = []
+    for name, setup in BENCHMARKS:
+        if args.names and name not in args.names:
+            continue
+        result = results[name] = measure(setup, args.repeat)
+        result['relative'] = result['us_per_op'] / reference_us
+        regressions += compare(name, result, baseline, 'peak_bytes', args.memory_tolerance)
+        slowdowns += compare(name, result, baseline, 'relative', args.time_tolerance)
+        reference = baseline.get(name)
+        print('%-30s %10.2f us/op %8.2fx %10.1f KiB peak%s' % (
+            name, result['us_per_op'], result['relative'], result['peak_bytes'] / 1024.0,
+            '  (baseline %.2fx %.1f KiB)' % (reference['relative'], reference['peak_bytes'] / 1024.0)
+            if reference and 'relative' in reference else '',
+        ))
+
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('baseline is saved to %s' % args.baseline)
+        return 0
+    if args.warn_only_time:
+        for slowdown in slowdowns:
+            print('SLOWER %s' % slowdown)
+    else:
+        regressions += slowdowns
+    for regression in regressions:
+        print('REGRESSION %s' % regression)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
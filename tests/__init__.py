@@ -0,0 +1,12 @@
+from mock import MagicMock
+
+
+def async_mock(return_value=None):
+    """
+    Mock the coroutine function. The mock records calls like MagicMock.
+    :param return_value: The result of awaiting the call.
+    :return: {MagicMock}
+    """
+    async def coroutine(*args, **kwargs):
+        return return_value
+    return MagicMock(side_effect=coroutine)
@@ -0,0 +1,156 @@
+import asyncio
+import unittest
+from datetime import datetime
+from mock import MagicMock, patch
+from asahi import msearch
+from asahi.document import Document, reset_ensured_indices
+from asahi.properties import StringProperty, IntegerProperty, FloatProperty, BooleanProperty, DateTimeProperty,\
+    ListProperty, DictProperty
+from asahi.aggregations import Terms, DateHistogram, Stats, Sum, Avg, Min, Max, Percentiles, Cardinality, Bucket
+from asahi.exceptions import PropertyNotExist, QuerySyntaxError
+
+
+class FakeOrder(Document):
+    status = StringProperty(analyzed=False)
+    customer = StringProperty(analyzed=False)
+    amount = FloatProperty()
+    quantity = IntegerProperty()
+    paid = BooleanProperty()
+    created_at = DateTimeProperty()
+    tags = ListProperty(int)
+    extra = DictProperty()
+
+
+class TestAsahiAggregations(unittest.TestCase):
+    def setUp(self):
+        reset_ensured_indices()
+        self.fake_es = MagicMock()
+        self.patches = [
+            patch('asahi.document.Document._es', new=self.fake_es),
+            patch.object(FakeOrder, 'get_index_name', return_value='fakeorder'),
+        ]
+        for x in self.patches:
+            x.start()
+
+    def tearDown(self):
+        for x in self.patches:
+            x.stop()
+
+    def test_asahi_aggregations_body(self):
+        self.fake_es.search.return_value = {'hits': {'total': 0, 'hits': []}, 'aggregations': {
+            'status': {'buckets': []}, 'daily': {'buckets': []}, 'customers': {'value': 0},
+        }}
+        FakeOrder.where('paid', equal=True).aggregate(
+            status=Terms('status', size=5, aggs={'amount': Sum('amount'), 'p': Percentiles('amount', percents=[50])}),
+            daily=DateHistogram('created_at', interval='month', time_zone='+08:00', min_doc_count=0),
+            customers=Cardinality('customer', precision_threshold=1000),
+        )
+        body = self.fake_es.search.call_args[1]['body']
+        self.assertEqual(self.fake_es.search.call_count, 1)
+        self.assertEqual(self.fake_es.search.call_args[1]['index'], 'fakeorder')
+        self.assertEqual(body['size'], 0)
+        self.assertIn('filtered', body['query'])
+        self.assertDictEqual(body['aggs'], {
+            'status': {
+                'terms': {'field': 'status', 'size': 5, 'order': {'_count': 'desc'}},
+                'aggs': {
+                    'amount': {'sum': {'field': 'amount'}},
+                    'p': {'percentiles': {'field': 'amount', 'percents': [50]}},
+                },
+            },
+            'daily': {'date_histogram': {
+                'field': 'created_at', 'interval': 'month', 'time_zone': '+08:00', 'min_doc_count': 0,
+            }},
+            'customers': {'cardinality': {'field': 'customer', 'precision_threshold': 1000}},
+        })
+
+    def test_asahi_aggregations_result(self):
+        self.fake_es.search.return_value = {'hits': {'total': 3, 'hits': []}, 'aggregations': {
+            'status': {'buckets': [
+                {'key': 'paid', 'doc_count': 2, 'amount': {'value': 30.5}},
+                {'key': 'new', 'doc_count': 1, 'amount': {'value': 1.0}},
+            ]},
+            'quantity': {'buckets': [{'key': 3, 'doc_count': 3}]},
+            'paid': {'buckets': [{'key': 1, 'key_as_string': 'T', 'doc_count': 3}]},
+            'tags': {'buckets': [{'key': 7, 'doc_count': 1}]},
+            'created_at': {'buckets': [
+                {'key': 1476748800000, 'key_as_string': '2016-10-18T00:00:00.000Z', 'doc_count': 3},
+            ]},
+            'daily': {'buckets': [
+                {'key': 1476748800000, 'key_as_string': '2016-10-18T00:00:00.000Z', 'doc_count': 3,
+                 'customers': {'value': 2}},
+            ]},
+            'stats': {'count': 3, 'min': 1.0, 'max': 20.0, 'avg': 10.5, 'sum': 31.5},
+            'avg': {'value': 10.5},
+            'min': {'value': 1.0},
+            'max': {'value': None},
+            'percentiles': {'values': {'50.0': 10.5, '99.0': 20.0}},
+        }}
+        result = FakeOrder.all().aggregate(
+            status=Terms('status', aggs={'amount': Sum('amount')}),
+            quantity=Terms('quantity'),
+            paid=Terms('paid'),
+            tags=Terms('tags'),
+            created_at=Terms('created_at'),
+            daily=DateHistogram('created_at', aggs={'customers': Cardinality('customer')}),
+            stats=Stats('amount'),
+            avg=Avg('amount'),
+            min=Min('amount'),
+            max=Max('amount'),
+            percentiles=Percentiles('amount'),
+        )
+        self.assertListEqual(result['status'], [
+            Bucket('paid', 2, {'amount': 30.5}),
+            Bucket('new', 1, {'amount': 1.0}),
+        ])
+        self.assertEqual(result['status'][0]['amount'], 30.5)
+        self.assertIs(result['quantity'][0].key, 3)
+        self.assertIs(result['paid'][0].key, True)
+        self.assertIs(result['tags'][0].key, 7)
+        self.assertEqual(result['created_at'][0].key, datetime(2016, 10, 18))
+        self.assertEqual(result['daily'][0].key, datetime(2016, 10, 18))
+        self.assertEqual(result['daily'][0].doc_count, 3)
+        self.assertIs(result['daily'][0]['customers'], 2)
+        self.assertDictEqual(result['stats'], {'count': 3, 'min': 1.0, 'max': 20.0, 'avg': 10.5, 'sum': 31.5})
+        self.assertEqual(result['avg'], 10.5)
+        self.assertEqual(result['min'], 1.0)
+        self.assertIsNone(result['max'])
+        self.assertDictEqual(result['percentiles'], {50.0: 10.5, 99.0: 20.0})
+
+    def test_asahi_aggregations_dict_field(self):
+        self.fake_es.search.return_value = {'aggregations': {'source': {'buckets': [{'key': 'web', 'doc_count': 1}]}}}
+        result = FakeOrder.all().aggregate(source=Terms('extra.source'))
+        self.assertEqual(result['source'][0].key, 'web')
+
+    def test_asahi_aggregations_errors(self):
+        with self.assertRaises(PropertyNotExist):
+            FakeOrder.all().aggregate(x=Terms('missing'))
+        with self.assertRaises(ValueError):
+            FakeOrder.all().aggregate(x=DateHistogram('amount'))
+        with self.assertRaises(TypeError):
+            FakeOrder.all().aggregate(x={'terms': {'field': 'status'}})
+        with self.assertRaises(QuerySyntaxError):
+            FakeOrder.all().aggregate()
+        self.fake_es.search.assert_not_called()
+
+    def test_asahi_aggregations_aaggregate(self):
+        async def search(*args, **kwargs):
+            return {'aggregations': {'total': {'value': 3.0}}}
+        async def exists(*args, **kwargs):
+            return True
+        async_es = MagicMock()
+        async_es.search.side_effect = search
+        async_es.indices.exists.side_effect = exists
+        with patch('asahi.document.Document._async_es', new=async_es):
+            result = asyncio.run(FakeOrder.all().aaggregate(total=Sum('amount')))
+        self.assertDictEqual(result, {'total': 3.0})
+        self.assertDictEqual(async_es.search.call_args[1]['body']['aggs'], {'total': {'sum': {'field': 'amount'}}})
+
+    def test_asahi_aggregations_msearch(self):
+        self.fake_es.msearch.return_value = {'responses': [
+            {'hits': {'total': 3, 'hits': []}, 'aggregations': {'status': {'buckets': [{'key': 'paid', 'doc_count': 3}]}}},
+        ]}
+        result, = msearch([FakeOrder.all().aggregate_spec(status=Terms('status'))])
+        self.assertListEqual(result['status'], [Bucket('paid', 3)])
+        body = self.fake_es.msearch.call_args[1]['body']
+        self.assertIn('terms', body[1]['aggs']['status'])
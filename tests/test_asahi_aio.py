@@ -0,0 +1,38 @@
+import asyncio
+import unittest
+from mock import MagicMock, patch
+from asahi import aio
+from asahi.exceptions import NotFoundError
+from tests import async_mock
+
+
+class TestAsahiAio(unittest.TestCase):
+    def setUp(self):
+        with patch('asahi.aio.aiohttp', new=MagicMock()):
+            self.es = aio.AsyncElasticsearch('http://es:9200/')
+        self.es.perform_request = async_mock({})
+
+    def test_asahi_aio_get(self):
+        asyncio.run(self.es.get(index='index_name', doc_type='Document', id='id-A'))
+        self.es.perform_request.assert_called_once_with('GET', '/index_name/Document/id-A', params={})
+
+    def test_asahi_aio_index_without_id(self):
+        asyncio.run(self.es.index(index='index_name', doc_type='Document', body={}, version=0))
+        self.es.perform_request.assert_called_once_with(
+            'POST', '/index_name/Document', params={'version': 0}, body={}
+        )
+
+    def test_asahi_aio_refresh(self):
+        asyncio.run(self.es.indices.refresh(index='index_name'))
+        self.es.perform_request.assert_called_once_with('POST', '/index_name/_refresh')
+
+    def test_asahi_aio_raise_error(self):
+        with self.assertRaises(NotFoundError) as context:
+            self.es._AsyncElasticsearch__raise_error(404, '{"error": "IndexMissingException[[index_name] missing]"}')
+        self.assertIn('IndexMissingException', str(context.exception))
+
+
+class TestAsahiAioWithoutAiohttp(unittest.TestCase):
+    def test_asahi_aio_without_aiohttp(self):
+        with patch('asahi.aio.aiohttp', new=None):
+            self.assertRaises(ImportError, aio.AsyncElasticsearch)
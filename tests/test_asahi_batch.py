@@ -0,0 +1,99 @@
+import unittest
+from mock import MagicMock, patch
+import asahi
+from asahi.batch import QueryBatch, msearch
+from asahi.document import Document, reset_ensured_indices
+from asahi.properties import StringProperty, ReferenceProperty
+from asahi.exceptions import TransportError
+
+
+class FakeUser(Document):
+    name = StringProperty()
+class FakeArticle(Document):
+    title = StringProperty()
+    author = ReferenceProperty(FakeUser)
+    body = StringProperty(deferred=True)
+
+
+class TestAsahiBatch(unittest.TestCase):
+    def setUp(self):
+        reset_ensured_indices()
+        self.fake_es = MagicMock()
+        self.fake_es.msearch.return_value = {
+            'responses': [
+                {'hits': {'total': 1, 'hits': [{'_id': 'article-A', '_version': 1,
+                                                '_source': {'title': 'asahi', 'author': 'user-A'}}]}},
+                {'hits': {'total': 3, 'hits': []}},
+                {'hits': {'total': 3, 'hits': []}, 'aggregations': {'group': {'buckets': [{'key': 'kelp', 'doc_count': 3}]}}},
+            ]
+        }
+        self.patches = [
+            patch('asahi.document.Document._es', new=self.fake_es),
+            patch.object(FakeUser, 'get_index_name', return_value='fakeuser'),
+            patch.object(FakeArticle, 'get_index_name', return_value='fakearticle'),
+        ]
+        for x in self.patches:
+            x.start()
+
+    def tearDown(self):
+        for x in self.patches:
+            x.stop()
+
+    def test_asahi_batch_export(self):
+        self.assertIs(asahi.msearch, msearch)
+        self.assertIs(asahi.QueryBatch, QueryBatch)
+
+    def test_asahi_batch_msearch(self):
+        with patch('asahi.batch.update_batch_reference_properties') as mock_update_reference_properties:
+            (documents, total), count, buckets, empty = msearch([
+                FakeArticle.where('title', equal='asahi').fetch_spec(20, 10),
+                FakeUser.all().count_spec(),
+                FakeUser.all().group_by_spec('name'),
+                FakeUser.where('name', contains=[]).fetch_spec(),
+            ])
+        self.assertEqual(self.fake_es.msearch.call_count, 1)
+        body = self.fake_es.msearch.call_args[1]['body']
+        self.assertListEqual(body[0::2], [{'index': 'fakearticle'}, {'index': 'fakeuser'}, {'index': 'fakeuser'}])
+        self.assertEqual(body[1]['from'], 10)
+        self.assertEqual(body[1]['size'], 20)
+        self.assertIs(body[1]['version'], True)
+        self.assertDictEqual(body[1]['_source'], {'exclude': ['body']})
+        self.assertDictEqual(body[3], {'size': 0})
+        self.assertEqual(body[5]['aggs']['group']['terms']['field'], 'name')
+        self.assertEqual(total, 1)
+        self.assertEqual(documents[0].title, 'asahi')
+        self.assertSetEqual(documents[0]._deferred, {'body'})
+        self.assertEqual(count, 3)
+        self.assertListEqual(buckets, [{'key': 'kelp', 'doc_count': 3}])
+        self.assertEqual(empty, ([], 0))
+        mock_update_reference_properties.assert_called_once_with([(documents, None)])
+
+    def test_asahi_batch_msearch_resolve_references_across_specs(self):
+        self.fake_es.msearch.return_value = {
+            'responses': [
+                {'hits': {'total': 1, 'hits': [{'_id': 'article-A', '_version': 1, '_source': {'author': 'user-A'}}]}},
+                {'hits': {'total': 1, 'hits': [{'_id': 'article-B', '_version': 1, '_source': {'author': 'user-A'}}]}},
+            ]
+        }
+        self.fake_es.mget.return_value = {'docs': [
+            {'_index': 'fakeuser', '_type': 'FakeUser', '_id': 'user-A', '_version': 1, 'found': True,
+             '_source': {'name': 'kelp'}},
+        ]}
+        (documents_a, _), (documents_b, _) = QueryBatch([
+            FakeArticle.all().fetch_spec(),
+            FakeArticle.where('title', equal='asahi').fetch_spec(),
+        ]).execute()
+        self.fake_es.mget.assert_called_once_with(body={'docs': [{'_index': 'fakeuser', '_type': 'FakeUser', '_id': 'user-A'}]})
+        self.assertEqual(documents_a[0].author.name, 'kelp')
+        self.assertIs(documents_b[0].author, documents_a[0].author)
+
+    def test_asahi_batch_msearch_without_request(self):
+        result = msearch([FakeUser.where('name', contains=[]).count_spec()])
+        self.assertListEqual(result, [0])
+        self.fake_es.msearch.assert_not_called()
+
+    def test_asahi_batch_msearch_error(self):
+        self.fake_es.msearch.return_value = {'responses': [{'error': 'SearchPhaseExecutionException', 'status': 400}]}
+        with self.assertRaises(TransportError) as context:
+            msearch([FakeUser.all().count_spec()])
+        self.assertEqual(context.exception.status_code, 400)
@@ -0,0 +1,78 @@
+import unittest
+from mock import MagicMock, patch
+from asahi import bulk
+from asahi.exceptions import TransportError
+
+
+class TestAsahiBulk(unittest.TestCase):
+    def test_asahi_bulk_action(self):
+        action = bulk.BulkAction('index', 'index_name', 'Document', id='id-A', version=1, body={'name': 'kelp'})
+        self.assertEqual(
+            action.data,
+            '{"index": {"_index": "index_name", "_type": "Document", "_id": "id-A", "_version": 1}}\n'
+            '{"name": "kelp"}\n'
+        )
+        self.assertEqual(action.size, len(action.data))
+
+    def test_asahi_bulk_chunk_actions_by_count(self):
+        actions = [bulk.BulkAction('delete', 'index_name', 'Document', id=str(x)) for x in range(5)]
+        chunks = list(bulk.chunk_actions(actions, chunk_size=2))
+        self.assertListEqual([len(x) for x in chunks], [2, 2, 1])
+
+    def test_asahi_bulk_chunk_actions_by_bytes(self):
+        actions = [bulk.BulkAction('delete', 'index_name', 'Document', id=str(x)) for x in range(3)]
+        chunks = list(bulk.chunk_actions(actions, max_chunk_bytes=actions[0].size * 2))
+        self.assertListEqual([len(x) for x in chunks], [2, 1])
+
+    def test_asahi_bulk_execute_retry_rejected_items(self):
+        actions = [bulk.BulkAction('delete', 'index_name', 'Document', id=str(x)) for x in range(2)]
+        es = MagicMock()
+        es.bulk.side_effect = [
+            {'items': [
+                {'delete': {'_id': '0', 'status': 200}},
+                {'delete': {'_id': '1', 'status': 429, 'error': 'EsRejectedExecutionException'}},
+            ]},
+            {'items': [
+                {'delete': {'_id': '1', 'status': 200}},
+            ]},
+        ]
+        with patch('asahi.bulk.time.sleep') as mock_sleep:
+            failures = bulk.execute(es, actions)
+        mock_sleep.assert_called_once_with(bulk.DEFAULT_INITIAL_BACKOFF)
+        self.assertListEqual(failures, [])
+        self.assertEqual(es.bulk.call_args[1]['body'], actions[1].data)
+
+    def test_asahi_bulk_execute_retry_rejected_request(self):
+        actions = [bulk.BulkAction('delete', 'index_name', 'Document', id='0')]
+        es = MagicMock()
+        es.bulk.side_effect = TransportError(429, 'EsRejectedExecutionException')
+        with patch('asahi.bulk.time.sleep') as mock_sleep:
+            failures = bulk.execute(es, actions, max_retries=2)
+        self.assertEqual(es.bulk.call_count, 3)
+        self.assertEqual(mock_sleep.call_count, 2)
+        self.assertListEqual(failures, actions)
+
+    def test_asahi_bulk_parallel_execute(self):
+        es = MagicMock()
+        es.bulk.side_effect = lambda body: {'items': [
+            {'index': {'_id': x, 'status': 400, 'error': 'MapperParsingException'} if x == 'bad' else {'_id': x, 'status': 201}}
+            for x in [line.split('"_id": "')[1].split('"')[0] for line in body.splitlines()[0::2]]
+        ]}
+        read = []
+        def pages():
+            for page, ids in enumerate([['a', 'b'], ['bad', 'c'], ['d']]):
+                read.append(page)
+                yield [bulk.BulkAction('index', 'index_name', 'Document', id=x, body={}) for x in ids], ids[-1]
+        result = []
+        for count, failures, checkpoint in bulk.parallel_execute(es, pages(), workers=2):
+            result.append((count, [x.id for x in failures], checkpoint))
+            self.assertLessEqual(len(read) - len(result), 2)  # pages are read lazily
+        self.assertListEqual(result, [(2, [], 'b'), (2, ['bad'], 'c'), (1, [], 'd')])
+        self.assertEqual(es.bulk.call_count, 3)
+
+    def test_asahi_bulk_parallel_execute_error(self):
+        es = MagicMock()
+        es.bulk.side_effect = TransportError(500, 'ServerError')
+        pages = [([bulk.BulkAction('delete', 'index_name', 'Document', id='a')], 'a')]
+        with self.assertRaises(TransportError):
+            list(bulk.parallel_execute(es, pages))
@@ -0,0 +1,67 @@
+import unittest
+from mock import MagicMock, patch
+from asahi.cache import DocumentCache
+
+
+class TestAsahiCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = DocumentCache(max_items=2, ttl=60)
+
+    def test_asahi_cache_get(self):
+        hit = {'_id': 'id-A', '_version': 1, '_source': {'name': 'kelp'}}
+        self.assertIsNone(self.cache.get('id-A'))
+        self.cache.set('id-A', hit)
+        self.assertDictEqual(self.cache.get('id-A'), hit)
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(self.cache.misses, 1)
+
+    def test_asahi_cache_get_copy(self):
+        hit = {'_id': 'id-A', '_version': 1, '_source': {'tags': ['a'], 'meta': {'k': 1}}}
+        self.cache.set('id-A', hit)
+        hit['_source']['tags'].append('set')
+        cached = self.cache.get('id-A')
+        cached['_source']['tags'].append('get')
+        cached['_source']['meta']['k'] = 2
+        self.assertDictEqual(self.cache.get('id-A'),
+                             {'_id': 'id-A', '_version': 1, '_source': {'tags': ['a'], 'meta': {'k': 1}}})
+
+    def test_asahi_cache_lru(self):
+        self.cache.set('id-A', {'_source': {}})
+        self.cache.set('id-B', {'_source': {}})
+        self.cache.get('id-A')
+        self.cache.set('id-C', {'_source': {}})
+        self.assertIsNone(self.cache.get('id-B'))
+        self.assertIsNotNone(self.cache.get('id-A'))
+        self.assertEqual(self.cache.evictions, 1)
+
+    def test_asahi_cache_ttl(self):
+        self.cache.set('id-A', {'_source': {}})
+        with patch('asahi.cache.time.time', new=MagicMock(return_value=2 ** 40)):
+            self.assertIsNone(self.cache.get('id-A'))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_asahi_cache_max_bytes(self):
+        cache = DocumentCache(max_bytes=30)
+        cache.set('id-A', {'_source': {'name': 'a' * 10}})
+        cache.set('id-B', {'_source': {'name': 'b' * 10}})
+        cache.set('id-C', {'_source': {'name': 'c' * 100}})
+        self.assertIsNone(cache.get('id-A'))
+        self.assertIsNotNone(cache.get('id-B'))
+        self.assertIsNone(cache.get('id-C'))
+        self.assertEqual(cache.stats()['bytes'], 22)
+        cache.set('id-B', {'_source': {'name': 'b' * 100}})  # the larger hit replaces the cached one
+        self.assertIsNone(cache.get('id-B'))
+        self.assertEqual(cache.stats()['bytes'], 0)
+
+    def test_asahi_cache_invalidate(self):
+        self.cache.set('id-A', {'_source': {}})
+        self.cache.invalidate('id-A')
+        self.assertIsNone(self.cache.get('id-A'))
+        self.assertEqual(self.cache.stats()['items'], 0)
+
+    def test_asahi_cache_invalidate_version(self):
+        self.cache.invalidate('id-A', version=2)
+        self.cache.set('id-A', {'_id': 'id-A', '_version': 1, '_source': {}})  # it was read before the write
+        self.assertIsNone(self.cache.get('id-A'))
+        self.cache.set('id-A', {'_id': 'id-A', '_version': 2, '_source': {}})
+        self.assertIsNotNone(self.cache.get('id-A'))
@@ -1,13 +1,16 @@
 import unittest
 from asahi import db
 from asahi.document import Document
+from asahi.cache import DocumentCache
 from asahi.properties import *
 
 
 class TestAsahiDB(unittest.TestCase):
     def test_asahi_db_document(self):
         self.assertIs(db.Document, Document)
-        
+    def test_asahi_db_document_cache(self):
+        self.assertIs(db.DocumentCache, DocumentCache)
+
     def test_asahi_db_property_property(self):
         self.assertIs(db.Property, Property)
     def test_asahi_db_property_string_property(self):
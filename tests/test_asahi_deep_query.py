@@ -0,0 +1,137 @@
+import asyncio
+import unittest
+from mock import MagicMock, patch
+from asahi.cache import DocumentCache
+from asahi.document import Document, reset_ensured_indices
+from asahi.properties import StringProperty, ReferenceProperty
+from asahi.exceptions import PropertyNotExist
+from asahi.deep_query import update_reference_properties, aupdate_reference_properties, update_batch_reference_properties
+
+
+class FakeCompany(Document):
+    name = StringProperty()
+class FakeUser(Document):
+    name = StringProperty()
+    company = ReferenceProperty(FakeCompany)
+class FakeArticle(Document):
+    title = StringProperty()
+    author = ReferenceProperty(FakeUser)
+    editor = ReferenceProperty(FakeUser)
+
+
+class TestAsahiDeepQuery(unittest.TestCase):
+    def setUp(self):
+        reset_ensured_indices()
+        self.hits = {
+            ('FakeCompany', 'company-A'): {'_source': {'name': 'rinse'}},
+            ('FakeUser', 'user-A'): {'_source': {'company': 'company-A'}},
+            ('FakeUser', 'user-B'): {'_source': {'company': 'company-A'}},
+        }
+        self.fake_es = MagicMock()
+        self.fake_es.mget.side_effect = self.__mget
+        self.patches = [
+            patch('asahi.document.Document._es', new=self.fake_es),
+            patch.object(FakeCompany, 'get_index_name', return_value='fakecompany'),
+            patch.object(FakeUser, 'get_index_name', return_value='fakeuser'),
+        ]
+        for x in self.patches:
+            x.start()
+        self.articles = [
+            FakeArticle._from_hit({'_id': 'article-A', '_version': 1,
+                                   '_source': {'author': 'user-A', 'editor': 'user-B'}}),
+            FakeArticle._from_hit({'_id': 'article-B', '_version': 1,
+                                   '_source': {'author': 'user-A', 'editor': 'user-A'}}),
+        ]
+
+    def tearDown(self):
+        for x in self.patches:
+            x.stop()
+
+    def __mget(self, body):
+        docs = []
+        for doc in body['docs']:
+            hit = self.hits.get((doc['_type'], doc['_id']))
+            if hit is None:
+                docs.append(dict(doc, found=False))
+            else:
+                docs.append(dict(doc, found=True, _version=1, **hit))
+        return {'docs': docs}
+
+    def __get_requested_docs(self):
+        return [sorted([(x['_type'], x['_id']) for x in call[1]['body']['docs']]) for call in self.fake_es.mget.call_args_list]
+
+    def test_asahi_deep_query_update_reference_properties(self):
+        update_reference_properties(self.articles)
+        self.assertListEqual(self.__get_requested_docs(), [[('FakeUser', 'user-A'), ('FakeUser', 'user-B')]])
+        self.assertEqual(self.fake_es.mget.call_args[1]['body']['docs'][0]['_index'], 'fakeuser')
+        self.assertEqual(self.articles[0].author._id, 'user-A')
+        self.assertEqual(self.articles[0].editor._id, 'user-B')
+        self.assertIs(self.articles[1].editor, self.articles[0].author)
+        self.assertNotIn('company', self.articles[0].author._reference_document)
+
+    def test_asahi_deep_query_update_reference_properties_include(self):
+        update_reference_properties(self.articles, ['author', 'author.company'])
+        self.assertListEqual(self.__get_requested_docs(), [
+            [('FakeUser', 'user-A')],
+            [('FakeCompany', 'company-A')],
+        ])
+        self.assertIs(self.articles[1].author, self.articles[0].author)
+        self.assertEqual(self.articles[0].author.company.name, 'rinse')
+        # editor is not included, so it is the raw id
+        self.assertEqual(self.articles[0]._document['editor'], 'user-B')
+        self.assertNotIn('editor', self.articles[0]._reference_document)
+
+    def test_asahi_deep_query_update_reference_properties_include_nested_only(self):
+        update_reference_properties(self.articles, ['author.company'])
+        self.assertEqual(self.fake_es.mget.call_count, 2)
+        self.assertEqual(self.articles[0].author.company._id, 'company-A')
+
+    def test_asahi_deep_query_update_reference_properties_empty_include(self):
+        update_reference_properties(self.articles, [])
+        self.fake_es.mget.assert_not_called()
+
+    def test_asahi_deep_query_update_reference_properties_not_reference(self):
+        with self.assertRaises(PropertyNotExist):
+            update_reference_properties(self.articles, ['title'])
+
+    def test_asahi_deep_query_update_reference_properties_not_found(self):
+        del self.hits[('FakeUser', 'user-B')]
+        update_reference_properties(self.articles, ['editor'])
+        self.assertIsNone(self.articles[0].editor)
+        self.assertEqual(self.articles[1].editor._id, 'user-A')
+
+    def test_asahi_deep_query_update_batch_reference_properties_one_request_for_classes(self):
+        users = [FakeUser._from_hit({'_id': 'user-C', '_version': 1, '_source': {'company': 'company-A'}})]
+        update_batch_reference_properties([
+            (self.articles, ['author', 'editor']),
+            (users, ['company']),
+        ])
+        self.assertEqual(self.fake_es.mget.call_count, 1)
+        self.assertSetEqual(set(self.__get_requested_docs()[0]), {
+            ('FakeUser', 'user-A'), ('FakeUser', 'user-B'), ('FakeCompany', 'company-A'),
+        })
+        self.assertEqual(users[0].company.name, 'rinse')
+        self.assertEqual(self.articles[0].editor._id, 'user-B')
+
+    def test_asahi_deep_query_update_reference_properties_cache(self):
+        with patch.object(FakeUser, '_cache', DocumentCache()):
+            update_reference_properties(self.articles, ['author'])
+            update_reference_properties(self.articles, ['author', 'editor'])
+        self.assertListEqual(self.__get_requested_docs(), [
+            [('FakeUser', 'user-A')],
+            [('FakeUser', 'user-B')],
+        ])
+        self.assertEqual(self.articles[1].editor._id, 'user-A')
+
+    def test_asahi_deep_query_aupdate_reference_properties(self):
+        async_es = MagicMock()
+        async def mget(body):
+            return self.__mget(body)
+        async def exists(*args, **kwargs):
+            return True
+        async_es.mget.side_effect = mget
+        async_es.indices.exists.side_effect = exists
+        with patch('asahi.document.Document._async_es', new=async_es):
+            asyncio.run(aupdate_reference_properties(self.articles, ['author.company']))
+        self.assertEqual(async_es.mget.call_count, 2)
+        self.assertEqual(self.articles[0].author.company.name, 'rinse')
@@ -1,8 +1,14 @@
+import asyncio
 import unittest
 from mock import MagicMock, patch
+from tests import async_mock
 
 
 class TestAsahiDocument(unittest.TestCase):
+    def setUp(self):
+        from asahi.document import reset_ensured_indices
+        reset_ensured_indices()
+
     def test_asahi_document_get_by_id(self):
         with patch('asahi.document.utils.get_elasticsearch', new=MagicMock()) as mock_es:
             from asahi.document import Document
@@ -27,6 +33,235 @@ class TestAsahiDocument(unittest.TestCase):
             },
         )
 
+    def test_asahi_document_get_index_body(self):
+        from asahi.document import Document
+        from asahi.properties import StringProperty, SUBSTRING_ANALYSIS
+        class SubstringDocument(Document):
+            name = StringProperty()
+            email = StringProperty(searchable='substring')
+        self.assertDictEqual(Document.get_index_body(), {'mappings': {'Document': {'properties': {}}}})
+        body = SubstringDocument.get_index_body()
+        self.assertDictEqual(body['settings'], {'analysis': SUBSTRING_ANALYSIS})
+        self.assertListEqual(list(body['mappings']['SubstringDocument']['properties'].keys()), ['name', 'email'])
+
+    def test_asahi_document_ensure_index_once(self):
+        import threading
+        from asahi.document import Document
+        from asahi.properties import StringProperty
+        class EnsureDocument(Document):
+            name = StringProperty()
+        fake_es = MagicMock()
+        fake_es.indices.exists.return_value = False
+        with patch('asahi.document.Document._es', new=fake_es), \
+                patch.object(EnsureDocument, 'get_index_name', return_value='ensure'):
+            threads = [threading.Thread(target=EnsureDocument.ensure_index) for x in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            EnsureDocument.ensure_index()
+        fake_es.indices.exists.assert_called_once_with(index='ensure')
+        fake_es.indices.create.assert_called_once_with(index='ensure_v1', body=dict(
+            EnsureDocument.get_index_body(), aliases={'ensure': {}}))
+
+    def test_asahi_document_aensure_index_once(self):
+        from asahi.document import Document
+        from asahi.properties import StringProperty
+        class AsyncEnsureDocument(Document):
+            name = StringProperty()
+        async def exists(*args, **kwargs):
+            await asyncio.sleep(0)
+            return False
+        async_es = MagicMock()
+        async_es.indices.exists.side_effect = exists
+        async_es.indices.create = async_mock({'acknowledged': True})
+        async def ensure():
+            await asyncio.gather(*[AsyncEnsureDocument.aensure_index() for x in range(8)])
+            await AsyncEnsureDocument.aensure_index()
+        with patch('asahi.document.Document._async_es', new=async_es), \
+                patch.object(AsyncEnsureDocument, 'get_index_name', return_value='ensure'):
+            asyncio.run(ensure())
+        async_es.indices.exists.assert_called_once_with(index='ensure')
+        self.assertEqual(async_es.indices.create.call_count, 1)
+
+    def test_asahi_document_aensure_index_retry_after_error(self):
+        from asahi.document import Document
+        from asahi.exceptions import TransportError
+        async_es = MagicMock()
+        async_es.indices.exists = async_mock(False)
+        async_es.indices.create = MagicMock(side_effect=TransportError(400, 'MapperParsingException'))
+        with patch('asahi.document.Document._async_es', new=async_es), \
+                patch.object(Document, 'get_index_name', return_value='index_name'):
+            self.assertRaises(TransportError, asyncio.run, Document.aensure_index())
+            async_es.indices.create = async_mock({'acknowledged': True})
+            asyncio.run(Document.aensure_index())
+        self.assertEqual(async_es.indices.create.call_count, 1)
+
+    def test_asahi_document_ensure_index_created_by_others(self):
+        from asahi.document import Document
+        from asahi.exceptions import TransportError
+        fake_es = MagicMock()
+        fake_es.indices.exists.return_value = False
+        fake_es.indices.create.side_effect = TransportError(400, 'IndexAlreadyExistsException[[index_name] already exists]')
+        with patch('asahi.document.Document._es', new=fake_es), \
+                patch.object(Document, 'get_index_name', return_value='index_name'):
+            Document.ensure_index()
+            fake_es.indices.create.side_effect = TransportError(400, 'MapperParsingException')
+            Document.ensure_index()  # it is ensured
+            Document.get_index_name.return_value = 'other_index'
+            self.assertRaises(TransportError, Document.ensure_index)
+
+    def test_asahi_document_sync_mapping_create(self):
+        from asahi.document import Document
+        from asahi.properties import StringProperty
+        class MappingDocument(Document):
+            name = StringProperty(analyzed=False)
+        fake_es = MagicMock()
+        fake_es.indices.exists.return_value = False
+        with patch('asahi.document.Document._es', new=fake_es), \
+                patch.object(MappingDocument, 'get_index_name', return_value='mappingdocument'):
+            result = MappingDocument.sync_mapping()
+        fake_es.indices.create.assert_called_once_with(
+            index='mappingdocument_v1',
+            body={
+                'mappings': {'MappingDocument': {'properties': {'name': {'type': 'string', 'index': 'not_analyzed'}}}},
+                'aliases': {'mappingdocument': {}},
+            },
+        )
+        self.assertDictEqual(result, {'created': True, 'added': ['name'], 'updated': [], 'conflicts': []})
+
+    def test_asahi_document_create_next_index(self):
+        from asahi.document import Document
+        class VersionedDocument(Document):
+            pass
+        fake_es = MagicMock()
+        fake_es.indices.get_alias.return_value = {'versioned_v2': {'aliases': {'versioned': {}}}}
+        with patch('asahi.document.Document._es', new=fake_es), \
+                patch.object(VersionedDocument, 'get_index_name', return_value='versioned'):
+            self.assertEqual(VersionedDocument.create_next_index(), 'versioned_v3')
+        fake_es.indices.create.assert_called_once_with(index='versioned_v3', body={
+            'mappings': {'VersionedDocument': {'properties': {}}},
+            'settings': {'refresh_interval': '-1', 'number_of_replicas': 0},
+        })
+
+    def test_asahi_document_swap_index(self):
+        from asahi.document import Document
+        class VersionedDocument(Document):
+            pass
+        fake_es = MagicMock()
+        fake_es.indices.get_alias.return_value = {
+            'versioned_v1': {'aliases': {'versioned': {}}},
+        }
+        fake_es.indices.get_settings.return_value = {
+            'versioned_v1': {'settings': {'index': {'number_of_replicas': '2'}}},
+        }
+        with patch('asahi.document.Document._es', new=fake_es), \
+                patch.object(VersionedDocument, 'get_index_name', return_value='versioned'):
+            VersionedDocument.swap_index('versioned_v2')
+        fake_es.indices.put_settings.assert_called_once_with(
+            index='versioned_v2', body={'index': {'refresh_interval': '1s', 'number_of_replicas': '2'}})
+        fake_es.indices.update_aliases.assert_called_once_with(body={'actions': [
+            {'remove': {'index': 'versioned_v1', 'alias': 'versioned'}},
+            {'add': {'index': 'versioned_v2', 'alias': 'versioned'}},
+        ]})
+        fake_es.indices.delete.assert_called_once_with(index='versioned_v1')
+
+    def test_asahi_document_swap_index_without_alias(self):
+        from asahi.document import Document
+        from asahi.exceptions import NotFoundError
+        class VersionedDocument(Document):
+            pass
+        fake_es = MagicMock()
+        fake_es.indices.get_alias.side_effect = NotFoundError(404, 'missing')
+        fake_es.indices.exists.return_value = True
+        fake_es.indices.get_settings.return_value = {}
+        with patch('asahi.document.Document._es', new=fake_es), \
+                patch.object(VersionedDocument, 'get_index_name', return_value='versioned'):
+            self.assertListEqual(VersionedDocument.get_index_versions(), ['versioned'])
+            VersionedDocument.swap_index('versioned_v1')
+        fake_es.indices.delete.assert_called_once_with(index='versioned')
+        fake_es.indices.update_aliases.assert_called_once_with(body={'actions': [
+            {'add': {'index': 'versioned_v1', 'alias': 'versioned'}},
+        ]})
+
+    def test_asahi_document_swap_index_without_alias_auto_created(self):
+        from asahi.document import Document
+        from asahi.exceptions import NotFoundError, TransportError
+        class VersionedDocument(Document):
+            pass
+        fake_es = MagicMock()
+        fake_es.indices.get_alias.side_effect = NotFoundError(404, 'missing')
+        fake_es.indices.exists.return_value = True  # a write auto-created the index before the alias is added
+        fake_es.indices.get_settings.return_value = {}
+        fake_es.indices.update_aliases.side_effect = [TransportError(400, 'InvalidAliasNameException'), {}]
+        with patch('asahi.document.Document._es', new=fake_es), \
+                patch('asahi.document.helpers.reindex') as reindex, \
+                patch.object(VersionedDocument, 'get_index_name', return_value='versioned'):
+            VersionedDocument.swap_index('versioned_v1')
+        reindex.assert_called_once_with(fake_es, 'versioned', 'versioned_v1')
+        self.assertEqual(fake_es.indices.delete.call_count, 2)
+        self.assertEqual(fake_es.indices.update_aliases.call_count, 2)
+
+    def test_asahi_document_swap_index_without_alias_error(self):
+        from asahi.document import Document
+        from asahi.exceptions import NotFoundError, TransportError
+        class VersionedDocument(Document):
+            pass
+        fake_es = MagicMock()
+        fake_es.indices.get_alias.side_effect = NotFoundError(404, 'missing')
+        fake_es.indices.exists.side_effect = [True, False]
+        fake_es.indices.get_settings.return_value = {}
+        fake_es.indices.update_aliases.side_effect = TransportError(500, 'ServerError')
+        with patch('asahi.document.Document._es', new=fake_es), \
+                patch.object(VersionedDocument, 'get_index_name', return_value='versioned'):
+            with self.assertRaises(TransportError):
+                VersionedDocument.swap_index('versioned_v1')
+        self.assertEqual(fake_es.indices.update_aliases.call_count, 1)
+
+    def test_asahi_document_sync_mapping_diff(self):
+        from asahi.document import Document
+        from asahi.properties import StringProperty, IntegerProperty, DictProperty
+        class MappingDocument(Document):
+            name = StringProperty(analyzed=False)
+            email = StringProperty(searchable='substring')
+            age = IntegerProperty()
+            payload = DictProperty()
+            tag = StringProperty(eager_global_ordinals=True)
+        fake_es = MagicMock()
+        fake_es.indices.exists.return_value = True
+        fake_es.indices.get_mapping.return_value = {
+            'mapping_v1': {
+                'mappings': {
+                    'MappingDocument': {
+                        'properties': {
+                            'name': {'type': 'string'},
+                            'email': {'type': 'string'},
+                            'payload': {'properties': {'a': {'type': 'long'}}},
+                            'tag': {'type': 'string'},
+                        }
+                    }
+                }
+            }
+        }
+        with patch('asahi.document.Document._es', new=fake_es), \
+                patch.object(MappingDocument, 'get_index_name', return_value='mapping'):
+            result = MappingDocument.sync_mapping()
+        self.assertDictEqual(result, {
+            'created': False,
+            'added': ['age'],
+            'updated': ['email', 'tag'],
+            'conflicts': ['name'],
+        })
+        fake_es.indices.put_mapping.assert_called_once_with(
+            index='mapping',
+            doc_type='MappingDocument',
+            body={'properties': {
+                'email': MappingDocument.email.get_mapping(),
+                'age': {'type': 'long'},
+                'tag': MappingDocument.tag.get_mapping(),
+            }},
+        )
+
     def test_asahi_document_where(self):
         from asahi.document import Document
         with patch('asahi.document.Query', new=MagicMock()) as mock_query:
@@ -57,6 +292,141 @@ class TestAsahiDocument(unittest.TestCase):
             body={}
         )
 
+    def test_asahi_document_dirty(self):
+        from asahi.document import Document
+        from asahi.properties import StringProperty, ListProperty
+        class DirtyDocument(Document):
+            name = StringProperty()
+            tags = ListProperty(str)
+        self.assertIsNone(DirtyDocument(name='asahi', tags=[])._dirty)
+        document = DirtyDocument._from_hit({'_id': 'id-A', '_version': 1, '_source': {'name': 'asahi', 'tags': []}})
+        self.assertSetEqual(document._dirty, set())
+        self.assertTrue(document._is_clean())
+        self.assertListEqual(document.tags, [])
+        self.assertTrue(document._is_clean())  # reading doesn't change the list
+        document.name = 'kelp'
+        self.assertSetEqual(document._dirty, {'name'})
+        document.tags.append('a')  # lists could be changed in place
+        self.assertSetEqual(document._get_changed_names(), {'name', 'tags'})
+        self.assertFalse(document._is_clean())
+
+    def test_asahi_document_dirty_in_place(self):
+        from asahi.document import Document
+        from asahi.properties import ListProperty, DictProperty
+        class DirtyDocument(Document):
+            tags = ListProperty(str)
+            extra = DictProperty()
+        document = DirtyDocument._from_hit({'_id': 'id-A', '_version': 1, '_source': {'tags': ['a'], 'extra': {'x': 1}}})
+        tags, extra = document.tags, document.extra
+        with patch('asahi.document.Document._es', new=MagicMock()) as mock_es, \
+                patch.object(DirtyDocument, 'get_index_name', return_value='index_name'):
+            mock_es.update.return_value = {'_id': 'id-A', '_version': 2}
+            document.save(partial=True)
+            self.assertFalse(mock_es.update.called)
+            extra['x'] = 2
+            document.save(partial=True)
+            self.assertDictEqual(mock_es.update.call_args[1]['body'], {'doc': {'extra': {'x': 2}}})
+            tags.append('b')  # the list which was read before the last save
+            self.assertFalse(document._is_clean())
+            document.save(partial=True)
+            self.assertDictEqual(mock_es.update.call_args[1]['body'], {'doc': {'tags': ['a', 'b']}})
+        self.assertTrue(document._is_clean())
+
+    def test_asahi_document_save_skip_clean(self):
+        from asahi.document import Document
+        from asahi.properties import StringProperty
+        class DirtyDocument(Document):
+            name = StringProperty()
+        document = DirtyDocument._from_hit({'_id': 'id-A', '_version': 1, '_source': {'name': 'asahi'}})
+        with patch('asahi.document.Document._es', new=MagicMock()) as mock_es, \
+                patch.object(DirtyDocument, 'get_index_name', return_value='index_name'):
+            document.save()
+            self.assertFalse(mock_es.index.called)
+            mock_es.index.return_value = {'_id': 'id-A', '_version': 2}
+            document.name = 'kelp'
+            document.save()
+            document.save()
+        self.assertEqual(mock_es.index.call_count, 1)
+        self.assertEqual(document._version, 2)
+        self.assertSetEqual(document._dirty, set())
+
+    def test_asahi_document_save_partial(self):
+        from asahi.document import Document
+        from asahi.properties import StringProperty, IntegerProperty, DictProperty
+        class DirtyDocument(Document):
+            name = StringProperty()
+            views = IntegerProperty()
+            payload = DictProperty(deferred=True)
+        document = DirtyDocument._from_hit({'_id': 'id-A', '_version': 3, '_source': {'name': 'asahi', 'views': 1}},
+                                           {'payload'})
+        document.views += 1
+        with patch('asahi.document.Document._es', new=MagicMock()) as mock_es, \
+                patch.object(DirtyDocument, 'get_index_name', return_value='index_name'):
+            mock_es.update.return_value = {'_id': 'id-A', '_version': 4}
+            document.save(partial=True)
+        mock_es.update.assert_called_once_with(
+            index='index_name',
+            doc_type='DirtyDocument',
+            id='id-A',
+            version=3,
+            body={'doc': {'views': 2}},
+        )
+        self.assertFalse(mock_es.get.called)  # deferred properties are not loaded
+        self.assertFalse(mock_es.index.called)
+        self.assertEqual(document._version, 4)
+        self.assertSetEqual(document._dirty, set())
+
+    def test_asahi_document_save_partial_new_document(self):
+        from asahi.document import Document
+        document = Document()
+        document.get_index_name = MagicMock(return_value='index_name')
+        with patch('asahi.document.Document._es', new=MagicMock()) as mock_es:
+            mock_es.index.return_value = {'_id': 'id-A', '_version': 1}
+            document.save(partial=True)
+        self.assertFalse(mock_es.update.called)
+        self.assertEqual(mock_es.index.call_count, 1)
+
+    def test_asahi_document_asave_partial(self):
+        from asahi.document import Document
+        from asahi.properties import StringProperty
+        class DirtyDocument(Document):
+            name = StringProperty()
+        document = DirtyDocument._from_hit({'_id': 'id-A', '_version': 1, '_source': {'name': 'asahi'}})
+        document.name = 'kelp'
+        async def update(*args, **kwargs):
+            return {'_id': 'id-A', '_version': 2}
+        async def exists(*args, **kwargs):
+            return True
+        async_es = MagicMock()
+        async_es.update.side_effect = update
+        async_es.indices.exists.side_effect = exists
+        with patch('asahi.document.Document._async_es', new=async_es), \
+                patch.object(DirtyDocument, 'get_index_name', return_value='index_name'):
+            asyncio.run(document.asave(partial=True))
+        self.assertDictEqual(async_es.update.call_args[1]['body'], {'doc': {'name': 'kelp'}})
+        self.assertEqual(document._version, 2)
+
+    def test_asahi_document_save_many_partial(self):
+        from asahi.document import Document
+        from asahi.properties import StringProperty
+        class DirtyDocument(Document):
+            name = StringProperty()
+        documents = [
+            DirtyDocument._from_hit({'_id': 'id-A', '_version': 1, '_source': {'name': 'asahi'}}),
+            DirtyDocument._from_hit({'_id': 'id-B', '_version': 1, '_source': {'name': 'asahi'}}),
+        ]
+        documents[1].name = 'kelp'
+        with patch('asahi.document.Document._es', new=MagicMock()) as mock_es, \
+                patch.object(DirtyDocument, 'get_index_name', return_value='index_name'):
+            mock_es.bulk.return_value = {'items': [{'update': {'_id': 'id-B', '_version': 2, 'status': 200}}]}
+            DirtyDocument.save_many(documents, partial=True)
+        body = mock_es.bulk.call_args[1]['body']
+        self.assertEqual(body.count('\n'), 2)  # the clean document is skipped
+        self.assertIn('"update"', body)
+        self.assertIn('{"doc":{"name":"kelp"}}', body.replace(' ', ''))
+        self.assertEqual(documents[1]._version, 2)
+        self.assertSetEqual(documents[1]._dirty, set())
+
     def test_asahi_document_delete(self):
         from asahi.document import Document
         document = Document(_id='byMQ-ULRSJ291RG_eEwSfQ', _version=1)
@@ -68,3 +438,275 @@ class TestAsahiDocument(unittest.TestCase):
             id='byMQ-ULRSJ291RG_eEwSfQ',
             doc_type='Document'
         )
+
+    def test_asahi_document_save_many(self):
+        from asahi.document import Document
+        documents = [Document(), Document(_id='id-B', _version=2)]
+        Document.get_index_name = MagicMock(return_value='index_name')
+        with patch('asahi.document.Document._es', new=MagicMock()) as mock_es:
+            mock_es.bulk.return_value = {
+                'items': [
+                    {'index': {'_id': 'id-A', '_version': 1, 'status': 201}},
+                    {'index': {'_id': 'id-B', '_version': 3, 'status': 200}},
+                ]
+            }
+            Document.save_many(documents)
+        self.assertEqual(mock_es.bulk.call_count, 1)
+        self.assertEqual(documents[0]._id, 'id-A')
+        self.assertEqual(documents[0]._version, 1)
+        self.assertEqual(documents[1]._version, 3)
+
+    def test_asahi_document_save_many_failed(self):
+        from asahi.document import Document
+        from asahi.exceptions import BulkError
+        documents = [Document(_id='id-A', _version=1)]
+        Document.get_index_name = MagicMock(return_value='index_name')
+        with patch('asahi.document.Document._es', new=MagicMock()) as mock_es:
+            mock_es.bulk.return_value = {
+                'items': [
+                    {'index': {'_id': 'id-A', 'status': 409, 'error': 'VersionConflictEngineException'}},
+                ]
+            }
+            with self.assertRaises(BulkError) as context:
+                Document.save_many(documents)
+        self.assertEqual(context.exception.errors[0]['document'], documents[0])
+        self.assertEqual(context.exception.errors[0]['status'], 409)
+        self.assertEqual(documents[0]._version, 1)
+
+    def test_asahi_document_save_many_chunk_error(self):
+        from asahi.document import Document
+        from asahi.exceptions import TransportError
+        documents = [Document() for _ in range(4)]
+        Document.get_index_name = MagicMock(return_value='index_name')
+        with patch('asahi.document.Document._es', new=MagicMock()) as mock_es:
+            mock_es.bulk.side_effect = [
+                {'items': [
+                    {'index': {'_id': 'id-A', '_version': 1, 'status': 201}},
+                    {'index': {'_id': 'id-B', '_version': 1, 'status': 201}},
+                ]},
+                TransportError(500, 'ServerError'),
+            ]
+            with self.assertRaises(TransportError):
+                Document.save_many(documents, chunk_size=2)
+        self.assertListEqual([x._id for x in documents], ['id-A', 'id-B', None, None])
+        self.assertListEqual([x._is_clean() for x in documents], [True, True, False, False])
+
+    def test_asahi_document_delete_many(self):
+        from asahi.document import Document
+        documents = [Document(_id='id-A', _version=1), Document()]
+        Document.get_index_name = MagicMock(return_value='index_name')
+        with patch('asahi.document.Document._es', new=MagicMock()) as mock_es:
+            mock_es.bulk.return_value = {
+                'items': [
+                    {'delete': {'_id': 'id-A', '_version': 2, 'status': 200}},
+                ]
+            }
+            Document.delete_many(documents, synchronized=True)
+        mock_es.bulk.assert_called_once_with(
+            body='{"delete": {"_index": "index_name", "_type": "Document", "_id": "id-A"}}\n'
+        )
+        mock_es.indices.refresh.assert_called_once_with(index='index_name')
+
+    def test_asahi_document_get_by_ids_cached(self):
+        from asahi.document import Document
+        from asahi.cache import DocumentCache
+        class CachedDocument(Document):
+            _cache = DocumentCache()
+        CachedDocument.get_index_name = MagicMock(return_value='index_name')
+        CachedDocument._cache.set(('CachedDocument', 'id-A'), {'_id': 'id-A', '_version': 1, '_source': {}})
+        with patch('asahi.document.Document._es', new=MagicMock()) as mock_es:
+            mock_es.mget.return_value = {
+                'docs': [{'_id': 'id-B', '_version': 2, '_source': {}, 'found': True}]
+            }
+            documents = CachedDocument.get(['id-A', 'id-B'])
+            CachedDocument.get('id-B')
+        mock_es.mget.assert_called_once_with(
+            index='index_name',
+            doc_type='CachedDocument',
+            body={
+                'ids': ['id-B']
+            },
+        )
+        self.assertFalse(mock_es.get.called)
+        self.assertListEqual([x._id for x in documents], ['id-A', 'id-B'])
+        self.assertEqual(CachedDocument._cache.hits, 2)
+
+    def test_asahi_document_get_cached_mutation(self):
+        from asahi.document import Document
+        from asahi.properties import ListProperty, DictProperty
+        from asahi.cache import DocumentCache
+        class CachedDocument(Document):
+            _cache = DocumentCache()
+            tags = ListProperty(str)
+            meta = DictProperty()
+        CachedDocument.get_index_name = MagicMock(return_value='index_name')
+        with patch('asahi.document.Document._es', new=MagicMock()) as mock_es:
+            mock_es.mget.return_value = {
+                'docs': [{'_id': 'id-A', '_version': 1, '_source': {'tags': ['a'], 'meta': {'k': 1}}, 'found': True}]
+            }
+            for _ in range(2):
+                document = CachedDocument.get(['id-A'])[0]
+                document.tags.append('MUTATED')  # not saved
+                document.meta['k'] = 2
+            document = CachedDocument.get(['id-A'])[0]
+        self.assertEqual(mock_es.mget.call_count, 1)
+        self.assertListEqual(document.tags, ['a'])
+        self.assertDictEqual(dict(document.meta), {'k': 1})
+
+    def test_asahi_document_save_invalidate_cache(self):
+        from asahi.document import Document
+        from asahi.cache import DocumentCache
+        class CachedDocument(Document):
+            _cache = DocumentCache()
+        CachedDocument._cache.set(('CachedDocument', 'id-A'), {'_id': 'id-A', '_version': 1, '_source': {}})
+        document = CachedDocument(_id='id-A', _version=1)
+        document.get_index_name = MagicMock(return_value='index_name')
+        with patch('asahi.document.Document._es', new=MagicMock()) as mock_es:
+            mock_es.index.return_value = {'_id': 'id-A', '_version': 2}
+            document.save()
+        self.assertEqual(len(CachedDocument._cache), 0)
+
+    def test_asahi_document_get_cache_fill_after_save(self):
+        from asahi.document import Document
+        from asahi.cache import DocumentCache
+        class CachedDocument(Document):
+            _cache = DocumentCache()
+        def get(*args, **kwargs):
+            # the document is saved by others after ElasticSearch responded the old version
+            CachedDocument(_id='id-A', _version=2)._invalidate_cache(2)
+            return {'_id': 'id-A', '_version': 1, '_source': {}}
+        with patch('asahi.document.Document._es', new=MagicMock()) as mock_es, \
+                patch.object(CachedDocument, 'get_index_name', return_value='index_name'):
+            mock_es.get.side_effect = get
+            self.assertEqual(CachedDocument.get('id-A', fetch_reference=False)._version, 1)
+        self.assertEqual(len(CachedDocument._cache), 0)
+
+    def test_asahi_document_aget_by_id(self):
+        from asahi.document import Document
+        Document.get_index_name = MagicMock(return_value='index_name')
+        with patch('asahi.document.Document._async_es', new=MagicMock()) as mock_es:
+            mock_es.indices.exists = async_mock(True)
+            mock_es.get = async_mock({'_id': 'id', '_version': 1, '_source': {}, 'found': True})
+            document = asyncio.run(Document.aget('id'))
+        mock_es.get.assert_called_once_with(
+            index='index_name',
+            doc_type='Document',
+            id='id',
+        )
+        self.assertEqual(document._id, 'id')
+        self.assertEqual(document._version, 1)
+
+    def test_asahi_document_aget_by_ids(self):
+        from asahi.document import Document
+        Document.get_index_name = MagicMock(return_value='index_name')
+        with patch('asahi.document.Document._async_es', new=MagicMock()) as mock_es:
+            mock_es.indices.exists = async_mock(True)
+            mock_es.mget = async_mock({'docs': [{'_id': 'id-A', '_version': 1, '_source': {}, 'found': True}]})
+            documents = asyncio.run(Document.aget(['id-A']))
+        mock_es.mget.assert_called_once_with(
+            index='index_name',
+            doc_type='Document',
+            body={
+                'ids': ['id-A']
+            },
+        )
+        self.assertListEqual([x._id for x in documents], ['id-A'])
+
+    def test_asahi_document_asave(self):
+        from asahi.document import Document
+        document = Document()
+        document.get_index_name = MagicMock(return_value='index_name')
+        with patch('asahi.document.Document._async_es', new=MagicMock()) as mock_es:
+            mock_es.indices.exists = async_mock(True)
+            mock_es.index = async_mock({'_id': 'id-A', '_version': 1})
+            asyncio.run(document.asave())
+        mock_es.index.assert_called_once_with(
+            index='index_name',
+            doc_type='Document',
+            id=None,
+            version=0,
+            body={}
+        )
+        self.assertEqual(document._id, 'id-A')
+        self.assertEqual(document._version, 1)
+
+    def test_asahi_document_properties_at_class_creation(self):
+        from asahi.document import Document
+        from asahi.properties import StringProperty, IntegerProperty
+        class BaseDocument(Document):
+            name = StringProperty()
+            email = StringProperty()
+        class SubDocument(BaseDocument):
+            age = IntegerProperty()
+            email = None
+        self.assertListEqual(list(BaseDocument.get_properties().keys()), ['_id', '_version', 'name', 'email'])
+        self.assertListEqual(list(SubDocument.get_properties().keys()), ['_id', '_version', 'name', 'age'])
+        self.assertIs(SubDocument.get_properties(), SubDocument._properties)
+        self.assertIs(SubDocument()._properties, SubDocument._properties)
+        with self.assertRaises(TypeError):
+            SubDocument._properties['age'] = None
+
+    def test_asahi_document_get_only(self):
+        from asahi.document import Document
+        from asahi.properties import StringProperty, DictProperty
+        class ProjectedDocument(Document):
+            name = StringProperty()
+            email = StringProperty()
+            payload = DictProperty(deferred=True)
+        ProjectedDocument.get_index_name = MagicMock(return_value='index_name')
+        with patch('asahi.document.Document._es', new=MagicMock()) as mock_es:
+            mock_es.get.return_value = {'_id': 'id-A', '_version': 1, '_source': {'name': 'kelp'}, 'found': True}
+            document = ProjectedDocument.get('id-A', only=['name'])
+            mock_es.get.assert_called_once_with(
+                index='index_name',
+                doc_type='ProjectedDocument',
+                id='id-A',
+                _source_include=['name'],
+            )
+            self.assertSetEqual(document._deferred, {'email', 'payload'})
+            mock_es.get.return_value = {'_id': 'id-A', '_version': 1, '_source': {'email': 'kelp@rinse.io'}}
+            self.assertEqual(document.email, 'kelp@rinse.io')
+        mock_es.get.assert_called_with(
+            index='index_name',
+            doc_type='ProjectedDocument',
+            id='id-A',
+            _source_include=['email'],
+        )
+        self.assertSetEqual(document._deferred, {'payload'})
+
+    def test_asahi_document_get_deferred_property(self):
+        from asahi.document import Document
+        from asahi.properties import StringProperty, DictProperty
+        class ProjectedDocument(Document):
+            name = StringProperty()
+            payload = DictProperty(deferred=True)
+        ProjectedDocument.get_index_name = MagicMock(return_value='index_name')
+        with patch('asahi.document.Document._es', new=MagicMock()) as mock_es:
+            mock_es.mget.return_value = {'docs': [{'_id': 'id-A', '_version': 1, '_source': {'name': 'kelp'}, 'found': True}]}
+            documents = ProjectedDocument.get(['id-A'])
+            documents[0].payload = {'a': 1}
+        mock_es.mget.assert_called_once_with(
+            index='index_name',
+            doc_type='ProjectedDocument',
+            body={
+                'ids': ['id-A']
+            },
+            _source_exclude=['payload'],
+        )
+        self.assertSetEqual(documents[0]._deferred, set())
+        self.assertFalse(mock_es.get.called)
+
+    def test_asahi_document_save_load_deferred(self):
+        from asahi.document import Document
+        from asahi.properties import StringProperty, DictProperty
+        class ProjectedDocument(Document):
+            title = StringProperty()
+            payload = DictProperty(deferred=True)
+        document = ProjectedDocument._from_hit({'_id': 'id-A', '_version': 1, '_source': {}}, {'payload'})
+        document.get_index_name = MagicMock(return_value='index_name')
+        document.title = 'asahi'
+        with patch('asahi.document.Document._es', new=MagicMock()) as mock_es:
+            mock_es.get.return_value = {'_source': {'payload': {'a': 1}}}
+            mock_es.index.return_value = {'_id': 'id-A', '_version': 2}
+            document.save()
+        self.assertDictEqual(mock_es.index.call_args[1]['body'], {'title': 'asahi', 'payload': {'a': 1}})
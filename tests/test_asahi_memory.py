@@ -0,0 +1,387 @@
+import asyncio
+import unittest
+from datetime import datetime
+from mock import patch
+from asahi import msearch, Session, refresh_after
+from asahi import utils
+from asahi.document import Document
+from asahi.properties import StringProperty, IntegerProperty, FloatProperty, BooleanProperty, DateTimeProperty,\
+    ListProperty, DictProperty, ReferenceProperty
+from asahi.aggregations import Terms, DateHistogram, Stats, Sum, Percentiles, Cardinality, Bucket
+from asahi.memory import MemoryElasticsearch, AsyncMemoryElasticsearch
+from asahi.exceptions import NotFoundError, ConflictError, BulkError
+
+
+class MemoryCompany(Document):
+    name = StringProperty()
+class MemoryUser(Document):
+    name = StringProperty()
+    email = StringProperty(analyzed=False)
+    company = ReferenceProperty(MemoryCompany)
+class MemoryArticle(Document):
+    title = StringProperty(searchable='substring')
+    summary = StringProperty()
+    category = StringProperty(analyzed=False)
+    views = IntegerProperty()
+    score = FloatProperty()
+    published = BooleanProperty()
+    tags = ListProperty(str, default=[])
+    created_at = DateTimeProperty()
+    extra = DictProperty()
+    author = ReferenceProperty(MemoryUser)
+
+
+class TestAsahiMemory(unittest.TestCase):
+    def setUp(self):
+        self.es = MemoryElasticsearch()
+        self.es.reset()
+        self.patches = [
+            patch('asahi.document.Document._es', new=self.es),
+            patch('asahi.document.Document._async_es', new=AsyncMemoryElasticsearch(self.es)),
+            patch.object(MemoryCompany, 'get_index_name', return_value='memorycompany'),
+            patch.object(MemoryUser, 'get_index_name', return_value='memoryuser'),
+            patch.object(MemoryArticle, 'get_index_name', return_value='memoryarticle'),
+        ]
+        for x in self.patches:
+            x.start()
+
+    def tearDown(self):
+        for x in self.patches:
+            x.stop()
+        self.es.reset()
+
+    def __save_articles(self):
+        articles = [
+            MemoryArticle(title='Asahi ElasticSearch', summary='The ORM of ElasticSearch', category='orm', views=10,
+                          score=1.5, published=True, tags=['python', 'search'], created_at=datetime(2016, 10, 1, 8),
+                          extra={'source': 'web'}),
+            MemoryArticle(title='Rinse kelp', summary='Notes of kelp', category='note', views=3, score=0.5,
+                          published=False, tags=['kelp'], created_at=datetime(2016, 10, 2, 20),
+                          extra={'source': 'app'}),
+            MemoryArticle(title='Python asyncio', summary='The asyncio api', category='orm', views=7, score=2.5,
+                          published=True, tags=['python'], created_at=datetime(2016, 11, 5)),
+            MemoryArticle(title='Draft', category='draft'),
+        ]
+        with refresh_after():
+            for article in articles:
+                article.save(synchronized=True)
+        return articles
+
+    def __fetch_titles(self, query, **kwargs):
+        documents, total = query.fetch(fetch_reference=False, **kwargs)
+        return [x.title for x in documents], total
+
+    def test_asahi_memory_url(self):
+        client = utils.get_elasticsearch('memory://test')
+        self.assertIsInstance(client, MemoryElasticsearch)
+        self.assertIs(utils.get_elasticsearch('memory://test'), client)
+        self.assertIsNot(utils.get_elasticsearch('memory://other'), client)
+        async def get_async_client():
+            return utils.get_async_elasticsearch('memory://test')
+        async_client = asyncio.run(get_async_client())
+        self.assertIsInstance(async_client, AsyncMemoryElasticsearch)
+        self.assertIs(async_client.target, client)
+        utils.reset_elasticsearch()
+
+    def test_asahi_memory_save_get_delete(self):
+        user = MemoryUser(name='Kelp', email='kelp@rinse.io')
+        user.save()
+        self.assertEqual(user._version, 1)
+        self.assertTrue(self.es.indices.exists(index='memoryuser'))
+        self.assertTrue(self.es.indices.exists(index='memoryuser_v1'))
+        fetched = MemoryUser.get(user._id)
+        self.assertEqual(fetched.name, 'Kelp')
+        self.assertEqual(fetched._version, 1)
+        fetched.name = 'Rinse'
+        fetched.save()
+        self.assertEqual(fetched._version, 2)
+        self.assertIsNone(MemoryUser.get('missing'))
+        self.assertEqual([x.name for x in MemoryUser.get([user._id, 'missing'])], ['Rinse'])
+
+        user.name = 'stale'
+        with self.assertRaises(ConflictError):
+            user.save()  # the version 1 was changed
+        fetched.delete()
+        self.assertIsNone(MemoryUser.get(user._id))
+        with self.assertRaises(NotFoundError):
+            fetched.delete()
+
+    def test_asahi_memory_near_real_time(self):
+        user = MemoryUser(name='Kelp')
+        user.save()
+        self.assertEqual(MemoryUser.get(user._id).name, 'Kelp')  # get is realtime
+        self.assertEqual(MemoryUser.all().count(), 0)  # not refreshed
+        MemoryUser.refresh()
+        self.assertEqual(MemoryUser.where('name', equal='kelp').count(), 1)
+        user.name = 'Rinse'
+        user.save()
+        self.assertEqual(MemoryUser.where('name', equal='kelp').count(), 1)
+        with patch('asahi.memory.time.monotonic', return_value=2 ** 40):  # refresh_interval passed
+            self.assertEqual(MemoryUser.where('name', equal='rinse').count(), 1)
+            self.assertEqual(MemoryUser.where('name', equal='kelp').count(), 0)
+        self.es.indices.put_settings(index='memoryuser', body={'index': {'refresh_interval': '-1'}})
+        user.delete()
+        with patch('asahi.memory.time.monotonic', return_value=2 ** 41):
+            self.assertEqual(MemoryUser.all().count(), 1)
+        self.es.indices.refresh(index='memoryuser')
+        self.assertEqual(MemoryUser.all().count(), 0)
+
+    def test_asahi_memory_stored_documents_are_copied(self):
+        article = MemoryArticle(title='asahi', tags=['a'])
+        article.save()
+        article.tags.append('b')  # not saved
+        fetched = MemoryArticle.get(article._id)
+        fetched.tags.append('c')
+        self.assertListEqual(MemoryArticle.get(article._id).tags, ['a'])
+
+    def test_asahi_memory_partial_save(self):
+        article = MemoryArticle(title='asahi', views=1, extra={'source': 'web', 'lang': 'en'})
+        article.save()
+        fetched = MemoryArticle.get(article._id)
+        fetched.views = 2
+        fetched.save(partial=True)
+        self.assertEqual(fetched._version, 2)
+        result = MemoryArticle.get(article._id)
+        self.assertEqual((result.title, result.views), ('asahi', 2))
+        self.es.update(index='memoryarticle', doc_type='MemoryArticle', id=article._id,
+                       body={'doc': {'extra': {'lang': 'ja'}}})
+        self.assertDictEqual(MemoryArticle.get(article._id).extra, {'source': 'web', 'lang': 'ja'})
+        article.views = 3
+        with self.assertRaises(ConflictError):
+            article.save(partial=True)
+
+    def test_asahi_memory_query_operations(self):
+        self.__save_articles()
+        def titles(query):
+            return sorted(self.__fetch_titles(query)[0])
+        self.assertListEqual(titles(MemoryArticle.where('category', equal='orm')),
+                             ['Asahi ElasticSearch', 'Python asyncio'])
+        self.assertListEqual(titles(MemoryArticle.where('category', unequal='orm')), ['Draft', 'Rinse kelp'])
+        self.assertListEqual(titles(MemoryArticle.where('views', equal=None)), ['Draft'])
+        self.assertListEqual(titles(MemoryArticle.where('views', unequal=None)),
+                             ['Asahi ElasticSearch', 'Python asyncio', 'Rinse kelp'])
+        self.assertListEqual(titles(MemoryArticle.where('views', greater=3)), ['Asahi ElasticSearch', 'Python asyncio'])
+        self.assertListEqual(titles(MemoryArticle.where('views', greater_equal=3).where('views', less=10)),
+                             ['Python asyncio', 'Rinse kelp'])
+        self.assertListEqual(titles(MemoryArticle.where('score', less_equal=1.5)),
+                             ['Asahi ElasticSearch', 'Rinse kelp'])
+        self.assertListEqual(titles(MemoryArticle.where('created_at', greater=datetime(2016, 10, 1, 8))),
+                             ['Python asyncio', 'Rinse kelp'])
+        self.assertListEqual(titles(MemoryArticle.where('published', equal=True)),
+                             ['Asahi ElasticSearch', 'Python asyncio'])
+        self.assertListEqual(titles(MemoryArticle.where('summary', equal='elasticsearch orm')),
+                             ['Asahi ElasticSearch'])
+        self.assertListEqual(titles(MemoryArticle.where('summary', like='asyncio')), ['Python asyncio'])
+        self.assertListEqual(titles(MemoryArticle.where('summary', like='sync')), ['Python asyncio'])
+        self.assertListEqual(titles(MemoryArticle.where('title', like='elastic')), ['Asahi ElasticSearch'])
+        self.assertListEqual(titles(MemoryArticle.where('title', like='Kel')), ['Rinse kelp'])
+        self.assertListEqual(titles(MemoryArticle.where('title', unlike='kelp')),
+                             ['Asahi ElasticSearch', 'Draft', 'Python asyncio'])
+        self.assertListEqual(titles(MemoryArticle.where('tags', contains=['kelp', 'search'])),
+                             ['Asahi ElasticSearch', 'Rinse kelp'])
+        self.assertListEqual(titles(MemoryArticle.where('category', contains=['draft', 'note'])),
+                             ['Draft', 'Rinse kelp'])
+        self.assertListEqual(titles(MemoryArticle.where('extra.source', equal='app')), ['Rinse kelp'])
+        self.assertListEqual(titles(MemoryArticle.where('category', equal='orm').union('category', equal='draft')),
+                             ['Asahi ElasticSearch', 'Draft', 'Python asyncio'])
+        self.assertListEqual(titles(MemoryArticle.where('published', equal=True).where(
+            lambda x: x.where('views', less=5).union('tags', equal='search'))), ['Asahi ElasticSearch'])
+        self.assertListEqual(titles(MemoryArticle.where('category', equal='orm').filter('views', greater=8)),
+                             ['Asahi ElasticSearch'])
+        self.assertListEqual(titles(MemoryArticle.where('tags', contains=[])), [])
+
+    def test_asahi_memory_order_skip_limit(self):
+        self.__save_articles()
+        query = MemoryArticle.all().order_by('views', descending=True)
+        self.assertEqual(self.__fetch_titles(query),
+                         (['Asahi ElasticSearch', 'Python asyncio', 'Rinse kelp', 'Draft'], 4))
+        self.assertEqual(self.__fetch_titles(MemoryArticle.all().order_by('views'), limit=2, skip=1),
+                         (['Rinse kelp', 'Python asyncio'], 4))  # missing values are first ascending
+        query = MemoryArticle.where('views', unequal=None).order_by('category').order_by('score', descending=True)
+        self.assertEqual(self.__fetch_titles(query)[0], ['Rinse kelp', 'Python asyncio', 'Asahi ElasticSearch'])
+        self.assertEqual(MemoryArticle.all().order_by('created_at', descending=True).first().title, 'Python asyncio')
+        self.assertIsNone(MemoryArticle.where('category', equal='missing').first())
+
+    def test_asahi_memory_count(self):
+        self.__save_articles()
+        self.assertEqual(MemoryArticle.all().count(), 4)
+        self.assertEqual(MemoryArticle.where('category', equal='orm').count(), 2)
+        self.assertEqual(MemoryArticle.all().count(upto=3), 3)
+        self.assertTrue(MemoryArticle.where('category', equal='note').exists())
+        self.assertFalse(MemoryArticle.where('category', equal='missing').exists())
+
+    def test_asahi_memory_only_defer(self):
+        article = self.__save_articles()[0]
+        fetched = MemoryArticle.where('category', equal='orm').only('title').order_by('views').fetch()[0][-1]
+        self.assertEqual(fetched._id, article._id)
+        self.assertNotIn('summary', fetched._document)
+        self.assertEqual(fetched.summary, 'The ORM of ElasticSearch')  # loaded by get
+
+    def test_asahi_memory_iter(self):
+        with refresh_after():
+            for index in range(25):
+                MemoryUser(name='user %d' % index, email='%02d' % index).save(synchronized=True)
+        users = list(MemoryUser.all().order_by('email').iter(batch_size=10, fetch_reference=False))
+        self.assertListEqual([x.email for x in users], ['%02d' % x for x in range(25)])
+        self.assertDictEqual(self.es._scrolls, {})
+
+    def test_asahi_memory_group_by_aggregate(self):
+        self.__save_articles()
+        self.assertListEqual(MemoryArticle.all().group_by('category'), [
+            {'key': 'orm', 'doc_count': 2},
+            {'key': 'draft', 'doc_count': 1},
+            {'key': 'note', 'doc_count': 1},
+        ])
+        result = MemoryArticle.where('views', unequal=None).aggregate(
+            category=Terms('category', aggs={'views': Sum('views')}),
+            published=Terms('published'),
+            monthly=DateHistogram('created_at', interval='month', min_doc_count=0),
+            daily=DateHistogram('created_at', interval='day', time_zone='+08:00'),
+            stats=Stats('views'),
+            percentiles=Percentiles('views', percents=[50]),
+            tags=Cardinality('tags'),
+        )
+        self.assertListEqual(result['category'], [Bucket('orm', 2, {'views': 17.0}), Bucket('note', 1, {'views': 3.0})])
+        self.assertListEqual(result['published'], [Bucket(True, 2), Bucket(False, 1)])
+        self.assertListEqual(result['monthly'], [Bucket(datetime(2016, 10, 1), 2), Bucket(datetime(2016, 11, 1), 1)])
+        self.assertListEqual([x.key for x in result['daily']],
+                             [datetime(2016, 9, 30, 16), datetime(2016, 10, 2, 16), datetime(2016, 11, 4, 16)])
+        self.assertDictEqual(result['stats'], {'count': 3, 'min': 3.0, 'max': 10.0, 'avg': 20 / 3.0, 'sum': 20.0})
+        self.assertDictEqual(result['percentiles'], {50.0: 7.0})
+        self.assertEqual(result['tags'], 3)
+
+    def test_asahi_memory_references_msearch(self):
+        company = MemoryCompany(name='Rinse')
+        company.save()
+        user = MemoryUser(name='Kelp', company=company)
+        user.save(synchronized=True)
+        MemoryArticle(title='asahi', author=user).save(synchronized=True)
+        article = MemoryArticle.all().first(include=['author.company'])
+        self.assertEqual(article.author.name, 'Kelp')
+        self.assertEqual(article.author.company.name, 'Rinse')
+        (articles, total), count = msearch([
+            MemoryArticle.all().fetch_spec(include=['author.company']),
+            MemoryUser.where('name', equal='kelp').count_spec(),
+        ])
+        self.assertEqual(total, 1)
+        self.assertEqual(articles[0].author.company.name, 'Rinse')
+        self.assertEqual(count, 1)
+
+    def test_asahi_memory_range_after_changes(self):
+        articles = self.__save_articles()
+        self.assertEqual(MemoryArticle.where('views', greater_equal=7).count(), 2)
+        articles[1].views = 8
+        articles[1].save()
+        articles[2].delete(synchronized=True)
+        self.assertListEqual(self.__fetch_titles(MemoryArticle.where('views', greater_equal=7).order_by('views'))[0],
+                             ['Rinse kelp', 'Asahi ElasticSearch'])
+
+    def test_asahi_memory_msearch_concurrent(self):
+        import threading
+        MemoryArticle(title='asahi', category='orm').save(synchronized=True)
+        search = self.es.search
+        writers = []
+        def search_then_write(*args, **kwargs):
+            result = search(*args, **kwargs)
+            if not writers:
+                # another thread writes between searches of the msearch
+                writer = threading.Thread(target=MemoryArticle(title='kelp', category='orm').save,
+                                          kwargs={'synchronized': True})
+                writers.append(writer)
+                writer.start()
+                writer.join(0.2)
+            return result
+        with patch.object(self.es, 'search', new=search_then_write):
+            counts = msearch([
+                MemoryArticle.where('category', equal='orm').count_spec(),
+                MemoryArticle.all().count_spec(),
+            ])
+        writers[0].join()
+        self.assertListEqual(counts, [1, 1])
+        self.assertEqual(MemoryArticle.where('category', equal='orm').count(), 2)
+
+    def test_asahi_memory_references_are_not_changes(self):
+        user = MemoryUser(name='Kelp')
+        user.save()
+        MemoryArticle(title='asahi', author=user).save()
+        MemoryArticle(title='dangling', author='missing').save(synchronized=True)
+        articles = {x.title: x for x in MemoryArticle.all().fetch()[0]}
+        self.assertEqual(articles['asahi'].author.name, 'Kelp')
+        self.assertIsNone(articles['dangling'].author)
+        with patch.object(self.es, 'index') as index, patch.object(self.es, 'update') as update:
+            for article in articles.values():
+                self.assertSetEqual(article._dirty, set())
+                article.save()
+                article.save(partial=True)
+            index.assert_not_called()
+            update.assert_not_called()
+        articles['dangling'].title = 'changed'
+        articles['dangling'].save(partial=True)
+        self.assertEqual(MemoryArticle.get(articles['dangling']._id, fetch_reference=False).author, 'missing')
+
+    def test_asahi_memory_bulk(self):
+        users = [MemoryUser(name='user %d' % x) for x in range(3)]
+        MemoryUser.save_many(users, synchronized=True)
+        self.assertListEqual([x._version for x in users], [1, 1, 1])
+        self.assertEqual(MemoryUser.all().count(), 3)
+        stale = MemoryUser._from_hit({'_id': users[0]._id, '_version': 1, '_source': {'name': 'user 0'}})
+        users[0].name = 'changed'
+        users[0].save()
+        stale.name = 'stale'
+        users[1].name = 'saved'
+        with self.assertRaises(BulkError) as context:
+            MemoryUser.save_many([stale, users[1]])
+        self.assertEqual([x['document'] for x in context.exception.conflicts], [stale])
+        self.assertEqual(MemoryUser.get(users[1]._id).name, 'saved')
+        MemoryUser.delete_many(users, synchronized=True)
+        self.assertEqual(MemoryUser.all().count(), 0)
+
+    def test_asahi_memory_session(self):
+        user = MemoryUser(name='Kelp')
+        with Session(synchronized=True):
+            user.save()
+            MemoryUser(name='Rinse').save()
+            self.assertEqual(MemoryUser.all().count(), 0)
+        self.assertEqual(MemoryUser.all().count(), 2)
+
+    def test_asahi_memory_swap_index(self):
+        MemoryUser(name='Kelp').save()
+        index = MemoryUser.create_next_index()
+        self.assertEqual(index, 'memoryuser_v2')
+        self.assertEqual(self.es.indices.get_settings(index=index)[index]['settings']['index']['refresh_interval'],
+                         '-1')
+        MemoryUser.swap_index(index)
+        self.assertListEqual(MemoryUser.get_index_versions(), ['memoryuser_v2'])
+        self.assertEqual(self.es.indices.get_settings(index=index)[index]['settings']['index']['refresh_interval'],
+                         '1s')
+        self.assertEqual(MemoryUser.all().count(), 0)
+        self.assertFalse(self.es.indices.exists(index='memoryuser_v1'))
+
+    def test_asahi_memory_sync_mapping(self):
+        class MemoryMapping(Document):
+            _index_name = 'memorymapping'
+            name = StringProperty()
+        self.assertTrue(MemoryMapping.sync_mapping()['created'])
+        class MemoryMapping(Document):
+            _index_name = 'memorymapping'
+            name = StringProperty()
+            code = StringProperty(analyzed=False)
+        self.assertDictEqual(MemoryMapping.sync_mapping(),
+                             {'created': False, 'added': ['code'], 'updated': [], 'conflicts': []})
+        MemoryMapping(code='A-1').save(synchronized=True)
+        self.assertEqual(MemoryMapping.where('code', equal='A-1').count(), 1)
+        self.assertEqual(MemoryMapping.where('code', equal='a').count(), 0)
+
+    def test_asahi_memory_asyncio(self):
+        async def run():
+            user = MemoryUser(name='Kelp')
+            await user.asave(synchronized=True)
+            fetched = await MemoryUser.aget(user._id)
+            documents, total = await MemoryUser.where('name', equal='kelp').afetch()
+            count = await MemoryUser.all().acount()
+            await fetched.adelete()
+            return fetched, documents, total, count, await MemoryUser.aget(user._id)
+        fetched, documents, total, count, deleted = asyncio.run(run())
+        self.assertEqual(fetched.name, 'Kelp')
+        self.assertEqual((documents[0]._id, total, count), (fetched._id, 1, 1))
+        self.assertIsNone(deleted)
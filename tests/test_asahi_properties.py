@@ -1,6 +1,104 @@
 import unittest
+from datetime import datetime
+from mock import MagicMock, patch
 from asahi import properties
+from asahi.document import Document
 
 
-class TestAsahiProperties(unittest.TestCase):
+class FakeItem(dict):
     pass
+class FakeDocument(Document):
+    name = properties.StringProperty()
+    time = properties.DateTimeProperty()
+    tags = properties.ListProperty(str, default=[])
+    items = properties.ListProperty(FakeItem, default=[])
+
+
+class TestAsahiProperties(unittest.TestCase):
+    def test_asahi_properties_from_hit_keeps_raw_json(self):
+        document = FakeDocument._from_hit({
+            '_id': 'id-A',
+            '_version': 1,
+            '_source': {'name': 'kelp', 'time': '2014-12-01T10:00:00Z', 'unknown': 1},
+        })
+        self.assertDictEqual(document._document, {
+            '_id': 'id-A',
+            '_version': 1,
+            'name': 'kelp',
+            'time': '2014-12-01T10:00:00Z',
+            'tags': [],
+            'items': [],
+        })
+        self.assertDictEqual(document._decoded, {})
+
+    def test_asahi_properties_decode_once(self):
+        document = FakeDocument._from_hit({'_id': 'id-A', '_version': 1, '_source': {'time': '2014-12-01T10:00:00Z'}})
+        with patch.object(properties.DateTimeProperty, '_to_python', new=MagicMock(return_value=datetime(2014, 12, 1, 10))) as mock_to_python:
+            self.assertEqual(document.time, datetime(2014, 12, 1, 10))
+            self.assertEqual(document.time, datetime(2014, 12, 1, 10))
+        mock_to_python.assert_called_once_with('2014-12-01T10:00:00Z')
+
+    def test_asahi_properties_set_invalidate_decoded(self):
+        document = FakeDocument._from_hit({'_id': 'id-A', '_version': 1, '_source': {'time': '2014-12-01T10:00:00Z'}})
+        self.assertEqual(document.time, datetime(2014, 12, 1, 10))
+        document.time = datetime(2015, 1, 1)
+        self.assertEqual(document.time, datetime(2015, 1, 1))
+        self.assertEqual(document._document['time'], '2015-01-01T00:00:00Z')
+
+    def test_asahi_properties_list_decode_once(self):
+        document = FakeDocument._from_hit({'_id': 'id-A', '_version': 1, '_source': {'items': [{'a': 1}], 'tags': ['x']}})
+        self.assertIs(document.items, document.items)
+        self.assertIsInstance(document.items[0], FakeItem)
+        document.tags.append('y')
+        self.assertListEqual(document._document['tags'], ['x', 'y'])
+        document.tags = ['z']
+        self.assertEqual(document.tags, ['z'])
+
+    def test_asahi_properties_list_dict_items_are_saved(self):
+        document = FakeDocument._from_hit({'_id': 'id-A', '_version': 1, '_source': {'items': [{'a': 1}]}})
+        document.items[0]['a'] = 2
+        document.items.append(FakeItem(b=1))
+        self.assertListEqual(document.items, [{'a': 2}, {'b': 1}])
+        self.assertListEqual(document._prepare_save()['items'], [{'a': 2}, {'b': 1}])
+        self.assertDictEqual(document._prepare_partial_save(), {'items': [{'a': 2}, {'b': 1}]})
+
+    def test_asahi_properties_string_mapping(self):
+        self.assertDictEqual(properties.StringProperty().get_mapping(), {'type': 'string'})
+        self.assertDictEqual(properties.StringProperty(analyzed=False).get_mapping(), {
+            'type': 'string',
+            'index': 'not_analyzed',
+        })
+        self.assertDictEqual(properties.StringProperty(searchable='substring').get_mapping(), {
+            'type': 'string',
+            'fields': {
+                'ngram': {'type': 'string', 'analyzer': 'asahi_ngram', 'search_analyzer': 'asahi_ngram_search'},
+            },
+        })
+        self.assertRaises(ValueError, properties.StringProperty, searchable='prefix')
+
+    def test_asahi_properties_mapping(self):
+        self.assertDictEqual(properties.IntegerProperty(doc_values=True).get_mapping(), {
+            'type': 'long',
+            'doc_values': True,
+        })
+        self.assertDictEqual(properties.FloatProperty(index=False).get_mapping(), {'type': 'double', 'index': 'no'})
+        self.assertDictEqual(properties.BooleanProperty().get_mapping(), {'type': 'boolean'})
+        self.assertDictEqual(properties.DateTimeProperty().get_mapping(), {
+            'type': 'date',
+            'format': 'dateOptionalTime',
+        })
+        self.assertDictEqual(properties.StringProperty(analyzed=False, eager_global_ordinals=True).get_mapping(), {
+            'type': 'string',
+            'index': 'not_analyzed',
+            'fielddata': {'loading': 'eager_global_ordinals'},
+        })
+        self.assertDictEqual(properties.ListProperty(datetime).get_mapping(), {
+            'type': 'date',
+            'format': 'dateOptionalTime',
+        })
+        self.assertDictEqual(properties.ListProperty(FakeItem).get_mapping(), {'type': 'object', 'enabled': True})
+        self.assertDictEqual(properties.DictProperty(index=False).get_mapping(), {'type': 'object', 'enabled': False})
+        self.assertDictEqual(properties.ReferenceProperty(FakeDocument).get_mapping(), {
+            'type': 'string',
+            'index': 'not_analyzed',
+        })
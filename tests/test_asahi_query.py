@@ -1,9 +1,14 @@
+import asyncio
 import unittest
+import warnings
+from datetime import datetime
 from mock import MagicMock, patch
-from asahi.query import QueryOperation, QueryCell, Query
-from asahi.document import Document
-from asahi.properties import StringProperty, DateTimeProperty
-from asahi.exceptions import QuerySyntaxError
+from asahi.query import QueryOperation, QueryCell, Query, QueryParameter, QueryTemplate
+from asahi import query as asahi_query
+from asahi.document import Document, reset_ensured_indices
+from asahi.properties import StringProperty, DateTimeProperty, IntegerProperty
+from asahi.exceptions import QuerySyntaxError, PropertyNotExist, LeadingWildcardWarning
+from tests import async_mock
 
 
 class TestAsahiQueryOperation(unittest.TestCase):
@@ -51,8 +56,14 @@ class FakeDocument(Document):
     name = StringProperty()
     nickname = StringProperty()
     time = DateTimeProperty()
+class FakeExactDocument(FakeDocument):
+    code = StringProperty(analyzed=False)
+    age = IntegerProperty()
+class FakeSubstringDocument(FakeDocument):
+    email = StringProperty(searchable='substring')
 class TestAsahiQuery(unittest.TestCase):
     def setUp(self):
+        reset_ensured_indices()
         self.query = Query(FakeDocument)
 
     def test_asahi_query(self):
@@ -82,17 +93,154 @@ class TestAsahiQuery(unittest.TestCase):
             version=True,
         )
 
+    def test_asahi_query_fetch_only(self):
+        fake_es = MagicMock()
+        fake_es.search.return_value = {
+            'hits': {
+                'hits': [{'_id': 'id-A', '_version': 1, '_source': {'name': 'kelp'}}],
+                'total': 1
+            }
+        }
+        with patch('asahi.document.Document._es', new=fake_es):
+            self.query.document_class.get_index_name = MagicMock(return_value='index_name')
+            documents, total = self.query.only('name').fetch(fetch_reference=False)
+        fake_es.search.assert_called_once_with(
+            index='index_name',
+            body={'sort': [], 'fields': ['_source'], 'from': 0, 'size': 1000},
+            version=True,
+            _source_include=['name'],
+        )
+        self.assertSetEqual(documents[0]._deferred, {'nickname', 'time'})
+
+    def test_asahi_query_defer(self):
+        self.query.defer('time')
+        self.assertSetEqual(self.query.deferred_members, {'time'})
+        self.assertRaises(PropertyNotExist, self.query.defer, 'email')
+
+    def test_asahi_query_iter(self):
+        fake_es = MagicMock()
+        fake_es.search.return_value = {
+            '_scroll_id': 'scroll-A',
+            'hits': {'hits': [{'_id': 'id-A', '_version': 1, '_source': {}}, {'_id': 'id-B', '_version': 1, '_source': {}}]}
+        }
+        fake_es.scroll.return_value = {
+            '_scroll_id': 'scroll-B',
+            'hits': {'hits': [{'_id': 'id-C', '_version': 1, '_source': {}}]}
+        }
+        with patch('asahi.document.Document._es', new=fake_es):
+            self.query.document_class.get_index_name = MagicMock(return_value='index_name')
+            documents = list(self.query.iter(batch_size=2, fetch_reference=False))
+        self.assertListEqual([x._id for x in documents], ['id-A', 'id-B', 'id-C'])
+        fake_es.search.assert_called_once_with(
+            index='index_name',
+            body={'sort': [], 'fields': ['_source'], 'from': 0, 'size': 2},
+            scroll='1m',
+            version=True,
+        )
+        fake_es.scroll.assert_called_once_with(scroll_id='scroll-A', scroll='1m')
+        fake_es.clear_scroll.assert_called_once_with(scroll_id='scroll-B')
+
+    def test_asahi_query_iter_close(self):
+        fake_es = MagicMock()
+        fake_es.search.return_value = {
+            '_scroll_id': 'scroll-A',
+            'hits': {'hits': [{'_id': 'id-A', '_version': 1, '_source': {}}]}
+        }
+        fake_es.scroll.return_value = {'_scroll_id': 'scroll-B', 'hits': {'hits': []}}
+        with patch('asahi.document.Document._es', new=fake_es):
+            self.query.document_class.get_index_name = MagicMock(return_value='index_name')
+            documents = self.query.iter(batch_size=1, fetch_reference=False)
+            next(documents)
+            documents.close()
+        fake_es.clear_scroll.assert_called_once_with(scroll_id='scroll-B')
+
+    def test_asahi_query_afetch(self):
+        fake_es = MagicMock()
+        fake_es.indices.exists = async_mock(True)
+        fake_es.search = async_mock({
+            'hits': {
+                'hits': [{'_id': 'id-A', '_version': 1, '_source': {'name': 'kelp'}}],
+                'total': 1
+            }
+        })
+        with patch('asahi.document.Document._async_es', new=fake_es):
+            self.query.document_class.get_index_name = MagicMock(return_value='index_name')
+            documents, total = asyncio.run(self.query.afetch(fetch_reference=False))
+        fake_es.search.assert_called_once_with(
+            index='index_name',
+            body={'sort': [], 'fields': ['_source'], 'from': 0, 'size': 1000},
+            version=True,
+        )
+        self.assertEqual(total, 1)
+        self.assertEqual(documents[0].name, 'kelp')
+
+    def test_asahi_query_acount(self):
+        fake_es = MagicMock()
+        fake_es.indices.exists = async_mock(True)
+        fake_es.count = async_mock({'count': 3})
+        with patch('asahi.document.Document._async_es', new=fake_es):
+            self.query.document_class.get_index_name = MagicMock(return_value='index_name')
+            count = asyncio.run(self.query.acount())
+        fake_es.count.assert_called_once_with(index='index_name', body=None)
+        self.assertEqual(count, 3)
+
+    def test_asahi_query_agroup_by(self):
+        fake_es = MagicMock()
+        fake_es.indices.exists = async_mock(True)
+        fake_es.search = async_mock({'aggregations': {'group': {'buckets': [{'key': 'kelp', 'doc_count': 1}]}}})
+        with patch('asahi.document.Document._async_es', new=fake_es):
+            self.query.document_class.get_index_name = MagicMock(return_value='index_name')
+            buckets = asyncio.run(self.query.agroup_by('name'))
+        self.assertListEqual(buckets, [{'key': 'kelp', 'doc_count': 1}])
+        self.assertEqual(fake_es.search.call_args[1]['body']['aggs']['group']['terms']['field'], 'name')
+
+    def test_asahi_query_exists(self):
+        fake_es = MagicMock()
+        fake_es.search.return_value = {'hits': {'total': 2, 'hits': []}}
+        with patch('asahi.document.Document._es', new=fake_es), \
+                patch.object(FakeDocument, 'get_index_name', return_value='index_name'):
+            self.assertTrue(Query(FakeDocument).where('name', equal='kelp').exists())
+        fake_es.search.assert_called_once_with(
+            index='index_name',
+            body={
+                'size': 0,
+                'query': {'filtered': {'filter': {'query': {'match': {'name': {'query': 'kelp', 'operator': 'and'}}}}}},
+            },
+            terminate_after=1,
+        )
+    def test_asahi_query_exists_contains_empty(self):
+        fake_es = MagicMock()
+        with patch('asahi.document.Document._es', new=fake_es):
+            self.assertFalse(Query(FakeDocument).where('name', contains=[]).exists())
+        fake_es.search.assert_not_called()
+    def test_asahi_query_count_upto(self):
+        fake_es = MagicMock()
+        fake_es.search.return_value = {'hits': {'total': 120, 'hits': []}}  # terminate_after is per shard
+        with patch('asahi.document.Document._es', new=fake_es), \
+                patch.object(FakeDocument, 'get_index_name', return_value='index_name'):
+            self.assertEqual(Query(FakeDocument).count(upto=99), 99)
+        fake_es.search.assert_called_once_with(index='index_name', body={'size': 0}, terminate_after=99)
+        fake_es.count.assert_not_called()
+    def test_asahi_query_aexists(self):
+        fake_es = MagicMock()
+        fake_es.indices.exists = async_mock(True)
+        fake_es.search = async_mock({'hits': {'total': 0, 'hits': []}})
+        with patch('asahi.document.Document._async_es', new=fake_es), \
+                patch.object(FakeDocument, 'get_index_name', return_value='index_name'):
+            self.assertFalse(asyncio.run(Query(FakeDocument).aexists()))
+        fake_es.search.assert_called_once_with(index='index_name', body={'size': 0}, terminate_after=1)
+
     def test_asahi_query_first_none(self):
         self.query.fetch = MagicMock()
         self.query.fetch.return_value = tuple([[], 0])
         item = self.query.first()
-        self.query.fetch.assert_called_once_with(1, 0, fetch_reference=True)
+        self.query.fetch.assert_called_once_with(1, 0, fetch_reference=True, include=None)
         self.assertIsNone(item)
     def test_asahi_query_first(self):
         self.query.fetch = MagicMock()
         self.query.fetch.return_value = tuple([[{'_id': '4689f7addaedc3d52a9688722c3e595b', '_rev': '1-4689f7addaedc3d52a9688722c3e595b'}], 1])
         item = self.query.first()
-        self.query.fetch.assert_called_once_with(1, 0, fetch_reference=True)
+        self.query.fetch.assert_called_once_with(1, 0, fetch_reference=True, include=None)
         self.assertDictEqual(item, {
             '_id': '4689f7addaedc3d52a9688722c3e595b',
             '_rev': '1-4689f7addaedc3d52a9688722c3e595b',
@@ -197,6 +345,118 @@ class TestAsahiQuery(unittest.TestCase):
         })
         self.assertListEqual(sort_list, [])
 
+    def test_asahi_query__compile_queries_template_cache(self):
+        asahi_query._query_templates.clear()
+        query_a = Query(FakeDocument).where('name', equal='<kelp>').where('time', less=datetime(2014, 12, 1))
+        query_b = Query(FakeDocument).where('name', equal='asahi').where('time', less=datetime(2015, 1, 1))
+        es_query_a, _ = query_a._Query__compile_queries(query_a.items)
+        es_query_b, _ = query_b._Query__compile_queries(query_b.items)
+        self.assertEqual(len(asahi_query._query_templates), 1)
+        self.assertEqual(query_a.items[1].value, '<kelp>')
+        self.assertDictEqual(es_query_a['bool']['should'][0]['bool']['should'][0], {
+            'match': {'name': {'query': 'kelp', 'operator': 'and'}}
+        })
+        self.assertDictEqual(es_query_b['bool']['should'][0]['bool']['should'][1], {
+            'range': {'time': {'lt': '2015-01-01T00:00:00'}}
+        })
+
+    def test_asahi_query__compile_queries_template_shape(self):
+        asahi_query._query_templates.clear()
+        for value in [['a'], ['a', 'b'], None, 'a']:
+            query = Query(FakeDocument).where('name', equal=value) if not isinstance(value, list)\
+                else Query(FakeDocument).where('name', contains=value)
+            query._Query__compile_queries(query.items)
+        self.assertEqual(len(asahi_query._query_templates), 3)  # lists of any length have the same shape
+
+    def test_asahi_query__compile_queries_contains_iterable(self):
+        for value in [{'a'}, ('a',), (x for x in ['a'])]:
+            query = Query(FakeDocument).where('name', contains=value)
+            es_query, _ = query._Query__compile_queries(query.items)
+            self.assertDictEqual(es_query['bool']['should'][0]['bool']['should'][0], {
+                'bool': {'should': [{'match': {'name': {'query': 'a', 'operator': 'and'}}}]}
+            })
+        query = Query(FakeExactDocument).where('age', contains={2})
+        es_query, _ = query._Query__compile_queries(query.items, filter_context=True)
+        self.assertDictEqual(es_query, {'filtered': {'filter': {'terms': {'age': [2]}}}})
+
+    def test_asahi_query__compile_queries_template_lru(self):
+        asahi_query._query_templates.clear()
+        with patch.object(asahi_query, 'QUERY_TEMPLATES_LIMIT', 2):
+            for member in ['name', 'time', 'name', 'nickname']:
+                query = Query(FakeDocument).where(member, equal=None)
+                query._Query__compile_queries(query.items)
+        self.assertListEqual([x[2][-1][1] for x in asahi_query._query_templates], ['name', 'nickname'])
+
+    def test_asahi_query__compile_queries_filter_context(self):
+        query = Query(FakeExactDocument).where('code', equal='A1')\
+            .where('age', contains=[1, 2])\
+            .where('name', equal='kelp')\
+            .where('nickname', unequal=None)\
+            .order_by('time')
+        es_query, _ = query._Query__compile_queries(query.items)
+        self.assertDictEqual(es_query, {
+            'filtered': {
+                'filter': {
+                    'bool': {
+                        'must': [
+                            {'term': {'code': 'A1'}},
+                            {'terms': {'age': [1, 2]}},
+                            {'query': {'match': {'name': {'query': 'kelp', 'operator': 'and'}}}},
+                            {'exists': {'field': 'nickname'}},
+                        ]
+                    }
+                }
+            }
+        })
+    def test_asahi_query__compile_queries_filter_context_union(self):
+        query = Query(FakeExactDocument).filter('code', equal='A1').union('time', less=datetime(2014, 12, 1))
+        es_query, _ = query._Query__compile_queries(query.items)
+        self.assertIs(query.scoring, False)
+        self.assertDictEqual(es_query, {
+            'filtered': {
+                'filter': {
+                    'bool': {
+                        'should': [
+                            {'term': {'code': 'A1'}},
+                            {'range': {'time': {'lt': '2014-12-01T00:00:00'}}},
+                        ]
+                    }
+                }
+            }
+        })
+    def test_asahi_query__compile_queries_filter_context_shape(self):
+        asahi_query._query_templates.clear()
+        query = Query(FakeExactDocument).where('code', equal='A1')
+        scoring_query, _ = query._Query__compile_queries(query.items)
+        filter_query, _ = query._Query__compile_queries(query.items, filter_context=True)
+        self.assertEqual(len(asahi_query._query_templates), 2)
+        self.assertIn('bool', scoring_query)
+        self.assertDictEqual(filter_query, {'filtered': {'filter': {'term': {'code': 'A1'}}}})
+    def test_asahi_query_count_filter_context(self):
+        fake_es = MagicMock()
+        fake_es.count.return_value = {'count': 2}
+        with patch('asahi.document.Document._es', new=fake_es), \
+                patch.object(FakeExactDocument, 'get_index_name', return_value='index_name'):
+            count = Query(FakeExactDocument).where('code', equal=None).count()
+        fake_es.count.assert_called_once_with(
+            index='index_name',
+            body={'query': {'filtered': {'filter': {'missing': {'field': 'code'}}}}},
+        )
+        self.assertEqual(count, 2)
+
+    def test_asahi_query_query_template(self):
+        template = QueryTemplate({
+            'range': {'time': {'gte': QueryParameter(1, lambda x: x + 1)}},
+            'terms': [QueryParameter(0)],
+            "it's": [None, True, 1.5],
+        })
+        self.assertDictEqual(template.bind(['a', 1]), {
+            'range': {'time': {'gte': 2}},
+            'terms': ['a'],
+            "it's": [None, True, 1.5],
+        })
+        self.assertIsNot(template.bind(['a', 1])['terms'], template.bind(['a', 1])['terms'])
+
     def test_asahi_query__compile_query_like(self):
         query_cell = QueryCell(
             QueryOperation.like,
@@ -258,6 +518,42 @@ class TestAsahiQuery(unittest.TestCase):
                     ]
                 }
         })
+    def test_asahi_query__compile_query_like_substring(self):
+        query = Query(FakeSubstringDocument)
+        result = query._Query__compile_query(QueryCell(QueryOperation.like, member='email', value='Kelp'))
+        self.assertDictEqual(result, {
+            'bool': {
+                'should': [
+                    {'match': {'email.ngram': {'query': 'Kelp', 'operator': 'and'}}},
+                    {'term': {'email.ngram': 'kelp'}},
+                ]
+            }
+        })
+        result = query._Query__compile_query(QueryCell(QueryOperation.unlike, member='email', value='ke'))
+        self.assertDictEqual(result, {
+            'bool': {
+                'must_not': [
+                    {'match': {'email.ngram': {'query': 'ke', 'operator': 'and'}}},
+                    {'term': {'email.ngram': 'ke'}},
+                ]
+            }
+        })
+    def test_asahi_query__compile_queries_like_leading_wildcard(self):
+        asahi_query._query_templates.clear()
+        with patch.object(FakeDocument, '_leading_wildcard', new='warn'):
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always')
+                for value in ['kelp', 'asahi']:  # the second query is bound to the cached template
+                    query = Query(FakeDocument).where(lambda x: x.where('name', like=value))
+                    query._Query__compile_queries(query.items)
+            self.assertListEqual([x.category for x in caught], [LeadingWildcardWarning] * 2)
+        with patch.object(FakeDocument, '_leading_wildcard', new='refuse'):
+            query = Query(FakeDocument).where('name', unlike='kelp')
+            self.assertRaises(QuerySyntaxError, query._Query__compile_queries, query.items)
+            self.assertRaises(QuerySyntaxError, query._Query__compile_queries, query.items)
+        with patch.object(FakeSubstringDocument, '_leading_wildcard', new='refuse'):
+            query = Query(FakeSubstringDocument).where('email', like='kelp')
+            query._Query__compile_queries(query.items)
     def test_asahi_query__compile_query_among(self):
         query_cell = QueryCell(
             QueryOperation.contains,
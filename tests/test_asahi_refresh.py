@@ -0,0 +1,95 @@
+import asyncio
+import unittest
+from mock import MagicMock, patch
+import asahi
+from asahi.document import Document, reset_ensured_indices
+from asahi.properties import StringProperty
+from asahi.refresh import refresh_after, in_refresh_scope
+
+
+class FakeUser(Document):
+    name = StringProperty()
+class FakeArticle(Document):
+    title = StringProperty()
+
+
+class TestAsahiRefresh(unittest.TestCase):
+    def setUp(self):
+        reset_ensured_indices()
+        self.fake_es = MagicMock()
+        self.fake_es.index.return_value = {'_id': 'id-A', '_version': 1}
+        self.patches = [
+            patch('asahi.document.Document._es', new=self.fake_es),
+            patch.object(FakeUser, 'get_index_name', return_value='fakeuser'),
+            patch.object(FakeArticle, 'get_index_name', return_value='fakearticle'),
+        ]
+        for x in self.patches:
+            x.start()
+
+    def tearDown(self):
+        for x in self.patches:
+            x.stop()
+
+    def test_asahi_refresh_export(self):
+        self.assertIs(asahi.refresh_after, refresh_after)
+
+    def test_asahi_refresh_after(self):
+        with refresh_after():
+            self.assertTrue(in_refresh_scope())
+            for x in range(3):
+                FakeUser(name='kelp').save(synchronized=True)
+            FakeArticle(title='asahi').save()
+            FakeUser._from_hit({'_id': 'id-B', '_version': 1, '_source': {}}).delete()
+            self.fake_es.indices.refresh.assert_not_called()
+        self.assertFalse(in_refresh_scope())
+        self.fake_es.indices.refresh.assert_called_once_with(index='fakearticle,fakeuser')
+
+    def test_asahi_refresh_after_bulk(self):
+        self.fake_es.bulk.return_value = {'items': [{'index': {'_id': 'id-A', '_version': 1, 'status': 201}}]}
+        with refresh_after():
+            Document.save_many([FakeUser(name='kelp')], synchronized=True)
+        self.fake_es.indices.refresh.assert_called_once_with(index='fakeuser')
+
+    def test_asahi_refresh_after_nothing_written(self):
+        document = FakeUser._from_hit({'_id': 'id-A', '_version': 1, '_source': {'name': 'kelp'}})
+        with refresh_after():
+            document.save()
+        self.fake_es.index.assert_not_called()
+        self.fake_es.indices.refresh.assert_not_called()
+
+    def test_asahi_refresh_after_exception(self):
+        with self.assertRaises(ValueError):
+            with refresh_after():
+                FakeUser(name='kelp').save()
+                raise ValueError()
+        self.fake_es.indices.refresh.assert_called_once_with(index='fakeuser')
+
+    def test_asahi_refresh_after_wait_for(self):
+        with patch('asahi.refresh.time.sleep') as mock_sleep, \
+                patch('asahi.refresh.utils.get_refresh_interval', return_value=1.0):
+            with refresh_after(wait_for=True):
+                FakeUser(name='kelp').save(synchronized=True)
+        self.fake_es.indices.refresh.assert_not_called()
+        self.assertEqual(mock_sleep.call_count, 1)
+        self.assertTrue(0 < mock_sleep.call_args[0][0] <= 1.0)
+
+    def test_asahi_refresh_after_async(self):
+        async def coroutine(*args, **kwargs):
+            return {'_id': 'id-A', '_version': 1}
+        async_es = MagicMock()
+        async_es.index.side_effect = coroutine
+        async_es.indices.exists.side_effect = coroutine
+        async_es.indices.refresh.side_effect = coroutine
+        async def run():
+            async with refresh_after():
+                await FakeUser(name='kelp').asave(synchronized=True)
+                await FakeUser(name='asahi').asave(synchronized=True)
+                async_es.indices.refresh.assert_not_called()
+        with patch('asahi.document.Document._async_es', new=async_es):
+            asyncio.run(run())
+        async_es.indices.refresh.assert_called_once_with(index='fakeuser')
+
+    def test_asahi_refresh_without_scope(self):
+        FakeUser(name='kelp').save(synchronized=True)
+        FakeUser(name='kelp').save(synchronized=True)
+        self.assertEqual(self.fake_es.indices.refresh.call_count, 2)
@@ -0,0 +1,226 @@
+import json
+import unittest
+from mock import MagicMock, patch
+import asahi
+from asahi.document import Document, reset_ensured_indices
+from asahi.properties import StringProperty
+from asahi.session import Session, SessionMiddleware, get_current_session
+from asahi.exceptions import BulkError
+
+
+class FakeUser(Document):
+    name = StringProperty()
+class FakeArticle(Document):
+    title = StringProperty()
+
+
+class TestAsahiSession(unittest.TestCase):
+    def setUp(self):
+        reset_ensured_indices()
+        self.fake_es = MagicMock()
+        self.patches = [
+            patch('asahi.document.Document._es', new=self.fake_es),
+            patch.object(FakeUser, 'get_index_name', return_value='fakeuser'),
+            patch.object(FakeArticle, 'get_index_name', return_value='fakearticle'),
+        ]
+        for x in self.patches:
+            x.start()
+
+    def tearDown(self):
+        for x in self.patches:
+            x.stop()
+
+    def __get_bulk_lines(self):
+        return [json.loads(x) for x in self.fake_es.bulk.call_args[1]['body'].splitlines()]
+
+    def test_asahi_session_export(self):
+        self.assertIs(asahi.Session, Session)
+
+    def test_asahi_session_commit(self):
+        self.fake_es.bulk.return_value = {'items': [
+            {'index': {'_id': 'user-A', '_version': 1, 'status': 201}},
+            {'update': {'_id': 'article-A', '_version': 3, 'status': 200}},
+            {'delete': {'_id': 'article-B', '_version': 2, 'status': 200}},
+        ]}
+        user = FakeUser(name='kelp')
+        article = FakeArticle._from_hit({'_id': 'article-A', '_version': 2, '_source': {'title': 'asahi'}})
+        removed = FakeArticle._from_hit({'_id': 'article-B', '_version': 1, '_source': {}})
+        with Session() as session:
+            self.assertIs(get_current_session(), session)
+            user.save()
+            user.save()  # deduplicated
+            article.title = 'kelp'
+            article.save(partial=True)
+            removed.delete()
+            self.fake_es.index.assert_not_called()
+            self.fake_es.delete.assert_not_called()
+            self.fake_es.bulk.assert_not_called()
+        self.assertIsNone(get_current_session())
+        self.assertEqual(self.fake_es.bulk.call_count, 1)
+        lines = self.__get_bulk_lines()
+        self.assertEqual(len(lines), 5)
+        self.assertDictEqual(lines[0], {'index': {'_index': 'fakeuser', '_type': 'FakeUser', '_version': 0}})
+        self.assertDictEqual(lines[1], {'name': 'kelp'})
+        self.assertDictEqual(lines[2], {'update': {'_index': 'fakearticle', '_type': 'FakeArticle',
+                                                   '_id': 'article-A', '_version': 2}})
+        self.assertDictEqual(lines[3], {'doc': {'title': 'kelp'}})
+        self.assertDictEqual(lines[4], {'delete': {'_index': 'fakearticle', '_type': 'FakeArticle',
+                                                   '_id': 'article-B'}})
+        self.assertEqual(user._id, 'user-A')
+        self.assertEqual(article._version, 3)
+        self.fake_es.indices.refresh.assert_not_called()
+
+    def test_asahi_session_save_then_delete(self):
+        self.fake_es.bulk.return_value = {'items': [{'delete': {'_id': 'user-A', 'status': 200}}]}
+        user = FakeUser._from_hit({'_id': 'user-A', '_version': 1, '_source': {}})
+        with Session():
+            user.name = 'kelp'
+            user.save()
+            user.delete()
+        lines = self.__get_bulk_lines()
+        self.assertListEqual(list(lines[0].keys()), ['delete'])
+        self.assertEqual(len(lines), 1)
+
+    def test_asahi_session_save_many_delete_many(self):
+        self.fake_es.bulk.return_value = {'items': [
+            {'index': {'_id': 'user-B', '_version': 2, 'status': 200}},
+            {'delete': {'_id': 'user-A', 'status': 200}},
+        ]}
+        users = [FakeUser._from_hit({'_id': x, '_version': 1, '_source': {}}) for x in ['user-A', 'user-B']]
+        with Session():
+            users[0].name = 'kelp'
+            users[0].save()
+            users[1].name = 'rinse'
+            FakeUser.save_many(users[1:])
+            FakeUser.delete_many(users[:1])
+            self.fake_es.bulk.assert_not_called()
+            self.assertIsNone(FakeUser.get('user-A'))
+        lines = self.__get_bulk_lines()  # the delete is after the save of the same document
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[0]['index']['_id'], 'user-B')
+        self.assertDictEqual(lines[1], {'name': 'rinse'})
+        self.assertEqual(lines[2]['delete']['_id'], 'user-A')
+
+    def test_asahi_session_asave_adelete(self):
+        import asyncio
+        self.fake_es.bulk.return_value = {'items': [
+            {'index': {'_id': 'user-B', '_version': 1, 'status': 201}},
+            {'delete': {'_id': 'user-A', 'status': 200}},
+        ]}
+        async_es = MagicMock()
+        user = FakeUser._from_hit({'_id': 'user-A', '_version': 1, '_source': {}})
+        async def run():
+            with Session():
+                await FakeUser(name='kelp').asave()
+                await user.adelete()
+        with patch('asahi.document.Document._async_es', new=async_es):
+            asyncio.run(run())
+        async_es.index.assert_not_called()
+        async_es.delete.assert_not_called()
+        self.assertListEqual([list(x.keys())[0] for x in self.__get_bulk_lines()], ['index', 'name', 'delete'])
+
+    def test_asahi_session_skip_clean(self):
+        with Session():
+            FakeUser._from_hit({'_id': 'user-A', '_version': 1, '_source': {}}).save()
+            FakeUser().delete()
+        self.fake_es.bulk.assert_not_called()
+
+    def test_asahi_session_rollback(self):
+        with self.assertRaises(ValueError):
+            with Session():
+                FakeUser(name='kelp').save()
+                raise ValueError()
+        self.fake_es.bulk.assert_not_called()
+
+    def test_asahi_session_synchronized(self):
+        self.fake_es.bulk.return_value = {'items': [{'index': {'_id': 'user-A', '_version': 1, 'status': 201}}]}
+        with Session():
+            FakeUser(name='kelp').save(synchronized=True)
+        self.fake_es.indices.refresh.assert_called_once_with(index='fakeuser')
+
+    def test_asahi_session_conflict(self):
+        self.fake_es.bulk.return_value = {'items': [
+            {'index': {'_id': 'user-A', 'status': 409, 'error': 'VersionConflictEngineException'}},
+            {'index': {'_id': 'user-B', '_version': 2, 'status': 200}},
+        ]}
+        documents = [
+            FakeUser._from_hit({'_id': 'user-A', '_version': 1, '_source': {}}),
+            FakeUser._from_hit({'_id': 'user-B', '_version': 1, '_source': {}}),
+        ]
+        with self.assertRaises(BulkError) as context:
+            with Session():
+                for document in documents:
+                    document.name = 'kelp'
+                    document.save()
+        self.assertEqual(len(context.exception.conflicts), 1)
+        self.assertIs(context.exception.conflicts[0]['document'], documents[0])
+        self.assertEqual(documents[1]._version, 2)
+
+    def test_asahi_session_get(self):
+        user = FakeUser._from_hit({'_id': 'user-A', '_version': 1, '_source': {}})
+        removed = FakeUser._from_hit({'_id': 'user-B', '_version': 1, '_source': {}})
+        self.fake_es.mget.return_value = {'docs': [
+            {'_id': 'user-C', '_version': 1, 'found': True, '_source': {'name': 'asahi'}},
+        ]}
+        self.fake_es.bulk.return_value = {'items': [
+            {'index': {'_id': 'user-A', '_version': 2, 'status': 200}},
+            {'delete': {'_id': 'user-B', 'status': 200}},
+        ]}
+        with Session():
+            user.name = 'kelp'
+            user.save()
+            removed.delete()
+            self.assertIs(FakeUser.get('user-A'), user)
+            self.assertIsNone(FakeUser.get('user-B'))
+            documents = FakeUser.get(['user-C', 'user-B', 'user-A'])
+            self.fake_es.get.assert_not_called()
+        self.assertListEqual([x._id for x in documents], ['user-C', 'user-A'])
+        self.assertIs(documents[1], user)
+        self.assertEqual(self.fake_es.mget.call_args[1]['body'], {'ids': ['user-C']})
+
+    def test_asahi_session_middleware(self):
+        self.fake_es.bulk.return_value = {'items': [{'index': {'_id': 'user-A', '_version': 1, 'status': 201}}]}
+        def view(request):
+            FakeUser(name='kelp').save()
+            self.fake_es.bulk.assert_not_called()
+            return MagicMock(status_code=200)
+        response = SessionMiddleware(view)(MagicMock())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.fake_es.bulk.call_count, 1)
+
+    def test_asahi_session_middleware_server_error(self):
+        def view(request):
+            FakeUser(name='kelp').save()
+            return MagicMock(status_code=500)
+        SessionMiddleware(view)(MagicMock())
+        self.fake_es.bulk.assert_not_called()
+
+    def test_asahi_session_middleware_exception(self):
+        def view(request):
+            FakeUser(name='kelp').save()
+            raise ValueError()
+        with self.assertRaises(ValueError):
+            SessionMiddleware(view)(MagicMock())
+        self.fake_es.bulk.assert_not_called()
+        self.assertIsNone(get_current_session())
+
+    def test_asahi_session_middleware_classes(self):
+        # settings.MIDDLEWARE_CLASSES of django < 1.10
+        self.fake_es.bulk.return_value = {'items': [{'index': {'_id': 'user-A', '_version': 1, 'status': 201}}]}
+        middleware = SessionMiddleware()
+        request = MagicMock()
+        middleware.process_request(request)
+        FakeUser(name='kelp').save()
+        self.fake_es.bulk.assert_not_called()
+        response = MagicMock(status_code=200)
+        self.assertIs(middleware.process_response(request, response), response)
+        self.assertEqual(self.fake_es.bulk.call_count, 1)
+        self.assertIsNone(get_current_session())
+
+        middleware.process_request(request)
+        FakeUser(name='kelp').save()
+        self.assertIsNone(middleware.process_exception(request, ValueError()))
+        self.assertIsNone(get_current_session())
+        middleware.process_response(request, MagicMock(status_code=500))  # the response of the exception
+        self.assertEqual(self.fake_es.bulk.call_count, 1)
+        middleware.process_response(MagicMock(), MagicMock(status_code=200))  # process_request was skipped
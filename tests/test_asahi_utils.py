@@ -1,12 +1,59 @@
+import asyncio
 import unittest
 from mock import patch, MagicMock
 from asahi import utils
 
 
 class TestAsahiUtils(unittest.TestCase):
+    def setUp(self):
+        utils.reset_elasticsearch()
+    def tearDown(self):
+        utils.reset_elasticsearch()
+
     def test_asahi_utils_get_elasticsearch(self):
         with patch('django.conf.settings.ELASTICSEARCH_URL', new='http://es:9200'):
             with patch('elasticsearch.Elasticsearch', new=MagicMock(return_value='es')) as mock_es:
                 es = utils.get_elasticsearch()
                 self.assertEqual(es, 'es')
-            mock_es.assert_called_once_with('http://es:9200')
+            mock_es.assert_called_once_with('http://es:9200', maxsize=10)
+
+    def test_asahi_utils_get_elasticsearch_maxsizes(self):
+        maxsizes = {'http://es-a:9200': 50, ('http://es-b:9200', 'http://es-c:9200'): 20}
+        with patch('django.conf.settings.ELASTICSEARCH_MAXSIZES', new=maxsizes, create=True):
+            with patch('elasticsearch.Elasticsearch', new=MagicMock()) as mock_es:
+                utils.get_elasticsearch('http://es-a:9200')
+                utils.get_elasticsearch(['http://es-b:9200', 'http://es-c:9200'])
+                utils.get_elasticsearch('http://es-d:9200')
+        self.assertListEqual([x[1]['maxsize'] for x in mock_es.call_args_list], [50, 20, 10])
+
+    def test_asahi_utils_close_async_clients(self):
+        async def run():
+            with patch('asahi.aio.aiohttp', new=MagicMock()):
+                es = utils.get_async_elasticsearch('http://es:9200')
+            es.close = MagicMock(side_effect=lambda: asyncio.sleep(0))
+            await utils.close_async_clients()
+            self.assertEqual(es.close.call_count, 1)
+            with patch('asahi.aio.aiohttp', new=MagicMock()):
+                self.assertIsNot(utils.get_async_elasticsearch('http://es:9200'), es)
+        asyncio.run(run())
+
+    def test_asahi_utils_get_elasticsearch_shared(self):
+        with patch('elasticsearch.Elasticsearch', new=MagicMock(side_effect=lambda *args, **kwargs: MagicMock())) as mock_es:
+            es = utils.get_elasticsearch()
+            self.assertIs(utils.get_elasticsearch(), es)
+            self.assertIsNot(utils.get_elasticsearch('http://es-b:9200'), es)
+        self.assertEqual(mock_es.call_count, 2)
+
+    def test_asahi_utils_get_elasticsearch_after_fork(self):
+        with patch('elasticsearch.Elasticsearch', new=MagicMock(side_effect=lambda *args, **kwargs: MagicMock())) as mock_es:
+            es = utils.get_elasticsearch()
+            with patch('asahi.utils.os.getpid', new=MagicMock(return_value=-1)):
+                self.assertIsNot(utils.get_elasticsearch(), es)
+        self.assertEqual(mock_es.call_count, 2)
+
+    def test_asahi_utils_elasticsearch_descriptor(self):
+        class Fake(object):
+            _es = utils.ElasticsearchDescriptor()
+        with patch('asahi.utils.get_elasticsearch', new=MagicMock(return_value='es')):
+            self.assertEqual(Fake._es, 'es')
+            self.assertEqual(Fake()._es, 'es')